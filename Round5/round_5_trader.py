@@ -1,7 +1,7 @@
-import copy
+import base64
 import math
+import struct
 
-import jsonpickle
 import numpy as np
 import pandas as pd
 
@@ -23,21 +23,538 @@ EWMA_lambda = 0.94
 MAX_ITERATIONS = 100
 PRECISION = 1.0e-8
 INITIAL_GUESS_VOL = 0.01
+IV_BRACKET = (1.0e-6, 1.0)  # volatility per sqrt(day), prices outside of it have no implied volatility
+IV_MEMO_DECIMALS = 2  # mid prices are multiples of 0.5, rounding the memo key only merges float noise
+IV_MEMO_SIZE = 4096
+RESIDUAL_WINDOW = 100  # ticks of the rolling statistics of the COCONUT / COCONUT_COUPON regression residuals
+RESIDUAL_MIN_COUNT = 30  # below this many ticks the residual signals use the offline mean and std
+
+# fitted model constants, refit by calibrate.py (python calibrate.py DATA --embed Round5/round_5_trader.py keeps
+# these defaults in line with model_constants.py, which is not part of a submission)
+STARFRUIT_COEF = [0.18898843, 0.20770677, 0.26106908, 0.34176867]
+STARFRUIT_INTERCEPT = 2.356494353223752
+ORCHIDS_COEF = [0.03505737066667942, 3.7800693377867836, 7.7039004312429835]
+ORCHIDS_INTERCEPT = 648.6118462473457
+BASKET_PREMIUM = 379.4904833333333
+COCONUT_FAIR_COEF = 1.82459034
+COCONUT_FAIR_INTERCEPT = 8841.201392746636
+COCONUT_RESIDUAL_MEAN = 1.106915685037772e-12
+COCONUT_RESIDUAL_STD = 25.490151318439462
+COUPON_FAIR_COEF = 0.50286009
+COUPON_FAIR_INTERCEPT = -4393.50466244335
+COUPON_RESIDUAL_MEAN = 9.503613303725918e-13
+COUPON_RESIDUAL_STD = 13.381762301052223
+try:
+    import model_constants
+except ImportError:
+    model_constants = None
+# every constant falls back to its default on its own, a module written by a partial calibration only overrides the
+# constants it has
+for _name in ['STARFRUIT_COEF', 'STARFRUIT_INTERCEPT', 'ORCHIDS_COEF', 'ORCHIDS_INTERCEPT', 'BASKET_PREMIUM',
+              'COCONUT_FAIR_COEF', 'COCONUT_FAIR_INTERCEPT', 'COCONUT_RESIDUAL_MEAN', 'COCONUT_RESIDUAL_STD',
+              'COUPON_FAIR_COEF', 'COUPON_FAIR_INTERCEPT', 'COUPON_RESIDUAL_MEAN', 'COUPON_RESIDUAL_STD', 'EWMA_lambda']:
+    globals()[_name] = getattr(model_constants, _name, globals()[_name])
+
+
+class TraderDataCodec:
+    """
+    Fixed-schema codec for the TickHistory built by set_up_cached_trader_data.
+
+    every tick of the history is packed into one struct row following SCHEMA, trades are stored as
+    (price, quantity, buyer, seller, timestamp) with buyer/seller interned into a name table shared by all rows.
+    None is stored as NaN for float fields. history.state (online model states, {name: list of floats}) follows the
+    rows. the payload is base64 so it is a valid traderData string.
+    layout: version (B), number of rows (H), number of names (B), names (B length + utf-8), rows,
+    number of states (B), states (B name length + utf-8 name, H number of values, float64 values).
+    """
+    VERSION = 2
+    # f: float, i: int, b: small int, t: Trade of the slot's product
+    SCHEMA = [('STARFRUIT', 'ffif'),
+              ('ORCHIDS', 'fffffffffffif'),
+              ('COCONUT', 'ffffit'),
+              ('GIFT_BASKET', 't'),
+              ('ROSES', 't'),
+              ('Buy', 'b')]
+    FORMATS = {'f': 'd', 'i': 'i', 'b': 'b', 't': 'diBBi'}
+    HEADER = struct.Struct('<BHB')
+    STATE_HEADER = struct.Struct('<H')
+    ROW = struct.Struct('<' + ''.join(map(FORMATS.get, ''.join(kinds for _, kinds in SCHEMA))))
+    # the same row as a numpy record, so a whole history is packed and unpacked without a python loop per row
+    DTYPE = np.dtype([(f'c{i}', {'d': '<f8', 'i': '<i4', 'B': 'u1', 'b': 'i1'}[code])
+                      for i, code in enumerate(ROW.format[1:])])
+
+    @classmethod
+    def max_encoded_size(cls, num_rows, names=(), state=None):
+        """upper bound of len(encode(history)) for a history of num_rows ticks"""
+        raw = cls.HEADER.size + sum(1 + len(name.encode()) for name in names) + num_rows * cls.ROW.size + 1
+        for name, values in (state or {}).items():
+            raw += 1 + len(name.encode()) + cls.STATE_HEADER.size + 8 * len(values)
+        return 4 * ((raw + 2) // 3)
+
+    @classmethod
+    def encode(cls, history) -> str:
+        rows = history.rows()
+        records = np.empty(len(rows), dtype=cls.DTYPE)
+        for i, name in enumerate(cls.DTYPE.names):
+            records[name] = rows[:, i]
+        header = [cls.HEADER.pack(cls.VERSION, len(rows), len(history.names))]
+        for name in history.names:
+            raw = name.encode()
+            header.append(bytes([len(raw)]) + raw)
+        state = [bytes([len(history.state)])]
+        for name, values in history.state.items():
+            raw = name.encode()
+            state += [bytes([len(raw)]) + raw, cls.STATE_HEADER.pack(len(values)),
+                      np.asarray(values, dtype='<f8').tobytes()]
+        return base64.b64encode(b''.join(header) + records.tobytes() + b''.join(state)).decode()
+
+    @classmethod
+    def decode(cls, text, capacity=None):
+        data = base64.b64decode(text)
+        version, num_rows, num_names = cls.HEADER.unpack_from(data)
+        if version not in (1, cls.VERSION):
+            raise ValueError(f'unknown traderData version {version}')
+        offset = cls.HEADER.size
+        history = TickHistory(capacity or NUM_OF_DATA_POINT)
+        for _ in range(num_names):
+            length = data[offset]
+            history.intern(data[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+        records = np.frombuffer(data, dtype=cls.DTYPE, count=num_rows, offset=offset)
+        rows = np.empty((num_rows, len(cls.DTYPE.names)))
+        for i, name in enumerate(cls.DTYPE.names):
+            rows[:, i] = records[name]
+        history.extend(rows)
+        offset += num_rows * cls.ROW.size
+        if version >= 2:
+            num_states = data[offset]
+            offset += 1
+            for _ in range(num_states):
+                length = data[offset]
+                name = data[offset + 1:offset + 1 + length].decode()
+                offset += 1 + length
+                count, = cls.STATE_HEADER.unpack_from(data, offset)
+                offset += cls.STATE_HEADER.size
+                history.state[name] = np.frombuffer(data, dtype='<f8', count=count, offset=offset).tolist()
+                offset += 8 * count
+        return history
+
+
+class TickHistory:
+    """
+    Fixed-capacity ring buffer of the ticks cached by set_up_cached_trader_data, oldest ticks are dropped.
+
+    every field of TraderDataCodec.SCHEMA is one float64 column, a trade field is split into
+    (price, quantity, buyer, seller, timestamp) columns with buyer/seller interned into self.names.
+    each row is written twice, at slot and slot + capacity, so the last len(self) rows are always one contiguous
+    slice of self.data: append is O(1) and column() returns a view instead of building a list.
+    Examples:
+    history = TickHistory(10)
+    history.append({'STARFRUIT': [...], 'ORCHIDS': [...], ...})
+    history.column('COCONUT', 2)  # implied volatility of every cached tick, newest first
+    history.get('Buy', 0)  # latest value
+    """
+    TRADE_FIELDS = ['price', 'quantity', 'buyer', 'seller', 'timestamp']
+    # product -> [(kind, first column)] for every field of the product
+    LAYOUT = {}
+    WIDTH = 0
+    for _product, _kinds in TraderDataCodec.SCHEMA:
+        LAYOUT[_product] = []
+        for _kind in _kinds:
+            LAYOUT[_product].append((_kind, WIDTH))
+            WIDTH += len(TRADE_FIELDS) if _kind == 't' else 1
+    del _product, _kinds, _kind
+
+    def __init__(self, capacity=NUM_OF_DATA_POINT):
+        self.capacity = capacity
+        self.data = np.full((2 * capacity, self.WIDTH), np.nan)
+        self.count = 0  # number of ticks appended so far
+        self.names = []
+        self.name_index = {}
+        self.state = {}  # {name: list of floats} of the online models carried from tick to tick
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def intern(self, name) -> int:
+        name = name or ''
+        if name not in self.name_index:
+            self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return self.name_index[name]
+
+    def _end(self) -> int:
+        # one past the newest row in the upper copy
+        return (self.count - 1) % self.capacity + self.capacity + 1
+
+    def rows(self) -> np.ndarray:
+        """cached ticks as a (len(self), WIDTH) view, oldest first"""
+        end = self._end()
+        return self.data[end - len(self):end]
+
+    def append(self, tick: dict):
+        """
+        add one tick and drop the oldest one when the history is full.
+        Args:
+            tick: {product: [field values]} following TraderDataCodec.SCHEMA, trade fields hold a Trade
+        """
+        slot = self.count % self.capacity
+        row = self.data[slot]
+        for product, fields in self.LAYOUT.items():
+            for (kind, column), value in zip(fields, tick[product]):
+                if kind == 't':
+                    row[column:column + 5] = (value.price, value.quantity, self.intern(value.buyer),
+                                              self.intern(value.seller), value.timestamp)
+                else:
+                    row[column] = np.nan if value is None else value
+        self.data[slot + self.capacity] = row
+        self.count += 1
+
+    def extend(self, rows):
+        """append already encoded rows (oldest first), only the last capacity rows are kept"""
+        rows = rows[-self.capacity:]
+        slots = (self.count + np.arange(len(rows))) % self.capacity
+        self.data[slots] = self.data[slots + self.capacity] = rows
+        self.count += len(rows)
+
+    def kind(self, product, field) -> str:
+        return self.LAYOUT[product][field][0]
+
+    def _column(self, product, field, trade_field=None) -> int:
+        kind, column = self.LAYOUT[product][field]
+        if kind == 't':
+            if trade_field is None:
+                raise ValueError(f'{product} field {field} is a trade, pick one of {self.TRADE_FIELDS}')
+            column += self.TRADE_FIELDS.index(trade_field)
+        return column
+
+    def column(self, product, field, trade_field=None) -> np.ndarray:
+        """
+        values of one field over the cached ticks, newest first.
+        Args:
+            product: product of TraderDataCodec.SCHEMA
+            field: index of the field, negative indices count from the last field
+            trade_field: for trade fields, one of TRADE_FIELDS (buyer/seller are codes into self.names)
+        Returns:
+            np.ndarray: read-only view of the buffer, valid until the next append
+        """
+        end = self._end()
+        view = self.data[end - len(self):end, self._column(product, field, trade_field)][::-1]
+        view.flags.writeable = False
+        return view
+
+    def get(self, product, field, age=0):
+        """value of one field, age 0 is the newest tick and len(self) - 1 the oldest"""
+        kind, column = self.LAYOUT[product][field]
+        if kind == 't':
+            return self.trade(product, field, age)
+        value = self.data[self._end() - 1 - age, column]
+        if kind == 'f':
+            return None if value != value else float(value)
+        return int(value)
+
+    def set(self, product, field, value):
+        """overwrite one field of the newest tick"""
+        slot = (self.count - 1) % self.capacity
+        column = self._column(product, field)
+        self.data[slot, column] = self.data[slot + self.capacity, column] = np.nan if value is None else value
+
+    def trade(self, product, field=-1, age=0) -> Trade:
+        column = self._column(product, field, 'price')
+        price, quantity, buyer, seller, timestamp = self.data[self._end() - 1 - age, column:column + 5]
+        return Trade(product, float(price), int(quantity), self.names[int(buyer)], self.names[int(seller)],
+                     int(timestamp))
+
+    def trades(self, product, field=-1) -> list:
+        """Trade of every cached tick, newest first"""
+        return [self.trade(product, field, age) for age in range(len(self))]
+
+    def has_trade(self, product, trade, field=-1) -> bool:
+        """whether a trade with the same timestamp, price, quantity, buyer and seller is cached in the field"""
+        buyer, seller = self.name_index.get(trade.buyer, -1), self.name_index.get(trade.seller, -1)
+        if buyer < 0 or seller < 0:
+            return False
+        column = self._column(product, field, 'price')
+        rows = self.rows()[:, column:column + 5]
+        return bool(np.any((rows[:, 0] == trade.price) & (rows[:, 1] == trade.quantity) & (rows[:, 2] == buyer) &
+                           (rows[:, 3] == seller) & (rows[:, 4] == trade.timestamp)))
+
+
+class EstimatedBook:
+    """
+    Order books of one tick as they look after the orders we already planned in this tick.
+
+    the exchange OrderDepth objects are never modified: liquidity we take or post is recorded in a per product
+    overlay {price: volume} on top of them, volume 0 meaning the level is gone. the best price of each side is cached
+    and only recomputed when the best level itself is removed. every change is journaled, so a tentative plan can be
+    undone with rollback(checkpoint()) instead of deep-copying the books.
+    side follows stanford_values_extract: 1 is buy_orders (positive volumes), -1 is sell_orders (negative volumes).
+    Examples:
+    book = EstimatedBook(state.order_depths)
+    mark = book.checkpoint()
+    book.set_level('COCONUT', -1, best_ask, 0)  # we take the whole best ask
+    book.rollback(mark)
+    """
+
+    def __init__(self, order_depths):
+        self.order_depths = order_depths
+        self.overlay = {}  # (product, side) -> {price: volume}
+        self.journal = []  # (product, side, price, previous overlay volume or None)
+        self.best = {}  # (product, side) -> best price, None if the side is empty
+
+    def _base(self, product, side) -> dict:
+        order_depth = self.order_depths[product]
+        return order_depth.buy_orders if side == 1 else order_depth.sell_orders
+
+    def volume(self, product, side, price) -> int:
+        overlay = self.overlay.get((product, side))
+        if overlay is not None and price in overlay:
+            return overlay[price]
+        return self._base(product, side).get(price, 0)
+
+    def set_level(self, product, side, price, volume):
+        """set the volume of one level, 0 removes it"""
+        key = (product, side)
+        overlay = self.overlay.setdefault(key, {})
+        self.journal.append((product, side, price, overlay.get(price)))
+        overlay[price] = volume
+        if key in self.best:
+            best = self.best[key]
+            if volume * side > 0 and (best is None or (price - best) * side > 0):
+                self.best[key] = price
+            elif price == best and volume * side <= 0:
+                del self.best[key]
+
+    def checkpoint(self) -> int:
+        return len(self.journal)
+
+    def rollback(self, checkpoint):
+        """undo every set_level done after checkpoint"""
+        while len(self.journal) > checkpoint:
+            product, side, price, previous = self.journal.pop()
+            overlay = self.overlay[(product, side)]
+            if previous is None:
+                del overlay[price]
+            else:
+                overlay[price] = previous
+            self.best.pop((product, side), None)
+
+    def levels(self, product, side) -> dict:
+        """{price: volume} of one side, best price first, removed levels left out"""
+        levels = dict(self._base(product, side))
+        levels.update(self.overlay.get((product, side), {}))
+        return {price: levels[price] for price in sorted(levels, reverse=side == 1) if levels[price] != 0}
+
+    def bids(self, product) -> dict:
+        return self.levels(product, 1)
+
+    def asks(self, product) -> dict:
+        return self.levels(product, -1)
+
+    def _best(self, product, side):
+        key = (product, side)
+        if key not in self.best:
+            prices = [price for price, volume in self.levels(product, side).items() if volume * side > 0]
+            self.best[key] = prices[0] if prices else None
+        return self.best[key]
+
+    def best_bid_ask(self, product):
+        """same as Trader.get_best_bid_ask: (best bid, volume, best ask, volume), 0 for an empty side"""
+        best_bid, best_ask = self._best(product, 1) or 0, self._best(product, -1) or 0
+        return best_bid, self.volume(product, 1, best_bid), best_ask, self.volume(product, -1, best_ask)
+
+    def worst_bid_ask(self, product):
+        """same as Trader.get_worst_bid_ask: (worst bid, volume, worst ask, volume), 0 for an empty side"""
+        bids = [price for price, volume in self.bids(product).items() if volume > 0]
+        asks = [price for price, volume in self.asks(product).items() if volume < 0]
+        worst_bid, worst_ask = (bids[-1] if bids else 0), (asks[-1] if asks else 0)
+        return worst_bid, self.volume(product, 1, worst_bid), worst_ask, self.volume(product, -1, worst_ask)
+
+
+class RecursiveLeastSquares:
+    """
+    Online least squares y ~ x without intercept, with an optional forgetting factor.
+
+    the estimator keeps the information form (X'X, X'y), so an observation is added (or removed from a sliding window)
+    in O(p^2) and the coefficients are the exact least squares solution of the observations seen so far: with
+    forgetting=1 they match ols(y, X) to numerical precision. with forgetting < 1 an observation of age k has weight
+    forgetting^k.
+    the state is a flat list of floats (see to_list) so it can be kept in TickHistory.state between ticks.
+    Examples:
+    model = RecursiveLeastSquares(1)
+    model.update([iv_newer], iv_older)
+    model.coefficients  # array([0.998...])
+    """
+
+    def __init__(self, p, forgetting=1.0):
+        self.p = p
+        self.forgetting = forgetting
+        self.count = 0
+        self.xtx = np.zeros((p, p))
+        self.xty = np.zeros(p)
+
+    def update(self, x, y):
+        x = np.asarray(x, dtype=float)
+        if self.forgetting != 1.0:
+            self.xtx *= self.forgetting
+            self.xty *= self.forgetting
+        self.xtx += np.outer(x, x)
+        self.xty += x * y
+        self.count += 1
+
+    def remove(self, x, y):
+        """remove an observation added earlier, for sliding windows. only exact with forgetting=1"""
+        x = np.asarray(x, dtype=float)
+        self.xtx -= np.outer(x, x)
+        self.xty -= x * y
+        self.count -= 1
+
+    @property
+    def coefficients(self) -> np.ndarray:
+        """least squares coefficients, raises np.linalg.LinAlgError while X'X is singular"""
+        return np.linalg.solve(self.xtx, self.xty)
+
+    def predict(self, x) -> float:
+        return float(np.dot(self.coefficients, x))
+
+    def to_list(self) -> list:
+        return [self.count] + self.xtx.ravel().tolist() + self.xty.tolist()
+
+    @classmethod
+    def from_list(cls, values, p, forgetting=1.0):
+        model = cls(p, forgetting)
+        if values:
+            model.count = int(values[0])
+            model.xtx = np.array(values[1:1 + p * p]).reshape(p, p)
+            model.xty = np.array(values[1 + p * p:1 + p * p + p])
+        return model
+
+
+class RollingStats:
+    """
+    Mean, variance, z-score and least squares slope of the last window values of a series, in O(1) per value.
+
+    the values of the window are kept in a ring buffer so the oldest one can be evicted when a new one comes in.
+    the mean and the sum of squared deviations are updated with Welford's formulas (added and removed values), and the
+    slope uses the running sum of t * y where t = 0 is the oldest value of the window, shifted down by one at every
+    eviction. slope matches np.polyfit(np.arange(n), values oldest first, 1)[0] and var matches np.var(values, ddof=1).
+    the state is a flat list of floats (see to_list) so it can be kept in TickHistory.state between ticks.
+    Examples:
+    stats = RollingStats(100)
+    stats.add(residual)
+    stats.mean, stats.std, stats.zscore(), stats.slope
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.values = np.full(window, np.nan)
+        self.head = 0  # position of the oldest value in values
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared deviations from the mean
+        self.sty = 0.0  # sum of t * y
+
+    def __len__(self):
+        return self.count
+
+    def add(self, y):
+        """append y, evicting the oldest value if the window is full"""
+        if self.count == self.window:
+            self.evict()
+        n = self.count + 1
+        delta = y - self.mean
+        self.mean += delta / n
+        self.m2 += delta * (y - self.mean)
+        self.sty += self.count * y
+        self.values[(self.head + self.count) % self.window] = y
+        self.count = n
+
+    def evict(self):
+        """remove and return the oldest value"""
+        y = self.values[self.head]
+        self.head = (self.head + 1) % self.window
+        self.count -= 1
+        if self.count == 0:
+            self.mean = self.m2 = self.sty = 0.0
+            return y
+        old_mean = self.mean
+        self.mean -= (y - old_mean) / self.count
+        self.m2 = max(self.m2 - (y - old_mean) * (y - self.mean), 0.0)
+        # the evicted value had t = 0, every remaining value moves down by one
+        self.sty -= self.count * self.mean
+        return y
+
+    @property
+    def last(self):
+        return self.values[(self.head + self.count - 1) % self.window] if self.count else None
+
+    @property
+    def var(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.var)
+
+    def zscore(self, y=None) -> float:
+        """(y - mean) / std, y is the newest value by default. 0 while the std is 0"""
+        y = self.last if y is None else y
+        std = self.std
+        return (y - self.mean) / std if std > 0 else 0.0
+
+    @property
+    def slope(self) -> float:
+        """least squares slope of the window against time, per tick"""
+        n = self.count
+        if n < 2:
+            return 0.0
+        return (self.sty - (n - 1) / 2 * n * self.mean) / (n * (n * n - 1) / 12)
+
+    def to_list(self) -> list:
+        return [self.window, self.head, self.count, self.mean, self.m2, self.sty] + self.values.tolist()
+
+    @classmethod
+    def from_list(cls, values, window):
+        stats = cls(window)
+        # a state saved with another window is dropped
+        if values and int(values[0]) == window:
+            stats.head, stats.count = int(values[1]), int(values[2])
+            stats.mean, stats.m2, stats.sty = values[3:6]
+            stats.values = np.array(values[6:6 + window])
+        return stats
 
 
 class Trader:
     POSITION_LIMIT = {product: limit for product, limit in zip(products, position_limits)}
+    # strategy knobs, class attributes so that sweep.py can override them in a subclass
+    AMETHYSTS_LIMIT_TO_KEEP = 1  # position left unused by the AMETHYSTS liquidity take
+    STARFRUIT_ACCEPTABLE_RANGE = 2  # distance to the predicted price within which STARFRUIT is taken
+    # ORCHIDS exchange arbitrage: position added per tick on top of what the conversions flatten, edge over the
+    # foreign price of the one-sided quotes
+    ORCHIDS_MAX_LIMIT = 5
+    ORCHIDS_PROFIT_MARGIN = 1
+    SPREAD_LIQUIDITY_FRACTION = 0.3  # share of the book volume kevin_spread_trading takes
+    COUPON_FAIR_PRICE_BAND = 0.5  # COCONUT_COUPON mid further than this from its Black-Scholes price is traded
+    # keep the rolling residual statistics read by r4_coconut_signal / r4_coconut_coupon_signal in traderData. run
+    # does not use those signals, turn it on together with them
+    RESIDUAL_SIGNALS = False
+
+    def __init__(self):
+        # implied volatility memo, {(rounded S, rounded option price, K, r, T, option type): sigma}
+        self.iv_memo = {}
 
     @staticmethod
     def decode_trader_data(state):
         if state.timestamp == 0:
-            return []
-        return jsonpickle.decode(state.traderData)
+            return TickHistory(NUM_OF_DATA_POINT)
+        return TraderDataCodec.decode(state.traderData, NUM_OF_DATA_POINT)
 
     @staticmethod
-    def extract_from_cache(traderDataNew, product, position) -> list:
-        """"""
-        return [traderDataNew[i][product][position] for i in range(len(traderDataNew))][::-1]
+    def extract_from_cache(traderDataNew, product, position):
+        """values of one cached field, newest first: a read-only array view, or a list of Trade for trade fields"""
+        if traderDataNew.kind(product, position) == 't':
+            return traderDataNew.trades(product, position)
+        return traderDataNew.column(product, position)
 
     @staticmethod
     def calculate_mid_price(state, product):
@@ -84,7 +601,7 @@ class Trader:
 
     @staticmethod
     def update_estimated_position(estimated_position, product, amount, side):
-        estimated_position = copy.deepcopy(estimated_position)
+        # updated in place, the dict is only ever threaded through the calls of one run
         amount = side * abs(amount)
         estimated_position[product] = estimated_position[product] + amount
         return estimated_position
@@ -129,8 +646,8 @@ class Trader:
         coconut_best_bid, coconut_best_ask = list(state.order_depths['COCONUT'].buy_orders.keys())[0], list(
             state.order_depths['COCONUT'].sell_orders.keys())[0]
         mid_price_coupon = (best_bid + best_ask) / 2
-        intercept = 8841.201392746636
-        coef = 1.82459034
+        intercept = COCONUT_FAIR_INTERCEPT
+        coef = COCONUT_FAIR_COEF
         y_t = intercept + coef * mid_price_coupon
         residual = (coconut_best_ask + coconut_best_bid) / 2 - y_t
         return best_bid, best_ask, residual
@@ -141,8 +658,8 @@ class Trader:
         best_bid = list(order_depth.buy_orders.keys())[0]
         best_ask = list(order_depth.sell_orders.keys())[0]
         mid_price_coconut = (best_bid + best_ask) / 2
-        intercept = -4393.50466244335
-        coef = 0.50286009
+        intercept = COUPON_FAIR_INTERCEPT
+        coef = COUPON_FAIR_COEF
         y_t = intercept + coef * mid_price_coconut
         residual = (coupon_best_ask + coupon_best_bid) / 2 - y_t
         return residual
@@ -156,13 +673,12 @@ class Trader:
 
     def rhianna_trade_record(self, state, product, traderDataOld):
         empty_trade = Trade(product, 0, 0, '', '', 0)
-        stored_trade = self.extract_from_cache(traderDataOld, product, -1)
         mkt_trade = state.market_trades.get(product, [])
         if len(mkt_trade) > 0:
             # we only want rhianna trade that is not in the stored_trade
             mkt_trade = [trade for trade in mkt_trade if
-                         (trade.buyer == 'Rhianna' or trade.seller == 'Rhianna') and not self.assert_trade_equal(trade,
-                                                                                                                 stored_trade) and trade.timestamp in [
+                         (trade.buyer == 'Rhianna' or trade.seller == 'Rhianna') and not traderDataOld.has_trade(product,
+                                                                                                                 trade) and trade.timestamp in [
                              state.timestamp, state.timestamp - 100]]
 
         if len(mkt_trade) == 0:
@@ -202,9 +718,44 @@ class Trader:
     def rhianna_position(self, state, coconut_r_trade, product, traderDataOld):
         if state.timestamp == 0:
             return 0
-        stored_pos = self.extract_from_cache(traderDataOld, product, -2)[0]
+        stored_pos = traderDataOld.get(product, -2)
         return stored_pos + coconut_r_trade.quantity if coconut_r_trade.buyer == 'Rhianna' else stored_pos - coconut_r_trade.quantity
 
+    @staticmethod
+    def update_iv_model(traderDataOld, iv):
+        """
+        update the regression of tongfei_predict_iv with this tick's implied volatility, before it is cached.
+        the model is fitted on every pair of consecutive cached ticks (newer iv as x, older iv as y): the pair made by
+        this tick is added and the pair leaving the cache with its oldest tick is removed.
+        """
+        model = RecursiveLeastSquares.from_list(traderDataOld.state.get('iv_model'), 1)
+        if len(traderDataOld) > 0:
+            previous_iv = traderDataOld.get('COCONUT', 2)
+            if iv is not None and previous_iv is not None:
+                model.update([iv], previous_iv)
+            if len(traderDataOld) == traderDataOld.capacity:
+                leaving_x = traderDataOld.get('COCONUT', 2, age=len(traderDataOld) - 2)
+                leaving_y = traderDataOld.get('COCONUT', 2, age=len(traderDataOld) - 1)
+                if leaving_x is not None and leaving_y is not None:
+                    model.remove([leaving_x], leaving_y)
+        traderDataOld.state['iv_model'] = model.to_list()
+
+    def update_residual_stats(self, state, traderDataOld):
+        """
+        add this tick's residuals of the COCONUT / COCONUT_COUPON regressions to their rolling statistics, which
+        r4_coconut_signal and r4_coconut_coupon_signal read, only called when RESIDUAL_SIGNALS is set. ticks where
+        either book has an empty side are skipped.
+        """
+        if not all(state.order_depths[product].buy_orders and state.order_depths[product].sell_orders
+                   for product in ('COCONUT', 'COCONUT_COUPON')):
+            return
+        coupon_best_bid, coupon_best_ask, coconut_residual = self.r4_current_coconut_fair_price(state)
+        coupon_residual = self.r4_current_coconut_coupon_fair_price(state, coupon_best_bid, coupon_best_ask)
+        for name, residual in (('coconut_residual', coconut_residual), ('coupon_residual', coupon_residual)):
+            stats = RollingStats.from_list(traderDataOld.state.get(name), RESIDUAL_WINDOW)
+            stats.add(residual)
+            traderDataOld.state[name] = stats.to_list()
+
     # we get multiple trade in this time slice. we aggregate multiple trade into one trade with the same timestamp
     def set_up_cached_trader_data(self, state, traderDataOld):
         # for now we just cache the orderDepth.
@@ -221,7 +772,13 @@ class Trader:
             'COCONUT_COUPON', state.order_depths)
         coconut_midprice = (coconut_best_bid + coconut_best_ask) / 2
         coupon_midprice = (coupon_best_bid + coupon_best_ask) / 2
-        coconut_implied_volatility = self.implied_volatility(coconut_midprice, K, r, coupon_midprice, T, 'call')
+        # warm start from the previous tick, the volatility barely moves between ticks
+        previous_iv = traderDataOld.get('COCONUT', 2) if len(traderDataOld) > 0 else None
+        coconut_implied_volatility = self.implied_volatility(coconut_midprice, K, r, coupon_midprice, T, 'call',
+                                                             initial_guess=previous_iv)
+        self.update_iv_model(traderDataOld, coconut_implied_volatility)
+        if self.RESIDUAL_SIGNALS:
+            self.update_residual_stats(state, traderDataOld)
         coconut_delta = self.delta_call(coconut_midprice, K, r, coconut_implied_volatility, T)
         coconut_r_trade = self.rhianna_trade_record(state, 'COCONUT', traderDataOld)
         r_pos = self.rhianna_position(state, coconut_r_trade, 'COCONUT', traderDataOld)
@@ -234,9 +791,9 @@ class Trader:
             buy_rose = self.rose_buy_sell(rose_r_trade)
 
         if len(traderDataOld) > 0:
-            buy_rose = self.extract_from_cache(traderDataOld, 'ROSES', 0)[0]
+            buy_rose = traderDataOld.get('Buy', 0)
         # cache formulation
-        current_cache = [{'STARFRUIT': [star_midprice, star_standford_midprice, star_majority_vol, star_imbalance],
+        current_cache = {'STARFRUIT': [star_midprice, star_standford_midprice, star_majority_vol, star_imbalance],
                           'ORCHIDS': [None, None, None, None, sunlight, humidity, importTariff, exportTariff,
                                       transportFees,
                                       orc_midprice, orc_standford_midprice, orc_majority_vol, orc_imbalance],
@@ -245,14 +802,11 @@ class Trader:
                           'GIFT_BASKET': [gift_r_trade],
                           'ROSES': [rose_r_trade],
                           'Buy': [buy_rose]
-                          }]
+                          }
         # for ORCHIDS, the first four elements are for pure_arb price, conversion_cache, liquidity provide price, liquidity provide amount
         # for COCONUT and COCONUT_COUPON, the last element is for last time slice signal direction.
-        if state.timestamp == 0:
-            return current_cache
-        new_cache = copy.deepcopy(
-            traderDataOld + current_cache)
-        return new_cache[-NUM_OF_DATA_POINT:]  # take how many data, now is latest 100 data points.
+        traderDataOld.append(current_cache)  # the history keeps the latest NUM_OF_DATA_POINT ticks
+        return traderDataOld
 
     def cal_available_position(self, product, state, ordered_position):
         existing_position = state.position[product] if product in state.position.keys() else 0
@@ -268,47 +822,25 @@ class Trader:
 
     def kevin_market_take(self, product, price, amount, available_amount, side, ordered_position, estimated_traded_lob):
         amount = abs(amount)
-        ordered_position = copy.deepcopy(ordered_position)
-        estimated_traded_lob = copy.deepcopy(estimated_traded_lob)
         if available_amount == 0 or amount == 0:
             return [], available_amount, estimated_traded_lob, ordered_position
-        if side == 1:
-            # we buy the product
-            if amount > available_amount:
-                amount = available_amount
-                estimated_traded_lob[product].sell_orders[price] = estimated_traded_lob[product].sell_orders[price] + amount
-            else:
-                # we take the whole best ask
-                estimated_traded_lob[product].sell_orders.pop(price)
-            print("BUY", product, str(amount) + "x", price)
-            ordered_position = self.update_estimated_position(ordered_position, product, amount, side)
-            available_amount -= amount
-            # sort by key from small to large
-            estimated_traded_lob[product].sell_orders = dict(
-                sorted(estimated_traded_lob[product].sell_orders.items(), key=lambda x: x[0]))
-            return [Order(product, price, amount)], available_amount, estimated_traded_lob, ordered_position
+        if amount > available_amount:
+            amount = available_amount
+            # we take part of the level, its volume shrinks towards 0
+            estimated_traded_lob.set_level(product, -side, price,
+                                           estimated_traded_lob.volume(product, -side, price) + side * amount)
         else:
-            # we sell the product
-            if amount > available_amount:
-                amount = available_amount
-                estimated_traded_lob[product].buy_orders[price] = estimated_traded_lob[product].buy_orders[price] - amount
-            else:
-                # we take the whole best bid
-                estimated_traded_lob[product].buy_orders.pop(price)
-            print("SELL", product, str(amount) + "x", price)
-            ordered_position = self.update_estimated_position(ordered_position, product, amount, side)
-            available_amount -= amount
-            # sort by key from large to small
-            estimated_traded_lob[product].buy_orders = dict(
-                sorted(estimated_traded_lob[product].buy_orders.items(), key=lambda x: x[0], reverse=True))
-            estimated_traded_lob[product].sell_orders = dict(
-                sorted(estimated_traded_lob[product].sell_orders.items(), key=lambda x: x[0]))
-            return [Order(product, price, -amount)], available_amount, estimated_traded_lob, ordered_position
+            # we take the whole level
+            estimated_traded_lob.set_level(product, -side, price, 0)
+        print("BUY" if side == 1 else "SELL", product, str(amount) + "x", price)
+        ordered_position = self.update_estimated_position(ordered_position, product, amount, side)
+        available_amount -= amount
+        return [Order(product, price, side * amount)], available_amount, estimated_traded_lob, ordered_position
 
     def kevin_acceptable_price_wtb_liquidity_take(self, acceptable_price, product, state, ordered_position,
                                                   estimated_traded_lob, limit_to_keep: int = 1):
         """ same as BBO function,but this function allows to walk the book to take liquidity"""
-        order_depth: OrderDepth = copy.deepcopy(state.order_depths[product])
+        order_depth: OrderDepth = state.order_depths[product]
         orders: List[Order] = []
         buy_available_position, sell_available_position = self.cal_available_position(product, state, ordered_position)
         buy_available_position -= limit_to_keep
@@ -340,7 +872,7 @@ class Trader:
                                     ):
         orders: List[Order] = []
         buy_available_position, sell_available_position = self.cal_available_position(product, state, ordered_position)
-        best_estimated_bid, _, best_estimated_ask, _ = self.get_best_bid_ask(product, estimated_traded_lob)
+        best_estimated_bid, _, best_estimated_ask, _ = estimated_traded_lob.best_bid_ask(product)
         estimated_spread = best_estimated_ask - best_estimated_bid
         limit_buy, limit_sell = 0, 0
         if estimated_spread > 0:
@@ -358,13 +890,13 @@ class Trader:
             if limit_buy:
                 print("LIMIT BUY", str(buy_available_position) + "x", best_estimated_bid + 1)
                 orders.append(Order(product, best_estimated_bid + 1, buy_available_position))
-                estimated_traded_lob[product].buy_orders[best_estimated_bid + 1] = buy_available_position
+                estimated_traded_lob.set_level(product, 1, best_estimated_bid + 1, buy_available_position)
                 ordered_position = self.update_estimated_position(ordered_position, product, buy_available_position,
                                                                   1)
             if limit_sell:
                 print("LIMIT SELL", str(sell_available_position) + "x", best_estimated_ask - 1)
                 orders.append(Order(product, best_estimated_ask - 1, -sell_available_position))
-                estimated_traded_lob[product].sell_orders[best_estimated_ask - 1] = -sell_available_position
+                estimated_traded_lob.set_level(product, -1, best_estimated_ask - 1, -sell_available_position)
                 ordered_position = self.update_estimated_position(ordered_position, product,
                                                                   -sell_available_position, -1)
         return orders, ordered_position, estimated_traded_lob
@@ -465,13 +997,13 @@ class Trader:
         acceptable_ask = predicted_price + acceptable_range
         acceptable_bid = predicted_price - acceptable_range
         if standford_price:
-            best_bid, _ = self.stanford_values_extract(estimated_traded_lob[product].buy_orders, 1)
-            best_ask, _ = self.stanford_values_extract(estimated_traded_lob[product].sell_orders, -1)
+            best_bid, _ = self.stanford_values_extract(estimated_traded_lob.bids(product), 1)
+            best_ask, _ = self.stanford_values_extract(estimated_traded_lob.asks(product), -1)
         else:
-            best_bid, _, best_ask, _ = self.get_best_bid_ask(product, estimated_traded_lob)
+            best_bid, _, best_ask, _ = estimated_traded_lob.best_bid_ask(product)
         print(
             f'price_hft: best_bid: {best_bid}, best_ask: {best_ask}, acceptable_bid: {acceptable_bid}, acceptable_ask: {acceptable_ask}')
-        for ask, ask_amount in list(estimated_traded_lob[product].sell_orders.items()):
+        for ask, ask_amount in estimated_traded_lob.asks(product).items():
             if ask <= acceptable_bid or (product_position < 0 and ask == acceptable_bid + 1):
                 # we liquidity take the best ask
                 if buy_available_position > 0:
@@ -481,7 +1013,7 @@ class Trader:
                         ordered_position,
                         estimated_traded_lob)
                     orders += order
-        for bid, bid_amount in list(estimated_traded_lob[product].buy_orders.items()):
+        for bid, bid_amount in estimated_traded_lob.bids(product).items():
             if bid >= acceptable_ask or (product_position > 0 and bid == acceptable_ask - 1):
                 # we liquidity take the best bid
                 if sell_available_position > 0:
@@ -522,22 +1054,22 @@ class Trader:
         return orders, ordered_position, estimated_traded_lob
 
     def shaoqin_r1_starfruit_pred(self, traderDataNew) -> int:
-        coef = [0.18898843, 0.20770677, 0.26106908, 0.34176867]
-        intercept = 2.356494353223752
-        X = np.array([traderDataNew[i]['STARFRUIT'][1] for i in range(len(traderDataNew))])[:4][::-1]
+        coef = STARFRUIT_COEF
+        intercept = STARFRUIT_INTERCEPT
+        X = self.extract_from_cache(traderDataNew, 'STARFRUIT', 1)[-4:]  # the 4 oldest ticks, newest first
         return int(round(intercept + np.dot(coef, X)))
 
     def shaoqin_r2_orchids_pred(self, traderDataNew) -> int:
         coef = 1
         intercept = 0
-        return int(round(intercept + coef * traderDataNew[-1]['ORCHIDS'][8]))
+        return int(round(intercept + coef * traderDataNew.get('ORCHIDS', 8)))
 
     def shaoqin_r2_orchids_pred(self, traderDataNew) -> int:
-        coef = [0.03505737066667942, 3.7800693377867836, 7.7039004312429835, ]
-        intercept = 648.6118462473457
-        import_cost = traderDataNew[-1]['ORCHIDS'][6] + traderDataNew[-1]['ORCHIDS'][7] + traderDataNew[-1]['ORCHIDS'][
-            8]
-        X = np.array([traderDataNew[-1]['ORCHIDS'][4], traderDataNew[-1]['ORCHIDS'][5], import_cost])
+        coef = ORCHIDS_COEF
+        intercept = ORCHIDS_INTERCEPT
+        import_cost = traderDataNew.get('ORCHIDS', 6) + traderDataNew.get('ORCHIDS', 7) + traderDataNew.get('ORCHIDS',
+                                                                                                              8)
+        X = np.array([traderDataNew.get('ORCHIDS', 4), traderDataNew.get('ORCHIDS', 5), import_cost])
         return int(round(intercept + np.dot(coef, X)))
 
     @staticmethod
@@ -581,7 +1113,7 @@ class Trader:
         orders: List[Order] = []
         conversion_price_cache = 0
         conversions_cache = 0
-        order_depth: OrderDepth = copy.deepcopy(state.order_depths[product])
+        order_depth: OrderDepth = state.order_depths[product]
         foreign_exchange_ask, foreign_exchange_bid = self.overhead_calculation(state, product)
         print(f"foreign_exchange_ask: {foreign_exchange_ask}, foreign_exchange_bid: {foreign_exchange_bid}")
         buy_available_position, sell_available_position = self.cal_available_position(product, state, ordered_position)
@@ -620,7 +1152,7 @@ class Trader:
                     conversion_price_cache = bid
 
         # One side liquidity provide arb
-        best_bid, best_bid_amount, best_ask, best_ask_amount = self.get_best_bid_ask(product, estimated_traded_lob)
+        best_bid, best_bid_amount, best_ask, best_ask_amount = estimated_traded_lob.best_bid_ask(product)
         liquidity_provide_sell = ((best_ask - 1) >= (foreign_exchange_ask + profit_margin)) and (
                 sell_available_position > 0)
         liquidity_provide_buy = ((best_bid + 1) <= (foreign_exchange_bid - profit_margin)) and (
@@ -634,21 +1166,21 @@ class Trader:
             liquidity_provide_sell_price = int(round(foreign_exchange_ask + profit_margin))
             print(f"LIMIT SELL, {sell_available_position}x, {liquidity_provide_sell_price}")
             orders.append(Order(product, liquidity_provide_sell_price, -sell_available_position))
-            traderDataNew[-1][product][2] = liquidity_provide_sell_price
-            traderDataNew[-1][product][3] = -sell_available_position
+            traderDataNew.set(product, 2, liquidity_provide_sell_price)
+            traderDataNew.set(product, 3, -sell_available_position)
             ordered_position = self.update_estimated_position(ordered_position, product, -sell_available_position, -1)
-            estimated_traded_lob[product].sell_orders[liquidity_provide_sell_price] = -sell_available_position
+            estimated_traded_lob.set_level(product, -1, liquidity_provide_sell_price, -sell_available_position)
         if liquidity_provide_buy:
             liquidity_provide_buy_price = int(round(foreign_exchange_bid - profit_margin))
             print(f"LIMIT BUY, {buy_available_position}x, {liquidity_provide_buy_price}")
             orders.append(Order(product, liquidity_provide_buy_price, buy_available_position))
-            traderDataNew[-1][product][2] = liquidity_provide_buy_price
-            traderDataNew[-1][product][3] = buy_available_position
+            traderDataNew.set(product, 2, liquidity_provide_buy_price)
+            traderDataNew.set(product, 3, buy_available_position)
             ordered_position = self.update_estimated_position(ordered_position, product, buy_available_position, 1)
-            estimated_traded_lob[product].buy_orders[liquidity_provide_buy_price] = buy_available_position
+            estimated_traded_lob.set_level(product, 1, liquidity_provide_buy_price, buy_available_position)
 
-        traderDataNew[-1][product][0] = conversion_price_cache
-        traderDataNew[-1][product][1] = conversions_cache
+        traderDataNew.set(product, 0, conversion_price_cache)
+        traderDataNew.set(product, 1, conversions_cache)
         print(f"cached conversions: {conversions_cache}")
         return conversions, orders, ordered_position, estimated_traded_lob, traderDataNew
 
@@ -656,7 +1188,7 @@ class Trader:
         eligible_product = ['CHOCOLATE', 'STRAWBERRIES', 'ROSES', 'GIFT_BASKET']
         assert product in eligible_product
         mid_price = {prod: self.calculate_mid_price(state, prod) for prod in eligible_product}
-        basket_premium = 379.4904833333333
+        basket_premium = BASKET_PREMIUM
         if product == 'GIFT_BASKET':
             fair_price = np.dot([4, 6, 1], [mid_price[prod] for prod in eligible_product[:-1]]) + basket_premium
         elif product == 'CHOCOLATE':
@@ -675,10 +1207,12 @@ class Trader:
         return fair_price_deviation, fair_price
 
     def kevin_spread_trading(self, product, state, ordered_position, estimated_traded_lob,
-                             trade_direction, trade_coef, liquidity_fraction: float = 0.3,
+                             trade_direction, trade_coef, liquidity_fraction: float = None,
                              anchor_product='GIFT_BASKET'):
+        if liquidity_fraction is None:
+            liquidity_fraction = self.SPREAD_LIQUIDITY_FRACTION
         orders: List[Order] = []
-        worst_bid, worst_bid_amount, worst_ask, worst_ask_amount = self.get_worst_bid_ask(product, estimated_traded_lob)
+        worst_bid, worst_bid_amount, worst_ask, worst_ask_amount = estimated_traded_lob.worst_bid_ask(product)
         buy_available_position, sell_available_position = self.cal_available_position(product, state, ordered_position)
         print('sell_available_position: ' + str(sell_available_position))
         print('buy_available_position: ' + str(buy_available_position))
@@ -693,7 +1227,7 @@ class Trader:
         if action == -1 and sell_available_position > 0:
             # we sell at worst bid, anticipating mean reversion
             # gradually taking position: we take half liquidity of the lob
-            liquidity = int(round(sum(estimated_traded_lob[product].buy_orders.values()) * liquidity_fraction))
+            liquidity = int(round(sum(estimated_traded_lob.bids(product).values()) * liquidity_fraction))
             pos = min(sell_available_position, liquidity)
             order = Order(product, worst_bid, -pos)
             orders.append(order)
@@ -704,7 +1238,7 @@ class Trader:
 
         elif action == 1 and buy_available_position > 0:
             # we buy, anticipating mean reversion
-            liquidity = -int(round(sum(estimated_traded_lob[product].sell_orders.values()) * liquidity_fraction))
+            liquidity = -int(round(sum(estimated_traded_lob.asks(product).values()) * liquidity_fraction))
             pos = min(buy_available_position, liquidity)
 
             order = Order(product, worst_ask, pos)
@@ -713,44 +1247,59 @@ class Trader:
             ordered_position = self.update_estimated_position(ordered_position, product, pos, 1)
         return orders, ordered_position, estimated_traded_lob
 
+    @staticmethod
+    def residual_stats(traderDataNew, name, mean_residual, std_residual):
+        """
+        rolling statistics of a residual series and the mean and std its signal compares against: the rolling ones
+        once the window has RESIDUAL_MIN_COUNT ticks, the offline fitted ones before that
+        """
+        stats = RollingStats.from_list(traderDataNew.state.get(name), RESIDUAL_WINDOW)
+        if len(stats) >= RESIDUAL_MIN_COUNT and stats.std > 0:
+            mean_residual, std_residual = stats.mean, stats.std
+        return stats, mean_residual, std_residual
+
     def r4_coconut_signal(self, traderDataNew, k=1, momentum_threshold=0.5):
-        residual = self.extract_from_cache(traderDataNew, 'COCONUT', 2)
-        residual_momentum = -np.polyfit(np.arange(len(residual)), residual, 1)[0]
-        std_residual = 25.490151318439462
-        mean_residual = 1.106915685037772e-12
-        threshold = mean_residual + k * std_residual
-        print(f"coconut residual: {residual[0]}, threshold: {threshold}")
+        stats, mean_residual, std_residual = self.residual_stats(traderDataNew, 'coconut_residual',
+                                                                 COCONUT_RESIDUAL_MEAN, COCONUT_RESIDUAL_STD)
+        if len(stats) == 0:
+            return 0, 1
+        residual = stats.last - mean_residual
+        residual_momentum = stats.slope
+        threshold = k * std_residual
+        print(f"coconut residual: {residual}, threshold: {threshold}")
         print(f'coconut residual momentum: {residual_momentum}')
-        # if residual[0] > threshold:
+        # if residual > threshold:
         #     if residual_momentum < momentum_threshold:
         #         return -1
         #     else:
         #         return 0
-        # elif residual[0] < -threshold:
+        # elif residual < -threshold:
         #     if residual_momentum > -momentum_threshold:
         #         return 1
         #     else:
         #         return 0
         # else:
         #     return 0
-        if residual[0] > threshold:
+        if residual > threshold:
             return -1, 1 + residual_momentum
-        elif residual[0] < -threshold:
+        elif residual < -threshold:
             return 1, 1 - residual_momentum
         else:
             return 0, 1
 
     def r4_coconut_coupon_signal(self, traderDataNew, k=1, ):
-        residual = self.extract_from_cache(traderDataNew, 'COCONUT_COUPON', 0)
-        residual_momentum = -np.polyfit(np.arange(len(residual)), residual, 1)[0]
-        mean_residual = 9.503613303725918e-13
-        std_residual = 13.381762301052223
-        threshold = mean_residual + k * std_residual
-        print(f"coconut coupon residual: {residual[0]}, threshold: {threshold}")
+        stats, mean_residual, std_residual = self.residual_stats(traderDataNew, 'coupon_residual',
+                                                                 COUPON_RESIDUAL_MEAN, COUPON_RESIDUAL_STD)
+        if len(stats) == 0:
+            return 0, 1
+        residual = stats.last - mean_residual
+        residual_momentum = stats.slope
+        threshold = k * std_residual
+        print(f"coconut coupon residual: {residual}, threshold: {threshold}")
         print(f'coconut coupon residual momentum: {residual_momentum}')
-        if residual[0] > threshold:
+        if residual > threshold:
             return -1, 1 + residual_momentum
-        elif residual[0] < -threshold:
+        elif residual < -threshold:
             return 1, 1 - residual_momentum
         else:
             return 0, 1
@@ -787,15 +1336,45 @@ class Trader:
         elif option_type == 'put':
             return K * np.exp(-r * T) * self.norm_cdf(-d2) - S * self.norm_cdf(-d1)
 
-    def implied_volatility(self, S, K, r, price, T, option_type):
-        sigma = INITIAL_GUESS_VOL  # this initial guess matters, large would lead to divergence
+    def implied_volatility(self, S, K, r, price, T, option_type, initial_guess=None):
+        """
+        safeguarded Newton-Raphson: the option price is increasing in sigma, so every step keeps a bracket
+        [low, high] around the solution and a Newton step that would leave it is replaced by bisection.
+        Args:
+            S: underlying price
+            K, r, T: strike, rate and time to expiry
+            price: option price
+            option_type: 'call' or 'put'
+            initial_guess: starting sigma, usually the previous tick's volatility. INITIAL_GUESS_VOL by default
+        Returns:
+            float: sigma with |model price - price| < PRECISION, None if no sigma in IV_BRACKET gives the price
+        """
+        key = (round(S, IV_MEMO_DECIMALS), round(price, IV_MEMO_DECIMALS), K, r, T, option_type)
+        if key in self.iv_memo:
+            return self.iv_memo[key]
+
+        low, high = IV_BRACKET
+        sigma = initial_guess if initial_guess is not None and low < initial_guess < high else INITIAL_GUESS_VOL
+        result = None
         for i in range(MAX_ITERATIONS):
-            price_est = self.Black_Scholes(S, K, r, sigma, T, option_type)
-            vega_est = self.vega(S, K, r, sigma, T)
-            diff = price_est - price
+            diff = self.Black_Scholes(S, K, r, sigma, T, option_type) - price
             if abs(diff) < PRECISION:
-                return sigma
-            sigma = sigma - diff / vega_est  # Newton-Raphson method
+                result = sigma
+                break
+            if diff > 0:
+                high = sigma
+            else:
+                low = sigma
+            sigma = sigma - diff / self.vega(S, K, r, sigma, T)  # Newton-Raphson method
+            if not low < sigma < high:
+                sigma = (low + high) / 2
+            if high - low < 1e-15:
+                # the bracket collapsed on one of its ends, the price is out of the no-arbitrage bounds
+                break
+        if len(self.iv_memo) >= IV_MEMO_SIZE:
+            self.iv_memo.clear()
+        self.iv_memo[key] = result
+        return result
 
     def ols(self, y, x, intercept=False):
         """
@@ -880,11 +1459,12 @@ class Trader:
             print("Matrix is singular and cannot be inverted.")
             pass
 
-    def tongfei_predict_iv(self, ivs):
-
-        x = [0] + ivs[:-1]
-        ols_result = self.ols(ivs, x)
-        coef_fitted = ols_result.get('coefficients', 1)
+    def tongfei_predict_iv(self, ivs, iv_model: RecursiveLeastSquares):
+        # iv_model is the ols of ivs on np.concatenate(([0], ivs[:-1])), updated online by update_iv_model
+        try:
+            coef_fitted = iv_model.coefficients
+        except np.linalg.LinAlgError:
+            coef_fitted = [1]
         return coef_fitted[0] * ivs[0]
         # coef_fitted = [0.9969]
         # return np.dot(coef_fitted, ivs[0])
@@ -899,15 +1479,15 @@ class Trader:
     def tongfei_calculate_fair_price(self, product, state, ordered_position, estimated_traded_lob, latest_coconut_price,
                                      predicted_iv):
         # make latest coconut price a default value incase coconut coupon shows before coconut in the order book
-        best_bid, best_bid_amount, best_ask, best_ask_amount = self.get_best_bid_ask(product, estimated_traded_lob)
+        best_bid, best_bid_amount, best_ask, best_ask_amount = estimated_traded_lob.best_bid_ask(product)
         mid_price = (best_bid + best_ask) / 2
         fair_price = self.Black_Scholes(latest_coconut_price, K, r, predicted_iv, T, 'call')
         print(f"fair_price: {fair_price}, mid_price: {mid_price}")
         # one standard deviation
-        if mid_price > fair_price + 0.5:
+        if mid_price > fair_price + self.COUPON_FAIR_PRICE_BAND:
             # the price is considered overvalued
             return -1
-        elif mid_price < fair_price - 0.5:
+        elif mid_price < fair_price - self.COUPON_FAIR_PRICE_BAND:
             # the price is considered undervalued
             return 1
         else:
@@ -915,8 +1495,6 @@ class Trader:
 
     def tongfei_BS_trade(self, product_list, state, ordered_position, estimated_traded_lob, trade_coef, previous_delta,
                          predicted_iv, current_iv):
-        ordered_position = copy.deepcopy(ordered_position)
-        estimated_traded_lob = copy.deepcopy(estimated_traded_lob)
         orders_coupon: List[Order] = []
         orders_coconut: List[Order] = []
         buy_available_position_coconut, sell_available_position_coconut = self.cal_available_position(product_list[0],
@@ -925,11 +1503,11 @@ class Trader:
         buy_available_position_coupon, sell_available_position_coupon = self.cal_available_position(product_list[1],
                                                                                                     state,
                                                                                                     ordered_position)
-        best_bid_coconut, best_bid_coconut_amount, best_ask_coconut, best_ask_coconut_amount = self.get_best_bid_ask(
-            product_list[0], estimated_traded_lob)
+        best_bid_coconut, best_bid_coconut_amount, best_ask_coconut, best_ask_coconut_amount = \
+            estimated_traded_lob.best_bid_ask(product_list[0])
         mid_price_coconut = (best_bid_coconut + best_ask_coconut) / 2
-        best_bid_coupon, best_bid_coupon_amount, best_ask_coupon, best_ask_coupon_amount = self.get_best_bid_ask(
-            product_list[1], estimated_traded_lob)
+        best_bid_coupon, best_bid_coupon_amount, best_ask_coupon, best_ask_coupon_amount = \
+            estimated_traded_lob.best_bid_ask(product_list[1])
         print(f"predicted_iv is: {predicted_iv}, real vol is: {current_iv}")
         delta = self.delta_call(mid_price_coconut, K, r, current_iv, T)
         if trade_coef == 1:
@@ -1057,30 +1635,19 @@ class Trader:
         return orders_coupon, orders_coconut, ordered_position, estimated_traded_lob
 
     def r_vwap_adaptor(self, traderDataNew, product):
-        trades = self.extract_from_cache(traderDataNew, product, -1)
-        pos = self.extract_from_cache(traderDataNew, product, -2)
-        r_price, r_vol = [trade.price for trade in trades], [
-            trade.quantity if trade.buyer == 'Rhianna' else -trade.quantity for trade in trades]
-        print(f"r_price: {r_price}, r_vol: {r_vol}")
-        direction = np.sign(sum(r_vol))
-        price_list = []
-        vol_list = []
-        if direction == 1:
-            for price, vol in zip(r_price, r_vol):
-                if vol > 0:
-                    price_list.append(price)
-                    vol_list.append(vol)
-            r_vwap = np.dot(price_list, vol_list) / sum(vol_list)
-        elif direction == -1:
-            for price, vol in zip(r_price, r_vol):
-                if vol < 0:
-                    price_list.append(price)
-                    vol_list.append(vol)
-            r_vwap = np.dot(price_list, vol_list) / sum(vol_list)
+        r_price = traderDataNew.column(product, -1, 'price')
+        quantity = traderDataNew.column(product, -1, 'quantity')
+        r_vol = np.where(traderDataNew.column(product, -1, 'buyer') == traderDataNew.name_index.get('Rhianna', -1),
+                         quantity, -quantity)
+        print(f"r_price: {r_price.tolist()}, r_vol: {r_vol.tolist()}")
+        direction = np.sign(r_vol.sum())
+        if direction != 0:
+            # only the trades on rhianna's side of the net flow
+            side = r_vol * direction > 0
+            r_vwap = np.dot(r_price[side], r_vol[side]) / r_vol[side].sum()
         else:
-            # direction == 0
             r_vwap = 0
-        return direction, r_vwap, pos[0]
+        return direction, r_vwap, traderDataNew.get(product, -2)
 
     def r_latest_adaptor(self, traderDataNew, product):
         trades = self.extract_from_cache(traderDataNew, product, -1)
@@ -1113,7 +1680,7 @@ class Trader:
         print(f"buy_available_position_coconut: {buy_available_position_coconut}, sell_available_position_coconut: {sell_available_position_coconut}")
         if direction == 1:
             # we follow rhianna to buy, but we only take the best ask if the best ask is less than or equal to the vwap
-            for ask, ask_amount in list(estimated_traded_lob[product].sell_orders.items()):
+            for ask, ask_amount in estimated_traded_lob.asks(product).items():
                 if ask <= price and buy_available_position_coconut > 0:
                     # we market take the best ask
                     order, buy_available_position_coconut, estimated_traded_lob, ordered_position = self.kevin_market_take(
@@ -1126,7 +1693,7 @@ class Trader:
                     orders += order
         elif direction == -1:
             # we follow rhianna to sell, but we only sell the best bid if the best bid is greater than or equal to the vwap
-            for bid, bid_amount in list(estimated_traded_lob[product].buy_orders.items()):
+            for bid, bid_amount in estimated_traded_lob.bids(product).items():
                 if bid >= price and sell_available_position_coconut > 0:
                     order, sell_available_position_coconut, estimated_traded_lob, ordered_position = self.kevin_market_take(
                         product,
@@ -1139,7 +1706,7 @@ class Trader:
         return orders, ordered_position, estimated_traded_lob
 
     def rihana_order_follower(self, state, product, traderDataNew):
-        product_data_rihana = traderDataNew[0][product][0]
+        product_data_rihana = traderDataNew.trade(product, 0, age=len(traderDataNew) - 1)
         orders: List[Order] = []
 
         buyer = product_data_rihana.buyer
@@ -1167,7 +1734,7 @@ class Trader:
         return orders
 
     def rose_trader(self, state, traderDataNew):
-        buy = self.extract_from_cache(traderDataNew, 'Buy', 0)[0]
+        buy = traderDataNew.get('Buy', 0)
         orders: List[Order] = []
 
         buy_price, buy_amount, sell_price, sell_amount = self.get_best_bid_ask('ROSES', state.order_depths)
@@ -1194,16 +1761,17 @@ class Trader:
         traderDataNew = self.set_up_cached_trader_data(state, traderDataOld)
         print(f"position now:{state.position}")
         ordered_position = {product: 0 for product in products}
-        estimated_traded_lob = copy.deepcopy(state.order_depths)
+        estimated_traded_lob = EstimatedBook(state.order_depths)
         print(
-            f'COCONUT LOB buy:{estimated_traded_lob["COCONUT"].buy_orders} sell:{estimated_traded_lob["COCONUT"].sell_orders}')
+            f'COCONUT LOB buy:{state.order_depths["COCONUT"].buy_orders} sell:{state.order_depths["COCONUT"].sell_orders}')
 
         # Orders to be placed on exchange matching engine
         result = {}
         for product in state.order_depths.keys():
             if product == 'AMETHYSTS':
                 liquidity_take_order, ordered_position, estimated_traded_lob = self.kevin_acceptable_price_wtb_liquidity_take(
-                    10_000, product, state, ordered_position, estimated_traded_lob, limit_to_keep=1)
+                    10_000, product, state, ordered_position, estimated_traded_lob,
+                    limit_to_keep=self.AMETHYSTS_LIMIT_TO_KEEP)
                 # result[product] = liquidity_take_order
                 mm_order, ordered_position, estimated_traded_lob = self.kevin_residual_market_maker(10_000, product,
                                                                                                     state,
@@ -1220,11 +1788,9 @@ class Trader:
                     # cover_orders, ordered_position, estimated_traded_lob = self.kevin_cover_position(product, state,
                     #                                                                                  ordered_position,
                     #                                                                                  estimated_traded_lob)
-                    hft_orders, ordered_position, estimated_traded_lob = self.kevin_price_hft(predicted_price,
-                                                                                              product, state,
-                                                                                              ordered_position,
-                                                                                              estimated_traded_lob,
-                                                                                              acceptable_range=2)
+                    hft_orders, ordered_position, estimated_traded_lob = self.kevin_price_hft(
+                        predicted_price, product, state, ordered_position, estimated_traded_lob,
+                        acceptable_range=self.STARFRUIT_ACCEPTABLE_RANGE)
                     result[product] = hft_orders
             if product == 'ORCHIDS':
                 conversions, arb_orders, ordered_position, estimated_traded_lob, traderDataNew = self.kevin_exchange_arb(
@@ -1232,8 +1798,8 @@ class Trader:
                     ordered_position,
                     estimated_traded_lob,
                     traderDataNew,
-                    max_limit=5,
-                    profit_margin=1
+                    max_limit=self.ORCHIDS_MAX_LIMIT,
+                    profit_margin=self.ORCHIDS_PROFIT_MARGIN
                 )
 
                 result[product] = arb_orders
@@ -1300,7 +1866,7 @@ class Trader:
                                                  1)  # 0 is the current value, 1 is the previous value
                 ivs = self.extract_from_cache(traderDataNew, 'COCONUT', 2)
                 coconut_mid_prices = self.extract_from_cache(traderDataNew, 'COCONUT', 0)
-                if len(deltas) < 9:
+                if len(deltas) < NUM_OF_DATA_POINT - 1:
                     previous_delta = deltas[0]
                     predicted_iv = ivs[0]
                 else:
@@ -1309,7 +1875,8 @@ class Trader:
                                            state.position.get("COCONUT", 0)
                     print(f"The current position delta is {current_hedged_delta}")
                     previous_delta = deltas[1]
-                    predicted_iv = self.tongfei_predict_iv(ivs)
+                    predicted_iv = self.tongfei_predict_iv(
+                        ivs, RecursiveLeastSquares.from_list(traderDataNew.state['iv_model'], 1))
                 trade_coef = self.tongfei_calculate_fair_price(product, state, ordered_position, estimated_traded_lob,
                                                                coconut_mid_prices[0],
                                                                predicted_iv=predicted_iv)  # 1,-1,0 on coupon
@@ -1345,4 +1912,5 @@ class Trader:
                     else:
                         result[product_list[0]] += orders_r_coconut
         # conversions = 0
-        return result, conversions, jsonpickle.encode(traderDataNew)
+        trader_data = TraderDataCodec.encode(traderDataNew)
+        return result, conversions, trader_data
@@ -0,0 +1,459 @@
+import argparse
+import contextlib
+import importlib.util
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_store import OBSERVATION_FIELDS, PRICE_LEVELS, MarketDataStore, read_prices
+from datamodel import ConversionObservation, Observation, OrderDepth, Trade, TradingState
+from fill_model import PassiveFillModel
+from order_book import SortedOrderDepth
+from profiler import Profiler
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+POSITION_LIMITS = {'AMETHYSTS': 20, 'STARFRUIT': 20, 'ORCHIDS': 100, 'CHOCOLATE': 250, 'STRAWBERRIES': 350,
+                   'ROSES': 60, 'GIFT_BASKET': 60, 'COCONUT': 300, 'COCONUT_COUPON': 600}
+
+SUBMISSION = 'SUBMISSION'
+
+# seashells per unit of long position and per tick
+STORAGE_COSTS = {'ORCHIDS': 0.1}
+
+
+def load_trader(path):
+    """import a trader file (e.g. Round5/round_5_trader.py) and return its Trader class"""
+    if ROOT not in sys.path:
+        # traders import datamodel from the repo root
+        sys.path.insert(0, ROOT)
+    name = 'trader_' + re.sub(r'\W', '_', os.path.splitext(os.path.relpath(path, ROOT))[0])
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module.Trader
+
+
+class BacktestResult:
+
+    def __init__(self, products, days, timestamps, pnl, positions, own_trades, rejected, elapsed, conversions=None):
+        self.products = products
+        self.days = days  # day of every tick
+        self.timestamps = timestamps  # timestamp of every tick
+        self.pnl = pnl  # marked to market pnl, one row per tick and one column per product
+        self.positions = positions  # positions at the end of every tick, same layout as pnl
+        self.own_trades = own_trades
+        self.rejected = rejected  # number of order batches rejected for breaching the position limit
+        self.elapsed = elapsed
+        self.conversions = conversions or []  # [(day, timestamp, product, quantity, price)] of the applied conversions
+
+    @property
+    def ticks(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def ticks_per_second(self) -> float:
+        return self.ticks / self.elapsed if self.elapsed > 0 else float('inf')
+
+    def final_pnl(self) -> dict:
+        """pnl at the end of every day, {day: {product: pnl}}"""
+        res = {}
+        for day in np.unique(self.days):
+            last = np.flatnonzero(self.days == day)[-1]
+            res[int(day)] = dict(zip(self.products, self.pnl[last].tolist()))
+        return res
+
+    @property
+    def total_pnl(self) -> float:
+        return sum(sum(day_pnl.values()) for day_pnl in self.final_pnl().values())
+
+    def summary(self) -> str:
+        lines = []
+        for day, day_pnl in self.final_pnl().items():
+            lines.append(f'day {day}:')
+            for product, pnl in day_pnl.items():
+                lines.append(f'  {product}: {pnl:,.1f}')
+            lines.append(f'  total: {sum(day_pnl.values()):,.1f}')
+        lines.append(f'total pnl: {self.total_pnl:,.1f}')
+        lines.append(f'{self.ticks} ticks in {self.elapsed:.2f}s ({self.ticks_per_second:,.0f} ticks/s), '
+                     f'{self.rejected} order batches rejected')
+        if self.conversions:
+            lines.append(f'{len(self.conversions)} conversions, '
+                         f'{sum(abs(quantity) for *_, quantity, _ in self.conversions)} units')
+        return '\n'.join(lines)
+
+
+class Backtester:
+    """
+    Replay recorded price/trade csv data through a Trader.run, one TradingState per timestamp.
+
+    Every day is an independent session: a fresh Trader, empty traderData and flat positions. Orders are matched
+    against the book of the tick they were sent on, at the book price, and all orders of a product are rejected
+    when they could breach the position limit (same rule as the exchange). Unfilled quantity is cancelled, or with a
+    fill_model (see fill_model.PassiveFillModel) it rests and is matched against the market trades of the tick first.
+    Market trades of a tick and our own fills are delivered in the next TradingState.
+    Conversion requests are applied before the orders of the tick against its ConversionObservation, and long
+    positions pay STORAGE_COSTS at the end of every tick.
+    The trader gets plain datamodel.OrderDepth books with the levels best first, as the exchange sends them, or
+    order_book.SortedOrderDepth books with sorted_books.
+    """
+
+    def __init__(self, trader_cls, prices: pd.DataFrame, trades: pd.DataFrame = None,
+                 observations: pd.DataFrame = None, position_limits: dict = None, fill_model=None,
+                 sorted_books: bool = False):
+        self.trader_cls = trader_cls
+        self.position_limits = dict(POSITION_LIMITS)
+        self.position_limits.update(getattr(trader_cls, 'POSITION_LIMIT', {}))
+        if position_limits:
+            self.position_limits.update(position_limits)
+        self.products = sorted(prices['product'].unique().tolist())
+        self.days = self._build_ticks(prices)
+        self.market_trades = self._build_market_trades(trades) if trades is not None else {}
+        self.fill_model = fill_model
+        self.sorted_books = sorted_books
+        self.trade_arrays = self._build_trade_arrays(trades) if fill_model is not None and trades is not None else {}
+        self.observations = self._build_observations(observations) if observations is not None else {}
+
+    @classmethod
+    def from_directory(cls, trader_cls, data_dir, days=None, round=None, **kwargs):
+        """build a backtester from a round data directory, read through the data_store columnar cache"""
+        store = MarketDataStore(data_dir, round)
+        prices, trades, observations = [table.to_frame() if len(table) else None
+                                        for table in (store.prices(), store.trades(), store.observations())]
+        if prices is None:
+            raise FileNotFoundError(f'no prices_round_*_day_*.csv found in {data_dir}')
+        if days is not None:
+            prices, trades, observations = [df[df['day'].isin(days)] if df is not None else None
+                                            for df in (prices, trades, observations)]
+        return cls(trader_cls, prices, trades, observations, **kwargs)
+
+    @classmethod
+    def from_shared(cls, trader_cls, shared, days=None, **kwargs):
+        """build a backtester from a shared_market_data.SharedMarketData, e.g. in a worker that attached to it"""
+        prices, trades, observations = [shared.frame(kind) for kind in ('prices', 'trades', 'observations')]
+        if days is not None:
+            prices, trades, observations = [df[df['day'].isin(days)] if df is not None else None
+                                            for df in (prices, trades, observations)]
+        return cls(trader_cls, prices, trades, observations, **kwargs)
+
+    def _build_ticks(self, prices):
+        """convert the price rows into [(day, [(timestamp, {product: (bids, asks, mid)})])] once"""
+        n = len(prices)
+        levels = range(1, PRICE_LEVELS + 1)
+
+        def matrix(col):
+            cols = [f'{col}_{i}' for i in levels if f'{col}_{i}' in prices.columns]
+            return prices[cols].to_numpy(dtype=float)
+
+        bid_price, bid_volume = matrix('bid_price'), matrix('bid_volume')
+        ask_price, ask_volume = matrix('ask_price'), matrix('ask_volume')
+        bid_valid = ~np.isnan(bid_price) & ~np.isnan(bid_volume)
+        ask_valid = ~np.isnan(ask_price) & ~np.isnan(ask_volume)
+        bid_price, bid_volume = np.nan_to_num(bid_price).astype(int), np.nan_to_num(bid_volume).astype(int)
+        ask_price, ask_volume = np.nan_to_num(ask_price).astype(int), np.nan_to_num(ask_volume).astype(int)
+        if 'mid_price' in prices.columns:
+            mid = prices['mid_price'].to_numpy(dtype=float)
+        else:
+            mid = np.full(n, np.nan)
+        rows = zip(prices['day'].tolist(), prices['timestamp'].tolist(), prices['product'].tolist(),
+                   bid_price.tolist(), bid_volume.tolist(), bid_valid.tolist(),
+                   ask_price.tolist(), ask_volume.tolist(), ask_valid.tolist(), mid.tolist())
+
+        days = []
+        ticks, books = None, None
+        last_day, last_timestamp = None, None
+        for day, timestamp, product, bp, bv, bok, ap, av, aok, mid_price in rows:
+            if day != last_day:
+                ticks = []
+                days.append((day, ticks))
+                last_day, last_timestamp = day, None
+            if timestamp != last_timestamp:
+                books = {}
+                ticks.append((timestamp, books))
+                last_timestamp = timestamp
+            # bids best first with positive volume, asks best first with negative volume as in OrderDepth
+            bids = tuple(sorted(((p, v) for p, v, ok in zip(bp, bv, bok) if ok), reverse=True))
+            asks = tuple(sorted((p, -v) for p, v, ok in zip(ap, av, aok) if ok))
+            books[product] = (bids, asks, mid_price)
+        return days
+
+    @staticmethod
+    def _build_market_trades(trades):
+        """{(day, timestamp): {symbol: [Trade]}}"""
+        res = {}
+        rows = zip(trades['day'].tolist(), trades['timestamp'].tolist(), trades['symbol'].tolist(),
+                   trades['price'].tolist(), trades['quantity'].tolist(), trades['buyer'].tolist(),
+                   trades['seller'].tolist())
+        for day, timestamp, symbol, price, quantity, buyer, seller in rows:
+            tick = res.setdefault((day, timestamp), {})
+            tick.setdefault(symbol, []).append(Trade(symbol, price, quantity, buyer, seller, timestamp))
+        return res
+
+    def _build_trade_arrays(self, trades):
+        """{(day, timestamp): (product index, price, quantity)} arrays of the market trades, for the fill model"""
+        product_index = {product: i for i, product in enumerate(self.products)}
+        trades = trades[trades['symbol'].isin(product_index)].sort_values(['day', 'timestamp'], kind='stable')
+        day, timestamp = trades['day'].to_numpy(), trades['timestamp'].to_numpy()
+        group = trades['symbol'].map(product_index).to_numpy(dtype=np.int64)
+        price, quantity = trades['price'].to_numpy(dtype=float), trades['quantity'].to_numpy(dtype=np.int64)
+        bounds = np.flatnonzero((day[1:] != day[:-1]) | (timestamp[1:] != timestamp[:-1])) + 1
+        starts, ends = np.r_[0, bounds], np.r_[bounds, len(day)]
+        return {(int(day[a]), int(timestamp[a])): (group[a:b], price[a:b], quantity[a:b])
+                for a, b in zip(starts.tolist(), ends.tolist())}
+
+    @staticmethod
+    def _build_observations(observations):
+        """{(day, timestamp): Observation} for ORCHIDS, the only product with conversion observations"""
+        res = {}
+        fields = [field for field in OBSERVATION_FIELDS if field in observations.columns]
+        values = observations[fields].to_numpy(dtype=float).tolist()
+        for day, timestamp, row in zip(observations['day'].tolist(), observations['timestamp'].tolist(), values):
+            observation = dict(zip(fields, row))
+            res[(day, timestamp)] = Observation({}, {'ORCHIDS': ConversionObservation(
+                *[observation.get(field, 0.0) for field in OBSERVATION_FIELDS])})
+        return res
+
+    @staticmethod
+    def convert(conversions, observation, position, cash):
+        """
+        apply a conversion request like the exchange: it can only reduce the position of a product with a
+        ConversionObservation, anything else is ignored.
+        Args:
+            conversions: units to buy (positive, covers a short) or sell (negative, covers a long) on the foreign
+                exchange
+            observation: Observation of the tick
+            position: position dict, updated in place
+            cash: cash dict, updated in place
+        Returns:
+            tuple: (product, quantity, price per unit) of the conversion, None if nothing was converted
+        """
+        if not conversions or not observation.conversionObservations:
+            return None
+        product, foreign = next(iter(observation.conversionObservations.items()))
+        current = position.get(product, 0)
+        if conversions * current >= 0 or abs(conversions) > abs(current):
+            return None
+        if conversions > 0:
+            # we buy abroad and pay the transport and the import tariff on top of the ask
+            price = foreign.askPrice + foreign.transportFees + foreign.importTariff
+        else:
+            price = foreign.bidPrice - foreign.transportFees - foreign.exportTariff
+        position[product] = current + conversions
+        cash[product] = cash.get(product, 0) - conversions * price
+        return product, conversions, price
+
+    def match_orders(self, product, orders, book, position, cash, timestamp, resting: list = None):
+        """
+        match one product's orders against the book of this tick.
+        Args:
+            product: symbol of the orders
+            orders: list of Order returned by the trader for this product
+            book: (bids, asks, mid) of the product at this tick
+            position: position dict, updated in place
+            cash: cash dict, updated in place
+            timestamp: timestamp of the tick
+            resting: if given, the unfilled part of every order is appended as (product, side, price, quantity,
+                displayed volume at that price), see fill_resting
+        Returns:
+            list: our trades, or None if the orders were rejected for breaching the position limit
+        """
+        current = position.get(product, 0)
+        limit = self.position_limits.get(product)
+        total_buy = sum(order.quantity for order in orders if order.quantity > 0)
+        total_sell = -sum(order.quantity for order in orders if order.quantity < 0)
+        if limit is not None and (current + total_buy > limit or current - total_sell < -limit):
+            return None
+
+        bids = [[price, volume] for price, volume in book[0]]
+        asks = [[price, -volume] for price, volume in book[1]]
+        trades = []
+        for order in orders:
+            quantity = order.quantity
+            if quantity > 0:
+                for level in asks:
+                    if quantity == 0 or level[0] > order.price:
+                        break
+                    traded = min(quantity, level[1])
+                    if traded == 0:
+                        continue
+                    level[1] -= traded
+                    quantity -= traded
+                    current += traded
+                    cash[product] = cash.get(product, 0) - traded * level[0]
+                    trades.append(Trade(product, level[0], traded, SUBMISSION, '', timestamp))
+                if resting is not None and quantity > 0:
+                    displayed = next((volume for price, volume in book[0] if price == order.price), 0)
+                    resting.append((product, 1, order.price, quantity, displayed))
+            elif quantity < 0:
+                quantity = -quantity
+                for level in bids:
+                    if quantity == 0 or level[0] < order.price:
+                        break
+                    traded = min(quantity, level[1])
+                    if traded == 0:
+                        continue
+                    level[1] -= traded
+                    quantity -= traded
+                    current -= traded
+                    cash[product] = cash.get(product, 0) + traded * level[0]
+                    trades.append(Trade(product, level[0], traded, '', SUBMISSION, timestamp))
+                if resting is not None and quantity > 0:
+                    displayed = -next((volume for price, volume in book[1] if price == order.price), 0)
+                    resting.append((product, -1, order.price, quantity, displayed))
+        position[product] = current
+        return trades
+
+    def fill_resting(self, resting, tick_trades, position, cash, timestamp) -> dict:
+        """
+        match the resting orders of a tick against its market trades with the fill model.
+        Args:
+            resting: [(product, side, price, quantity, displayed)] collected by match_orders
+            tick_trades: (product index, price, quantity) arrays of the market trades of the tick
+            position: position dict, updated in place
+            cash: cash dict, updated in place
+            timestamp: timestamp of the tick
+        Returns:
+            dict: our passive trades, {product: [Trade]}
+        """
+        product_index = {product: i for i, product in enumerate(self.products)}
+        products, side, price, quantity, displayed = zip(*resting)
+        filled = self.fill_model.fill([product_index[product] for product in products], side, price, quantity,
+                                      displayed, *tick_trades)
+        res = {}
+        for product, order_side, order_price, traded in zip(products, side, price, filled.tolist()):
+            if traded == 0:
+                continue
+            position[product] = position.get(product, 0) + order_side * traded
+            cash[product] = cash.get(product, 0) - order_side * traded * order_price
+            buyer, seller = (SUBMISSION, '') if order_side > 0 else ('', SUBMISSION)
+            res.setdefault(product, []).append(Trade(product, order_price, traded, buyer, seller, timestamp))
+        return res
+
+    def run(self, verbose: bool = False, profiler=None) -> BacktestResult:
+        """
+        replay every day through a fresh trader.
+        Args:
+            verbose: keep the trader's prints, by default they are discarded
+            profiler: profiler.Profiler timing the trader's methods during the replay, nothing is timed by default
+        Returns:
+            BacktestResult
+        """
+        products = self.products
+        product_index = {product: i for i, product in enumerate(products)}
+        n_ticks = sum(len(ticks) for _, ticks in self.days)
+        pnl = np.zeros((n_ticks, len(products)))
+        positions = np.zeros((n_ticks, len(products)), dtype=int)
+        tick_days = np.zeros(n_ticks, dtype=int)
+        tick_timestamps = np.zeros(n_ticks, dtype=int)
+        all_own_trades = []
+        all_conversions = []
+        rejected = 0
+        listings = {product: {'symbol': product, 'product': product, 'denomination': 'SEASHELLS'}
+                    for product in products}
+        empty_observation = Observation({}, {})
+        depth_cls = SortedOrderDepth if self.sorted_books else OrderDepth
+
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+            if profiler is not None:
+                stack.enter_context(profiler.instrument(self.trader_cls))
+            i = 0
+            for day, ticks in self.days:
+                trader = self.trader_cls()
+                trader_data = ''
+                position, cash, mid = {}, {}, {}
+                own_trades, market_trades = {}, {}
+                for timestamp, books in ticks:
+                    order_depths = {product: depth_cls(dict(book[0]), dict(book[1])) for product, book in books.items()}
+                    state = TradingState(trader_data, timestamp, listings, order_depths, own_trades,
+                                         market_trades, dict(position),
+                                         self.observations.get((day, timestamp), empty_observation))
+                    output = trader.run(state)
+                    if len(output) == 3:
+                        result, conversions, trader_data = output
+                    else:
+                        (result, trader_data), conversions = output, 0
+                    trader_data = trader_data if isinstance(trader_data, str) else ''
+
+                    converted = self.convert(conversions, state.observations, position, cash)
+                    if converted is not None:
+                        all_conversions.append((day, timestamp, *converted))
+
+                    own_trades = {}
+                    resting = [] if self.fill_model is not None else None
+                    for product, orders in (result or {}).items():
+                        if not orders or product not in books:
+                            continue
+                        trades = self.match_orders(product, orders, books[product], position, cash, timestamp,
+                                                   resting)
+                        if trades is None:
+                            rejected += 1
+                        elif trades:
+                            own_trades[product] = trades
+                            all_own_trades.extend(trades)
+                    if resting and (day, timestamp) in self.trade_arrays:
+                        passive = self.fill_resting(resting, self.trade_arrays[(day, timestamp)], position, cash,
+                                                    timestamp)
+                        for product, trades in passive.items():
+                            own_trades.setdefault(product, []).extend(trades)
+                            all_own_trades.extend(trades)
+                    market_trades = self.market_trades.get((day, timestamp), {})
+
+                    for product, cost in STORAGE_COSTS.items():
+                        if position.get(product, 0) > 0:
+                            cash[product] = cash.get(product, 0) - cost * position[product]
+                    for product, book in books.items():
+                        if book[2] == book[2]:
+                            mid[product] = book[2]
+                    for product, current in position.items():
+                        j = product_index[product]
+                        positions[i, j] = current
+                        pnl[i, j] = cash.get(product, 0) + current * mid.get(product, 0)
+                    tick_days[i] = day
+                    tick_timestamps[i] = timestamp
+                    i += 1
+        elapsed = time.perf_counter() - start
+        return BacktestResult(products, tick_days, tick_timestamps, pnl, positions, all_own_trades, rejected, elapsed,
+                              all_conversions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay recorded round data through a Trader')
+    parser.add_argument('trader', help='trader file, e.g. Round5/round_5_trader.py')
+    parser.add_argument('data', nargs='+', help='round data directory, or price csv files')
+    parser.add_argument('--days', type=int, nargs='*', help='only replay these days')
+    parser.add_argument('--round', type=int, help='round of the data files, needed when a directory holds several')
+    parser.add_argument('--verbose', action='store_true', help="show the trader's prints")
+    parser.add_argument('--passive-fills', type=float, nargs='?', const=1.0, metavar='QUEUE_AHEAD',
+                        help='fill resting orders from the market trades, behind this share of the displayed volume')
+    parser.add_argument('--profile', action='store_true', help='time run and the strategy helpers of the trader')
+    parser.add_argument('--sorted-books', action='store_true',
+                        help='give the trader order_book.SortedOrderDepth books instead of plain OrderDepth ones')
+    args = parser.parse_args()
+
+    trader_cls = load_trader(args.trader)
+    fill_model = PassiveFillModel(args.passive_fills) if args.passive_fills is not None else None
+    if len(args.data) == 1 and os.path.isdir(args.data[0]):
+        backtester = Backtester.from_directory(trader_cls, args.data[0], days=args.days, round=args.round,
+                                               fill_model=fill_model, sorted_books=args.sorted_books)
+    else:
+        prices = read_prices(args.data)
+        if args.days is not None:
+            prices = prices[prices['day'].isin(args.days)]
+        backtester = Backtester(trader_cls, prices, fill_model=fill_model, sorted_books=args.sorted_books)
+    profiler = Profiler() if args.profile else None
+    print(backtester.run(verbose=args.verbose, profiler=profiler).summary())
+    if profiler is not None:
+        print()
+        print(profiler.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+import argparse
+import contextlib
+import copy
+import glob
+import json
+import os
+import pickle
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from backtester import ROOT, Backtester, load_trader
+from state_store import _price
+
+DEFAULT_TRADERS = 'Round*/*.py'
+DEFAULT_STATES = ['src/tutorial/*.pkl', 'logs/*/*.log']
+DEFAULT_THRESHOLD = 0.2
+
+# metric: (path in the result, True when a larger value is worse)
+TRACKED_METRICS = {'ticks_per_second': (('ticks_per_second',), False),
+                   'p50_ms': (('latency_ms', 'p50'), True),
+                   'p99_ms': (('latency_ms', 'p99'), True),
+                   'peak_memory_kb': (('peak_memory_kb',), True),
+                   'trader_data_max_bytes': (('trader_data_bytes', 'max'), True)}
+
+
+def find_traders(pattern: str = DEFAULT_TRADERS) -> list:
+    """trader files under the repo root matching pattern, i.e. the files that define a Trader class"""
+    res = []
+    for path in sorted(glob.glob(os.path.join(ROOT, pattern))):
+        with open(path, encoding='utf-8') as f:
+            if 'class Trader' in f.read():
+                res.append(os.path.relpath(path, ROOT))
+    return res
+
+
+def load_states(path) -> list:
+    """
+    recorded TradingState sequence of a file.
+    Args:
+        path: pickled list of TradingState (src/tutorial/*.pkl), state_store file (.states) or sandbox log (.log)
+    Returns:
+        list of TradingState
+    """
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            states = list(pickle.load(f))
+        for state in states:
+            for depth in state.order_depths.values():
+                depth.buy_orders = {_price(price): volume for price, volume in depth.buy_orders.items()}
+                depth.sell_orders = {_price(price): volume for price, volume in depth.sell_orders.items()}
+        return states
+    if path.endswith('.states'):
+        from state_store import StateStore
+        store = StateStore(path)
+        return [view.materialize() for view in store]
+    if path.endswith('.log'):
+        from log_parser import iter_states
+        return list(iter_states(path))
+    raise ValueError(f'unknown state file {path}, expected .pkl, .states or .log')
+
+
+def record_round_states(data_dir, days=None, round=None) -> dict:
+    """
+    TradingState sequences of round data files, as the backtester feeds them to a trader that never trades.
+    Returns:
+        dict: {'<data_dir> day <day>': list of TradingState}
+    """
+    sequences = []
+
+    class Recorder:
+
+        def __init__(self):
+            # the backtester builds a new trader every day
+            sequences.append([])
+
+        def run(self, state):
+            sequences[-1].append(copy.deepcopy(state))
+            return {}, 0, state.traderData
+
+    backtester = Backtester.from_directory(Recorder, data_dir, days=days, round=round)
+    backtester.run()
+    name = os.path.relpath(data_dir, ROOT) if os.path.abspath(data_dir).startswith(ROOT) else data_dir
+    return {f'{name} day {day}': states for (day, _), states in zip(backtester.days, sequences)}
+
+
+def _replay(trader_cls, states, latencies=None, sizes=None):
+    # we feed the recorded states in order, only traderData comes from the trader itself
+    trader = trader_cls()
+    trader_data = ''
+    perf_counter_ns = time.perf_counter_ns
+    for i, state in enumerate(states):
+        state.traderData = trader_data
+        start = perf_counter_ns()
+        output = trader.run(state)
+        if latencies is not None:
+            latencies[i] = perf_counter_ns() - start
+        trader_data = output[-1] if len(output) == 3 else output[1]
+        trader_data = trader_data if isinstance(trader_data, str) else ''
+        if sizes is not None:
+            sizes[i] = len(trader_data.encode())
+
+
+def benchmark(trader_cls, states, repeat: int = 1, memory: bool = True) -> dict:
+    """
+    replay states through trader_cls, open loop: positions and own trades are the recorded ones.
+    Args:
+        trader_cls: Trader class, see backtester.load_trader
+        states: list of TradingState, it is not modified
+        repeat: timed replays, the latencies are pooled and ticks_per_second is the best replay
+        memory: run one more replay under tracemalloc for the peak memory, it is not timed
+    Returns:
+        dict: ticks, ticks_per_second, latency_ms (mean, p50, p90, p99, max), peak_memory_kb and
+        trader_data_bytes (mean, max, last)
+    """
+    n = len(states)
+    latencies = np.zeros((repeat, n), dtype=np.int64)
+    sizes = np.zeros(n, dtype=np.int64)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for r in range(repeat):
+            # traders are free to modify the books they are given
+            replay_states = copy.deepcopy(states)
+            _replay(trader_cls, replay_states, latencies[r], sizes)
+        peak = None
+        if memory:
+            replay_states = copy.deepcopy(states)
+            tracemalloc.start()
+            try:
+                _replay(trader_cls, replay_states)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    ms = latencies.ravel() / 1e6
+    best = latencies.sum(axis=1).min() / 1e9
+    return {'ticks': n,
+            'ticks_per_second': n / best if best else float('inf'),
+            'latency_ms': {'mean': float(ms.mean()), 'p50': float(np.percentile(ms, 50)),
+                           'p90': float(np.percentile(ms, 90)), 'p99': float(np.percentile(ms, 99)),
+                           'max': float(ms.max())},
+            'peak_memory_kb': None if peak is None else peak / 1024,
+            'trader_data_bytes': {'mean': float(sizes.mean()), 'max': int(sizes.max()), 'last': int(sizes[-1])}}
+
+
+def run_suite(traders, sequences: dict, repeat: int = 1, memory: bool = True) -> dict:
+    """
+    benchmark every trader on every state sequence, a trader that fails on one gets an error entry instead.
+    Args:
+        traders: trader files relative to the repo root
+        sequences: {name: list of TradingState}, see load_states and record_round_states
+    Returns:
+        dict: {'environment': {...}, 'results': {trader: {sequence: benchmark result or {'error': message}}}}
+    """
+    results = {}
+    for trader in traders:
+        results[trader] = {}
+        try:
+            trader_cls = load_trader(os.path.join(ROOT, trader))
+        except Exception as e:
+            results[trader] = {path: {'error': f'{type(e).__name__}: {e}'} for path in sequences}
+            continue
+        for path, sequence in sequences.items():
+            try:
+                results[trader][path] = benchmark(trader_cls, sequence, repeat, memory)
+            except Exception as e:
+                results[trader][path] = {'error': f'{type(e).__name__}: {e}'}
+    environment = {'python': platform.python_version(), 'machine': platform.machine(),
+                   'platform': platform.platform(), 'numpy': np.__version__,
+                   'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'environment': environment, 'results': results}
+
+
+def _metric(result, path):
+    for key in path:
+        result = result.get(key) if isinstance(result, dict) else None
+    return result
+
+
+def compare(current: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    regressions of current against baseline, both as returned by run_suite.
+    Args:
+        threshold: relative change of a tracked metric (see TRACKED_METRICS) that counts as a regression
+    Returns:
+        list of (trader, state file, metric, baseline value, current value), a trader that used to run and now
+        fails is reported with the metric 'error'
+    """
+    res = []
+    for trader, files in current['results'].items():
+        for path, result in files.items():
+            old = baseline['results'].get(trader, {}).get(path)
+            if old is None or 'error' in old:
+                continue
+            if 'error' in result:
+                res.append((trader, path, 'error', None, result['error']))
+                continue
+            for name, (metric_path, larger_is_worse) in TRACKED_METRICS.items():
+                before, after = _metric(old, metric_path), _metric(result, metric_path)
+                if before is None or after is None:
+                    continue
+                change = (after - before) if larger_is_worse else (before - after)
+                if change > threshold * abs(before):
+                    res.append((trader, path, name, before, after))
+    return res
+
+
+def format_results(suite: dict) -> str:
+    rows = [(trader, path, result) for trader, files in suite['results'].items() for path, result in files.items()]
+    trader_width = max([len('trader')] + [len(trader) for trader, _, _ in rows]) + 2
+    path_width = max([len('states')] + [len(path) for _, path, _ in rows]) + 2
+    lines = [f'{"trader":<{trader_width}}{"states":<{path_width}}{"ticks/s":>10}{"p50 ms":>9}{"p99 ms":>9}'
+             f'{"max ms":>9}{"peak kb":>10}{"data B":>9}']
+    for trader, path, result in rows:
+        if 'error' in result:
+            lines.append(f'{trader:<{trader_width}}{path:<{path_width}}  {result["error"][:80]}')
+            continue
+        latency = result['latency_ms']
+        peak = result['peak_memory_kb']
+        lines.append(f'{trader:<{trader_width}}{path:<{path_width}}{result["ticks_per_second"]:>10,.0f}'
+                     f'{latency["p50"]:>9.3f}{latency["p99"]:>9.3f}{latency["max"]:>9.3f}'
+                     f'{"-" if peak is None else f"{peak:,.0f}":>10}{result["trader_data_bytes"]["max"]:>9}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time every trader on recorded TradingState sequences')
+    parser.add_argument('--traders', nargs='*', help=f'trader files, by default every trader in {DEFAULT_TRADERS}')
+    parser.add_argument('--states', nargs='*', help=f'.pkl, .states or .log files, by default {DEFAULT_STATES}')
+    parser.add_argument('--data', nargs='*', default=[], help='round data directories replayed as well')
+    parser.add_argument('--days', type=int, nargs='*', help='only these days of the round data')
+    parser.add_argument('--round', type=int, help='round of the data files, needed when a directory holds several')
+    parser.add_argument('--repeat', type=int, default=1, help='timed replays of every sequence')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc replay')
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to check the results against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative change that counts as a regression')
+    args = parser.parse_args()
+
+    traders = args.traders or find_traders()
+    state_files = args.states
+    if state_files is None:
+        state_files = [os.path.relpath(path, ROOT) for pattern in DEFAULT_STATES
+                       for path in sorted(glob.glob(os.path.join(ROOT, pattern)))]
+    sequences = {path: load_states(path if os.path.isabs(path) else os.path.join(ROOT, path)) for path in state_files}
+    for data_dir in args.data:
+        sequences.update(record_round_states(data_dir, args.days, args.round))
+    suite = run_suite(traders, sequences, args.repeat, not args.no_memory)
+    print(format_results(suite))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(suite, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(suite, baseline, args.threshold)
+        print()
+        if not regressions:
+            print(f'no regression beyond {args.threshold:.0%} against {args.compare}')
+        for trader, path, name, before, after in regressions:
+            if name == 'error':
+                print(f'REGRESSION {trader} on {path}: now fails with {after}')
+            else:
+                change = f' ({after / before - 1:+.0%})' if before else ''
+                print(f'REGRESSION {trader} on {path}: {name} {before:,.4g} -> {after:,.4g}{change}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
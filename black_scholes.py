@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+from scipy.special import erf
+
+# same conventions as the round 4 and round 5 traders: COCONUT_COUPON is a call on COCONUT, T counted in days
+K = 10000
+T = 248  # the log shows it is day 3
+r = 0
+MAX_ITERATIONS = 100
+PRECISION = 1.0e-8
+INITIAL_GUESS_VOL = 0.01
+
+
+def norm_cdf(x):
+    return (1.0 + erf(x / np.sqrt(2.0))) / 2.0
+
+
+def norm_pdf(x):
+    return np.exp(-x ** 2 / 2.0) / np.sqrt(2.0 * np.pi)
+
+
+def d1(S, K, r, sigma, T):
+    return (np.log(S / K) + (r + 0.5 * sigma ** 2) * T) / (sigma * np.sqrt(T))
+
+
+def black_scholes(S, K, r, sigma, T, option_type='call'):
+    """
+    Black-Scholes price, every argument can be a scalar or an array (broadcast together).
+    Args:
+        S: underlying price
+        K: strike
+        r: interest rate per unit of T
+        sigma: volatility per sqrt unit of T
+        T: time to expiry
+        option_type: 'call' or 'put'
+    Returns:
+        np.ndarray: option price, a numpy scalar for scalar inputs
+    """
+    d_1 = d1(S, K, r, sigma, T)
+    d_2 = d_1 - sigma * np.sqrt(T)
+    if option_type == 'call':
+        return S * norm_cdf(d_1) - K * np.exp(-r * T) * norm_cdf(d_2)
+    elif option_type == 'put':
+        return K * np.exp(-r * T) * norm_cdf(-d_2) - S * norm_cdf(-d_1)
+    raise ValueError(f'option_type must be call or put, got {option_type}')
+
+
+def delta_call(S, K, r, sigma, T):
+    return norm_cdf(d1(S, K, r, sigma, T))
+
+
+def delta_put(S, K, r, sigma, T):
+    return norm_cdf(d1(S, K, r, sigma, T)) - 1
+
+
+def gamma(S, K, r, sigma, T):
+    return norm_pdf(d1(S, K, r, sigma, T)) / (S * sigma * np.sqrt(T))
+
+
+def vega(S, K, r, sigma, T):
+    return S * norm_pdf(d1(S, K, r, sigma, T)) * np.sqrt(T)
+
+
+def implied_volatility(S, price, K=K, r=r, T=T, option_type='call', initial_guess=INITIAL_GUESS_VOL,
+                       precision=PRECISION, max_iterations=MAX_ITERATIONS):
+    """
+    implied volatility of a whole array of (underlying, option price) pairs at once.
+
+    every element runs the same Newton-Raphson iteration as Trader.implied_volatility of Round4/round_4_trader.py, from
+    the same initial guess and with the same stopping rule, so the results match that scalar solver; the only
+    difference is that the elements still iterating are updated together. the round 5 trader brackets its Newton
+    steps with bisection and warm starts from the previous tick, so it may converge where this one does not. elements that do not converge within max_iterations are NaN where the
+    scalar solver returns None.
+    Args:
+        S: underlying prices
+        price: option prices, broadcast against S
+        K, r, T: strike, rate and time to expiry, scalars or arrays broadcast against S
+        option_type: 'call' or 'put'
+        initial_guess: starting volatility of every element
+        precision: stop once |model price - price| < precision
+        max_iterations: Newton steps before giving up
+    Returns:
+        np.ndarray: implied volatilities with the broadcast shape of the inputs
+    Examples:
+    coconut_mid = np.array([9999.5, 10001.0])
+    coupon_mid = np.array([637.5, 638.5])
+    implied_volatility(coconut_mid, coupon_mid)  # array([0.0101..., 0.0101...])
+    """
+    S, price, K, r, T = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (S, price, K, r, T)])
+    shape = S.shape
+    S, price, K, r, T = [x.ravel() for x in (S, price, K, r, T)]
+    res = np.full(S.shape, np.nan)
+    sigma = np.full(S.shape, float(initial_guess))
+    active = np.arange(S.size)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(max_iterations):
+            if active.size == 0:
+                break
+            s, k, rate, t = S[active], K[active], r[active], T[active]
+            diff = black_scholes(s, k, rate, sigma, t, option_type) - price[active]
+            done = np.abs(diff) < precision
+            res[active[done]] = sigma[done]
+            step = diff / vega(s, k, rate, sigma, t)
+            sigma = (sigma - step)[~done]
+            active = active[~done]
+    return res.reshape(shape)
+
+
+def option_frame(prices: pd.DataFrame, underlying='COCONUT', option='COCONUT_COUPON', K=K, r=r, T=T) -> pd.DataFrame:
+    """
+    implied volatility and greeks of every tick of a price frame (as returned by data_store.load_prices).
+    Args:
+        prices: price frame with day, timestamp, product and mid_price columns
+        underlying: product of the underlying
+        option: product of the call
+        K, r, T: same conventions as the traders
+    Returns:
+        pd.DataFrame: one row per (day, timestamp) with the two mid prices, iv, delta, gamma and vega
+    """
+    mid = prices.pivot_table(index=['day', 'timestamp'], columns='product', values='mid_price', observed=True)
+    res = pd.DataFrame({'S': mid[underlying], 'price': mid[option]})
+    res['iv'] = implied_volatility(res['S'].to_numpy(), res['price'].to_numpy(), K, r, T)
+    sigma = res['iv'].to_numpy()
+    res['delta'] = delta_call(res['S'].to_numpy(), K, r, sigma, T)
+    res['gamma'] = gamma(res['S'].to_numpy(), K, r, sigma, T)
+    res['vega'] = vega(res['S'].to_numpy(), K, r, sigma, T)
+    return res.reset_index()
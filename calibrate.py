@@ -0,0 +1,308 @@
+import argparse
+import ast
+import os
+import pprint
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from data_store import PRICE_LEVELS, MarketDataStore
+from utils import ols
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CONSTANTS_FILE = os.path.join(ROOT, 'model_constants.py')
+
+EWMA_LAMBDAS = np.round(np.arange(0.80, 0.9995, 0.005), 3)
+# ages of the STARFRUIT ticks shaoqin_r1_starfruit_pred reads: its history holds NUM_OF_DATA_POINT = 10 ticks newest
+# first, the current one included, and it takes the last 4 of them
+STARFRUIT_LAGS = [6, 7, 8, 9]
+# the header of a constants module, rewritten on every run
+HEADER_NAMES = ['CALIBRATION_VERSION', 'CALIBRATED_AT', 'CALIBRATION_SOURCE', 'VALIDATION']
+
+
+def _mid_prices(prices: pd.DataFrame) -> pd.DataFrame:
+    """mid price of every product, one column per product and one row per (day, timestamp)"""
+    return prices.pivot_table(index=['day', 'timestamp'], columns='product', values='mid_price', observed=True)
+
+
+def _stanford_side(prices: pd.DataFrame, side: str) -> np.ndarray:
+    # same walk as Trader.stanford_values_extract, over the csv levels instead of an order depth
+    total = np.zeros(len(prices))
+    best_volume = np.full(len(prices), -1.0)
+    best_price = np.full(len(prices), -1.0)
+    for i in range(1, PRICE_LEVELS + 1):
+        price = prices[f'{side}_price_{i}'].to_numpy(dtype=float)
+        volume = np.abs(prices[f'{side}_volume_{i}'].to_numpy(dtype=float))
+        valid = ~np.isnan(price)
+        total = np.where(valid, total + np.nan_to_num(volume), total)
+        take = valid & (total > best_volume)
+        best_volume = np.where(take, volume, best_volume)
+        best_price = np.where(take, price, best_price)
+    return best_price
+
+
+def stanford_mid_price(prices: pd.DataFrame, product) -> pd.Series:
+    """Trader.cal_standford_mid_price_vol of every tick of product, indexed by (day, timestamp)"""
+    book = prices[prices['product'] == product]
+    mid = (_stanford_side(book, 'bid') + _stanford_side(book, 'ask')) / 2
+    return pd.Series(mid, index=pd.MultiIndex.from_frame(book[['day', 'timestamp']]))
+
+
+def starfruit_data(prices, observations):
+    # next tick stanford mid price from the features of shaoqin_r1_starfruit_pred, in the order it applies the
+    # coefficients to them
+    mid = stanford_mid_price(prices, 'STARFRUIT')
+    by_day = mid.groupby(level='day')
+    X = pd.DataFrame({f'lag_{lag}': by_day.shift(lag) for lag in STARFRUIT_LAGS})
+    return X, by_day.shift(-1)
+
+
+def orchids_data(prices, observations):
+    # ORCHIDS mid price from sunlight, humidity and the import cost, as in shaoqin_r2_orchids_pred
+    obs = observations.set_index(['day', 'timestamp'])
+    X = pd.DataFrame({'sunlight': obs['sunlight'], 'humidity': obs['humidity'],
+                      'import_cost': obs['importTariff'] + obs['exportTariff'] + obs['transportFees']})
+    mid = _mid_prices(prices)['ORCHIDS']
+    return X.reindex(mid.index), mid
+
+
+def gift_basket_data(prices, observations):
+    # the premium of GIFT_BASKET over 4 CHOCOLATE + 6 STRAWBERRIES + 1 ROSES, an intercept only model
+    mid = _mid_prices(prices)
+    premium = mid['GIFT_BASKET'] - 4 * mid['CHOCOLATE'] - 6 * mid['STRAWBERRIES'] - mid['ROSES']
+    return pd.DataFrame(index=premium.index), premium
+
+
+def coconut_data(prices, observations):
+    # COCONUT mid price from COCONUT_COUPON mid price, as in r4_current_coconut_fair_price
+    mid = _mid_prices(prices)
+    return mid[['COCONUT_COUPON']], mid['COCONUT']
+
+
+def coupon_data(prices, observations):
+    # COCONUT_COUPON mid price from COCONUT mid price, as in r4_current_coconut_coupon_fair_price
+    mid = _mid_prices(prices)
+    return mid[['COCONUT']], mid['COCONUT_COUPON']
+
+
+def coconut_returns(prices, observations):
+    mid = _mid_prices(prices)['COCONUT']
+    return None, np.log(mid).groupby(level='day').diff()
+
+
+# model: (dataset, constants written for the model, products it needs)
+MODELS = {
+    'starfruit': (starfruit_data, {'coefficients': 'STARFRUIT_COEF', 'intercept': 'STARFRUIT_INTERCEPT'},
+                  ['STARFRUIT']),
+    'orchids': (orchids_data, {'coefficients': 'ORCHIDS_COEF', 'intercept': 'ORCHIDS_INTERCEPT'}, ['ORCHIDS']),
+    'gift_basket': (gift_basket_data, {'intercept': 'BASKET_PREMIUM'},
+                    ['GIFT_BASKET', 'CHOCOLATE', 'STRAWBERRIES', 'ROSES']),
+    'coconut': (coconut_data, {'coefficients': 'COCONUT_FAIR_COEF', 'intercept': 'COCONUT_FAIR_INTERCEPT',
+                               'residual_mean': 'COCONUT_RESIDUAL_MEAN', 'residual_std': 'COCONUT_RESIDUAL_STD'},
+                ['COCONUT', 'COCONUT_COUPON']),
+    'coupon': (coupon_data, {'coefficients': 'COUPON_FAIR_COEF', 'intercept': 'COUPON_FAIR_INTERCEPT',
+                             'residual_mean': 'COUPON_RESIDUAL_MEAN', 'residual_std': 'COUPON_RESIDUAL_STD'},
+               ['COCONUT', 'COCONUT_COUPON']),
+    'ewma': (coconut_returns, {'lambda': 'EWMA_lambda'}, ['COCONUT']),
+}
+
+
+def fit_regression(X: pd.DataFrame, y: pd.Series) -> dict:
+    res = ols(y.to_numpy(), X.to_numpy(), intercept=True)
+    return {'coefficients': res['coefficients'].tolist(), 'intercept': float(res['intercept']),
+            'residual_mean': float(np.mean(res['residuals'])), 'residual_std': float(np.std(res['residuals']))}
+
+
+def score_regression(params, X: pd.DataFrame, y: pd.Series) -> dict:
+    residuals = y.to_numpy() - params['intercept'] - X.to_numpy() @ np.asarray(params['coefficients'])
+    ss_tot = np.sum((y.to_numpy() - y.mean()) ** 2)
+    return {'rmse': float(np.sqrt(np.mean(residuals ** 2))), 'bias': float(np.mean(residuals)),
+            'R2': float(1 - np.sum(residuals ** 2) / ss_tot) if ss_tot > 0 else float('nan')}
+
+
+def _ewma_errors(returns: pd.Series, lam) -> np.ndarray:
+    # one tick ahead RiskMetrics variance forecast error, var_t+1 = lam * var_t + (1 - lam) * r_t^2, per day
+    errors = []
+    for _, r in returns.groupby(level='day'):
+        squared = r.dropna().to_numpy() ** 2
+        if len(squared) < 2:
+            continue
+        forecast = lfilter([1 - lam], [1, -lam], squared, zi=[lam * squared[0]])[0]
+        errors.append(squared[1:] - forecast[:-1])
+    return np.concatenate(errors) if errors else np.array([])
+
+
+def fit_ewma(X, returns: pd.Series) -> dict:
+    losses = [np.mean(_ewma_errors(returns, lam) ** 2) for lam in EWMA_LAMBDAS]
+    return {'lambda': float(EWMA_LAMBDAS[int(np.argmin(losses))])}
+
+
+def score_ewma(params, X, returns: pd.Series) -> dict:
+    errors = _ewma_errors(returns, params['lambda'])
+    return {'rmse': float(np.sqrt(np.mean(errors ** 2))), 'bias': float(np.mean(errors))}
+
+
+def calibrate_model(name, data_dir, round=None, days=None) -> dict:
+    """
+    fit one model on every day of the data, and on every day but one to score it on the day left out.
+    Args:
+        name: key of MODELS
+        data_dir: round data directory
+        round: round of the data files
+        days: only use these days, every day of the data by default
+    Returns:
+        dict: {'params': fit on every day, 'validation': {held out day: scores}, 'rows': rows of the dataset}
+    """
+    dataset, _, _ = MODELS[name]
+    store = MarketDataStore(data_dir, round)
+    prices = store.prices().to_frame()
+    observations = store.observations().to_frame() if name == 'orchids' else None
+    if days is not None:
+        prices = prices[prices['day'].isin(days)]
+        if observations is not None:
+            observations = observations[observations['day'].isin(days)]
+    X, y = dataset(prices, observations)
+    if name == 'ewma':
+        fit, score = fit_ewma, score_ewma
+    else:
+        rows = X.notna().all(axis=1) & y.notna()
+        X, y = X[rows], y[rows]
+        fit, score = fit_regression, score_regression
+
+    all_days = sorted(y.index.get_level_values('day').unique())
+    validation = {}
+    if len(all_days) > 1:
+        for day in all_days:
+            test = y.index.get_level_values('day') == day
+            params = fit(None if X is None else X[~test], y[~test])
+            validation[int(day)] = score(params, None if X is None else X[test], y[test])
+    return {'params': fit(X, y), 'validation': validation, 'rows': int(y.notna().sum())}
+
+
+def calibrate(data_dir, round=None, days=None, models=None, workers=None) -> dict:
+    """
+    calibrate every model (or the given ones) in a process pool, one model per task.
+    models whose products are missing from the data are skipped.
+    Returns:
+        dict: {model name: result of calibrate_model}
+    """
+    store = MarketDataStore(data_dir, round)
+    # build the columnar cache once here, the workers then only memory-map it
+    available = set(store.prices().to_frame()['product'].unique())
+    store.observations()
+    names = [name for name in (models or MODELS) if set(MODELS[name][2]) <= available]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(calibrate_model, name, data_dir, round, days) for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def _current_version(path) -> int:
+    try:
+        with open(path) as f:
+            match = re.search(r'^CALIBRATION_VERSION = (\d+)$', f.read(), re.M)
+    except OSError:
+        return 0
+    return int(match.group(1)) if match else 0
+
+
+def constants(results: dict) -> dict:
+    """{constant name: value} of the calibrated models, the names the traders use"""
+    res = {}
+    for name, result in results.items():
+        for key, constant in MODELS[name][1].items():
+            value = result['params'][key]
+            # the fair price regressions have a single coefficient
+            res[constant] = value[0] if isinstance(value, list) and len(value) == 1 else value
+    return res
+
+
+def read_constants(path) -> dict:
+    """{name: value} of the 'NAME = literal' assignments of a constants module, empty if there is none"""
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError):
+        return {}
+    res = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                res[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return res
+
+
+def write_constants(results: dict, path=CONSTANTS_FILE, source='') -> int:
+    """
+    write the calibrated constants to a python module, returns its CALIBRATION_VERSION.
+    the constants and validation scores of the models that were not refit this time are kept from the existing module,
+    so a run with --models or on data missing some products never drops a constant.
+    """
+    version = _current_version(path) + 1
+    existing = read_constants(path)
+    values = {name: value for name, value in existing.items() if name not in HEADER_NAMES}
+    values.update(constants(results))
+    validation = existing.get('VALIDATION') if isinstance(existing.get('VALIDATION'), dict) else {}
+    validation.update({name: result['validation'] for name, result in results.items()})
+    lines = ['# written by calibrate.py, do not edit by hand',
+             f'CALIBRATION_VERSION = {version}',
+             f'CALIBRATED_AT = {time.strftime("%Y-%m-%d %H:%M:%S")!r}',
+             f'CALIBRATION_SOURCE = {source!r}',
+             '']
+    lines += [f'{name} = {value!r}' for name, value in values.items()]
+    lines += ['', '# out of sample scores, each day scored by the model fitted on the other days',
+              'VALIDATION = ' + pprint.pformat(validation, width=120, sort_dicts=False), '']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+    return version
+
+
+def embed_constants(results: dict, trader_path) -> list:
+    """
+    overwrite the default value of the calibrated constants in a trader file, which has to be self-contained when
+    it is submitted. only the existing 'NAME = value' lines at the top level are replaced.
+    Returns:
+        list: names of the replaced constants
+    """
+    with open(trader_path) as f:
+        text = f.read()
+    replaced = []
+    for name, value in constants(results).items():
+        text, count = re.subn(rf'^{re.escape(name)} = .*$', f'{name} = {value!r}', text, flags=re.M)
+        if count:
+            replaced.append(name)
+    with open(trader_path, 'w') as f:
+        f.write(text)
+    return replaced
+
+
+def main():
+    parser = argparse.ArgumentParser(description='refit the model constants of the traders from round data')
+    parser.add_argument('data', help='round data directory')
+    parser.add_argument('--round', type=int, help='round of the data files, needed when a directory holds several')
+    parser.add_argument('--days', type=int, nargs='*', help='only use these days')
+    parser.add_argument('--models', nargs='*', choices=list(MODELS), help='only refit these models')
+    parser.add_argument('--workers', type=int, help='size of the process pool, the number of cpus by default')
+    parser.add_argument('--out', default=CONSTANTS_FILE, help='constants module to write')
+    parser.add_argument('--embed', nargs='*', default=[], help='trader files whose default constants are updated')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = calibrate(args.data, args.round, args.days, args.models, args.workers)
+    for name, result in results.items():
+        print(f'{name}: {result["rows"]} rows, {result["params"]}')
+        for day, scores in result['validation'].items():
+            print(f'    day {day}: ' + ', '.join(f'{key} {value:.6g}' for key, value in scores.items()))
+    version = write_constants(results, args.out, os.path.abspath(args.data))
+    print(f'wrote version {version} of {args.out} in {time.perf_counter() - start:.1f}s')
+    for trader in args.embed:
+        print(f'{trader}: updated {", ".join(embed_constants(results, trader)) or "nothing"}')
+
+
+if __name__ == '__main__':
+    main()
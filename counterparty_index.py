@@ -0,0 +1,261 @@
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_store import MarketDataStore, _round_from_filename
+
+DEFAULT_TRADES_DIR = 'src/round5/round-5-island-data-bottle'
+# how a round price directory is named, as in visualizer.visualize_player_product
+PRICE_DIR_FORMAT = 'src/round{round}/round-{round}-island-data-bottle'
+COLUMNS = ['round', 'day', 'timestamp', 'key', 'quantity', 'price', 'other', 'position', 'cash', 'mark', 'pnl',
+           'buy_vwap', 'sell_vwap']
+_PRODUCT_SHIFT = 40  # (product << 40) + key sorts the price rows by product then time, keys stay below 2 ** 40
+
+
+def _segment_cumsum(values, starts):
+    # cumulative sum restarting at every segment start, starts holds the segment start of every element
+    res = np.cumsum(values)
+    return res - (res - values)[starts]
+
+
+def _segment_key(columns) -> np.ndarray:
+    # one int64 per (counterparty, product, round)
+    return (columns['counterparty'].astype(np.int64) << 32) | (columns['product'].astype(np.int64) << 16) \
+        | columns['round'].astype(np.int64)
+
+
+def _mid(prices) -> np.ndarray:
+    # mid of the best levels, the present side when the other one is missing (stored as 0), NaN without both
+    bid = np.asarray(prices['bid_price_1'], dtype=float)
+    ask = np.asarray(prices['ask_price_1'], dtype=float)
+    return np.where(bid > 0, np.where(ask > 0, (bid + ask) / 2, bid), np.where(ask > 0, ask, np.nan))
+
+
+class CounterpartyIndex:
+    """
+    Positions and PnL of every named counterparty, computed once over the trades_round_*_wn.csv files.
+
+    every trade gives a +quantity row to its buyer and a -quantity row to its seller. the rows are sorted by
+    (counterparty, product, round, time) and the position, cash, running buy / sell VWAP and mark-to-market PnL of
+    every row are cumulative sums over its (counterparty, product, round) segment, so a query is a dict lookup and
+    array slices and the leaderboard is a reduction over the segment ends. positions restart at 0 every round, the
+    rounds replay overlapping days and are not one history.
+    the mark of a row is the mid of the product at that tick (or the last tick before it) in the prices of its round,
+    the trade price when the round has no prices for the product.
+    Examples:
+    index = CounterpartyIndex.build('src/round5/round-5-island-data-bottle')
+    flow = index.query('Rhianna', 'ROSES')  # {'timestamp': ..., 'quantity': ..., 'position': ..., 'pnl': ...}
+    index.leaderboard().head(10)  # who makes money on what
+    """
+
+    def __init__(self, columns: dict, counterparties: list, products: list, final_marks: dict):
+        self.columns = columns
+        self.counterparties = counterparties
+        self.products = products
+        self.final_marks = final_marks  # {(product code, round): last mark of the round}
+        self._counterparty_code = {name: i for i, name in enumerate(counterparties)}
+        self._product_code = {name: i for i, name in enumerate(products)}
+
+        segment = _segment_key(columns)
+        starts = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]]) if len(segment) else np.zeros(0, int)
+        ends = np.r_[starts[1:], len(segment)].astype(np.int64)
+        self.segment_starts, self.segment_ends = starts, ends
+        self._segments = {}  # {(counterparty, product): [(round, start, end)]}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            key = (int(columns['counterparty'][start]), int(columns['product'][start]))
+            self._segments.setdefault(key, []).append((int(columns['round'][start]), start, end))
+
+    @classmethod
+    def build(cls, trades_dir=DEFAULT_TRADES_DIR, rounds=None, price_dirs=None) -> 'CounterpartyIndex':
+        """
+        index the named trades of a directory.
+        Args:
+            trades_dir: directory of the trades_round_*_day_*_wn.csv files, the round 5 directory holds every round
+            rounds: only index these rounds
+            price_dirs: {round: price data directory} for the marks, by default trades_dir when it has the prices of
+                the round, else PRICE_DIR_FORMAT when that directory exists
+        Returns:
+            CounterpartyIndex
+        """
+        found = sorted({_round_from_filename(path) for path in glob.glob(os.path.join(trades_dir, 'trades_round_*.csv'))
+                        if _round_from_filename(path) is not None})
+        rounds = [r for r in found if rounds is None or r in rounds]
+        if not rounds:
+            raise FileNotFoundError(f'no trades_round_*_day_*.csv found in {trades_dir} for rounds {rounds}')
+
+        tables = {r: MarketDataStore(trades_dir, r).trades() for r in rounds}
+        counterparties = sorted({name for table in tables.values() for name in table.categories['buyer']} - {''})
+        products = sorted({name for table in tables.values() for name in table.categories['symbol']})
+        counterparty_code = {name: i for i, name in enumerate(counterparties)}
+        product_code = {name: i for i, name in enumerate(products)}
+
+        parts, final_marks = [], {}
+        for r, table in tables.items():
+            if not len(table):
+                continue
+            # local category codes to the codes shared by every round, -1 for the anonymous ''
+            names = np.array([counterparty_code.get(name, -1) for name in table.categories['buyer']], dtype=np.int64)
+            symbols = np.array([product_code[name] for name in table.categories['symbol']], dtype=np.int64)
+            product = symbols[np.asarray(table['symbol'])]
+            key = np.asarray(table['key'], dtype=np.int64)
+            price = np.asarray(table['price'], dtype=float)
+            mark, last_mark = cls._marks(trades_dir, r, price_dirs, product_code, product, key)
+            for p in np.unique(product).tolist():
+                rows = np.flatnonzero(product == p)
+                final_marks[(p, r)] = last_mark.get(p, float(price[rows[-1]]))
+            mark = np.where(np.isnan(mark), price, mark)
+
+            buyer, seller = names[np.asarray(table['buyer'])], names[np.asarray(table['seller'])]
+            quantity = np.asarray(table['quantity'], dtype=np.int64)
+            for counterparty, other, sign in ((buyer, seller, 1), (seller, buyer, -1)):
+                keep = counterparty >= 0
+                parts.append({'counterparty': counterparty[keep], 'product': product[keep],
+                              'round': np.full(keep.sum(), r, dtype=np.int64),
+                              'day': np.asarray(table['day'], dtype=np.int64)[keep],
+                              'timestamp': np.asarray(table['timestamp'], dtype=np.int64)[keep], 'key': key[keep],
+                              'quantity': sign * quantity[keep], 'price': price[keep], 'other': other[keep],
+                              'mark': mark[keep], 'row': np.arange(len(table))[keep]})
+
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]} if parts else \
+            {name: np.zeros(0, dtype=np.int64) for name in ['counterparty', 'product', 'round', 'day', 'timestamp',
+                                                           'key', 'quantity', 'price', 'other', 'mark', 'row']}
+        # the csv row breaks the ties, the rows of one tick keep the order they were printed in
+        row = columns.pop('row')
+        order = np.lexsort((row, columns['key'], columns['round'], columns['product'], columns['counterparty']))
+        columns = {name: values[order] for name, values in columns.items()}
+        columns['counterparty'] = columns['counterparty'].astype(np.int16)
+        columns['product'] = columns['product'].astype(np.int16)
+        columns['other'] = columns['other'].astype(np.int16)
+        columns['round'] = columns['round'].astype(np.int16)
+
+        segment = _segment_key(columns)
+        new = np.r_[True, segment[1:] != segment[:-1]] if len(segment) else np.zeros(0, dtype=bool)
+        starts = np.flatnonzero(new)[np.cumsum(new) - 1] if len(segment) else np.zeros(0, dtype=np.int64)
+        quantity, price = columns['quantity'], columns['price']
+        bought, sold = np.maximum(quantity, 0), np.maximum(-quantity, 0)
+        columns['position'] = _segment_cumsum(quantity, starts)
+        columns['cash'] = _segment_cumsum(-quantity * price, starts)
+        columns['pnl'] = columns['cash'] + columns['position'] * columns['mark']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns['buy_vwap'] = _segment_cumsum(bought * price, starts) / _segment_cumsum(bought, starts)
+            columns['sell_vwap'] = _segment_cumsum(sold * price, starts) / _segment_cumsum(sold, starts)
+        return cls(columns, counterparties, products, final_marks)
+
+    @staticmethod
+    def _marks(trades_dir, round, price_dirs, product_code, product, key):
+        # as-of mid of every trade row and the last mid of every product, NaN / missing without prices
+        mark = np.full(len(key), np.nan)
+        candidates = [trades_dir, PRICE_DIR_FORMAT.format(round=round)]
+        if price_dirs is not None:
+            candidates = [price_dirs[round]] if round in price_dirs else []
+        for data_dir in candidates:
+            if not os.path.isdir(data_dir) or not glob.glob(os.path.join(data_dir, f'prices_round_{round}_day_*.csv')):
+                continue
+            prices = MarketDataStore(data_dir, round).prices()
+            codes = np.array([product_code.get(name, -1) for name in prices.categories['product']], dtype=np.int64)
+            price_product = codes[np.asarray(prices['product'])]
+            mid = _mid(prices)
+            known = (price_product >= 0) & ~np.isnan(mid)
+            composite = (price_product[known] << _PRODUCT_SHIFT) + np.asarray(prices['key'], dtype=np.int64)[known]
+            order = np.argsort(composite, kind='stable')
+            composite, mid = composite[order], mid[known][order]
+            if not len(composite):
+                break
+            row = np.searchsorted(composite, (product << _PRODUCT_SHIFT) + key, 'right') - 1
+            found = (row >= 0) & ((composite[np.maximum(row, 0)] >> _PRODUCT_SHIFT) == product)
+            mark[found] = mid[row[found]]
+            last = np.r_[np.flatnonzero(np.diff(composite >> _PRODUCT_SHIFT)), len(composite) - 1]
+            return mark, dict(zip((composite[last] >> _PRODUCT_SHIFT).tolist(), mid[last].tolist()))
+        return mark, {}
+
+    def __len__(self) -> int:
+        return len(self.columns['key'])
+
+    def query(self, counterparty, product, round=None) -> dict:
+        """
+        trades of one counterparty in one product.
+        Args:
+            round: only this round, by default every round in order (position, cash and pnl restart each round)
+        Returns:
+            dict: {column: np.ndarray view} for the columns in COLUMNS, 'other' holds the code of the counterparty on
+            the other side (see counterparties), empty arrays when they never traded the product
+        """
+        segments = self._segments.get((self._counterparty_code.get(counterparty, -1),
+                                       self._product_code.get(product, -1)), [])
+        if round is not None:
+            segments = [segment for segment in segments if segment[0] == round]
+        start, end = (segments[0][1], segments[-1][2]) if segments else (0, 0)
+        # the rounds of a pair are consecutive segments, the slice of all of them is contiguous
+        return {name: self.columns[name][start:end] for name in COLUMNS}
+
+    def history(self, counterparty, product, round=None) -> pd.DataFrame:
+        """query as a frame, with the other side decoded, like trading_history of the round 5 notebook"""
+        res = pd.DataFrame(self.query(counterparty, product, round))
+        res['other'] = np.asarray(self.counterparties, dtype=object)[res['other'].to_numpy()] if len(res) else []
+        return res
+
+    def counterparties_of(self, product) -> list:
+        """counterparties that traded product"""
+        code = self._product_code.get(product, -1)
+        return [self.counterparties[c] for c, p in self._segments if p == code]
+
+    def leaderboard(self, rounds=None, by_round: bool = False) -> pd.DataFrame:
+        """
+        final PnL of every (counterparty, product): cash plus the position marked at the last mark of the round.
+        Args:
+            rounds: only these rounds
+            by_round: one row per (counterparty, product, round) instead of the sum over the rounds
+        Returns:
+            pd.DataFrame: counterparty, product, [round,] trades, bought, sold, buy_vwap, sell_vwap, position (of the
+            last round) and pnl, sorted by pnl
+        """
+        columns, starts, ends = self.columns, self.segment_starts, self.segment_ends
+        last = ends - 1
+        product, round = columns['product'][starts].astype(np.int64), columns['round'][starts].astype(np.int64)
+        quantity = columns['quantity']
+        bought = np.add.reduceat(np.maximum(quantity, 0), starts) if len(starts) else np.zeros(0)
+        sold = np.add.reduceat(np.maximum(-quantity, 0), starts) if len(starts) else np.zeros(0)
+        final_mark = np.array([self.final_marks[key] for key in zip(product.tolist(), round.tolist())], dtype=float)
+        res = pd.DataFrame({'counterparty': columns['counterparty'][starts].astype(np.int64), 'product': product,
+                            'round': round, 'trades': ends - starts, 'bought': bought, 'sold': sold,
+                            'buy_notional': np.nan_to_num(columns['buy_vwap'][last]) * bought,
+                            'sell_notional': np.nan_to_num(columns['sell_vwap'][last]) * sold,
+                            'position': columns['position'][last],
+                            'pnl': columns['cash'][last] + columns['position'][last] * final_mark})
+        if rounds is not None:
+            res = res[res['round'].isin(rounds)]
+        if not by_round:
+            res = res.groupby(['counterparty', 'product'], as_index=False).agg(
+                {'trades': 'sum', 'bought': 'sum', 'sold': 'sum', 'buy_notional': 'sum', 'sell_notional': 'sum',
+                 'position': 'last', 'pnl': 'sum'})
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res['buy_vwap'] = res.pop('buy_notional') / res['bought'].where(res['bought'] > 0)
+            res['sell_vwap'] = res.pop('sell_notional') / res['sold'].where(res['sold'] > 0)
+        res['counterparty'] = np.asarray(self.counterparties, dtype=object)[res['counterparty'].to_numpy()]
+        res['product'] = np.asarray(self.products, dtype=object)[res['product'].to_numpy()]
+        res = res[[name for name in ['counterparty', 'product', 'round', 'trades', 'bought', 'sold', 'buy_vwap',
+                                     'sell_vwap', 'position', 'pnl'] if name in res.columns]]
+        return res.sort_values('pnl', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PnL of every named counterparty on every product')
+    parser.add_argument('trades_dir', nargs='?', default=DEFAULT_TRADES_DIR, help='directory of the _wn trade files')
+    parser.add_argument('--rounds', type=int, nargs='*', help='only these rounds')
+    parser.add_argument('--product', help='only this product')
+    parser.add_argument('--by-round', action='store_true', help='one row per round')
+    parser.add_argument('--top', type=int, default=30, help='rows printed')
+    args = parser.parse_args()
+
+    board = CounterpartyIndex.build(args.trades_dir, args.rounds).leaderboard(args.rounds, args.by_round)
+    if args.product:
+        board = board[board['product'] == args.product]
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(board.head(args.top).to_string(index=False, float_format=lambda x: f'{x:,.2f}'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import glob
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+PRICE_LEVELS = 3
+
+LEVEL_COLUMNS = [f'{side}_{field}_{i}' for side in ['bid', 'ask'] for i in range(1, PRICE_LEVELS + 1)
+                 for field in ['price', 'volume']]
+
+OBSERVATION_FIELDS = ['bidPrice', 'askPrice', 'transportFees', 'exportTariff', 'importTariff', 'sunlight', 'humidity']
+
+CACHE_VERSION = 1
+
+
+def _read_csv(path, **kwargs) -> pd.DataFrame:
+    # the round files are ';' separated, the tutorial exports and observation files use ','
+    with open(path) as f:
+        header = f.readline()
+    df = pd.read_csv(path, sep=';' if ';' in header else ',', **kwargs)
+    return df.loc[:, ~df.columns.str.startswith('Unnamed')]
+
+
+def _day_from_filename(path) -> int:
+    match = re.search(r'day_(-?\d+)', os.path.basename(path))
+    if match is None:
+        raise ValueError(f'cannot infer the day from {path}')
+    return int(match.group(1))
+
+
+def _round_from_filename(path):
+    match = re.search(r'round_(\d+)', os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def find_round_files(data_dir, round=None):
+    """
+    find the price, trade and observation csv files of a round data directory.
+    Args:
+        data_dir: directory holding prices_round_*_day_*.csv, trades_round_*_day_*.csv and
+        (optionally) observations_round_*_day_*.csv
+        round: only keep the files of this round, the round 5 directory holds the trades of every round
+    Returns:
+        tuple: (price files, trade files, observation files), each sorted by day
+    """
+    def by_day(pattern):
+        files = glob.glob(os.path.join(data_dir, pattern))
+        if round is not None:
+            files = [f for f in files if _round_from_filename(f) == round]
+        return sorted(files, key=_day_from_filename)
+
+    return (by_day('prices_round_*_day_*.csv'), by_day('trades_round_*_day_*.csv'),
+            by_day('observations_round_*_day_*.csv'))
+
+
+def merged_timestamp(day, timestamp):
+    """single int64 key ordering (day, timestamp) across days, same convention as visualizer"""
+    return (np.asarray(day, dtype=np.int64) + 2) * 1_000_000 + np.asarray(timestamp, dtype=np.int64)
+
+
+def read_prices(paths) -> pd.DataFrame:
+    """read price csv files (day;timestamp;product;bid_price_1;...) sorted by day, timestamp and product"""
+    prices = pd.concat([_read_csv(path) for path in paths], ignore_index=True)
+    return prices.sort_values(['day', 'timestamp', 'product'], kind='stable').reset_index(drop=True)
+
+
+def read_trades(paths) -> pd.DataFrame:
+    """read trade csv files (timestamp;buyer;seller;symbol;...), the day is taken from the file name"""
+    trades = []
+    for path in paths:
+        df = _read_csv(path)
+        df.insert(0, 'day', _day_from_filename(path))
+        trades.append(df)
+    trades = pd.concat(trades, ignore_index=True)
+    for col in ['buyer', 'seller']:
+        if col not in trades.columns:
+            trades[col] = ''
+        trades[col] = trades[col].fillna('').astype(str)
+    return trades.sort_values(['day', 'timestamp'], kind='stable').reset_index(drop=True)
+
+
+def read_observations(paths) -> pd.DataFrame:
+    """read ORCHIDS observation csv files (timestamp,bidPrice,askPrice,...), the day is taken from the file name"""
+    observations = []
+    for path in paths:
+        df = _read_csv(path)
+        df.insert(0, 'day', _day_from_filename(path))
+        observations.append(df)
+    return pd.concat(observations, ignore_index=True).sort_values(['day', 'timestamp'], kind='stable').reset_index(
+        drop=True)
+
+
+def _integral(values) -> bool:
+    values = values[~np.isnan(values)]
+    return bool(np.all(values == np.round(values))) and (values.size == 0 or np.abs(values).max() < 2 ** 31)
+
+
+class ColumnTable:
+    """
+    Typed columns of one kind of market data (prices, trades or observations).
+    Categorical columns are stored as int16 codes, the labels are in categories[column].
+    Missing book levels are stored as price 0 and volume 0.
+    """
+
+    def __init__(self, columns: dict, categories: dict):
+        self.columns = columns
+        self.categories = categories
+
+    def __getitem__(self, name) -> np.ndarray:
+        return self.columns[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.columns
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def code(self, column, label) -> int:
+        """integer code of a category label, -1 if the label never appears"""
+        labels = self.categories[column]
+        return labels.index(label) if label in labels else -1
+
+    def decode(self, column) -> np.ndarray:
+        """labels of a categorical column as an object array"""
+        return np.asarray(self.categories[column], dtype=object)[self.columns[column]]
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        pandas view with the same columns as the csv files: categoricals become pd.Categorical and missing
+        book levels become NaN again.
+        """
+        data = {}
+        for name, values in self.columns.items():
+            if name in self.categories:
+                data[name] = pd.Categorical.from_codes(np.asarray(values), categories=self.categories[name])
+            else:
+                data[name] = np.asarray(values)
+        for side in ['bid', 'ask']:
+            for i in range(1, PRICE_LEVELS + 1):
+                price, volume = f'{side}_price_{i}', f'{side}_volume_{i}'
+                if price in data and (data[volume] == 0).any():
+                    missing = data[volume] == 0
+                    data[price] = np.where(missing, np.nan, data[price])
+                    data[volume] = np.where(missing, np.nan, data[volume])
+        return pd.DataFrame(data)
+
+
+class MarketDataStore:
+    """
+    Columnar cache of the round csv files.
+
+    The first load parses the csv files once and writes every column as a .npy file under
+    <data_dir>/.cache/round<round>/<kind>/; later loads memory-map those files. The cache is rebuilt whenever the
+    name, size or modification time of a source csv changes.
+    Examples:
+    store = MarketDataStore('src/round4/round-4-island-data-bottle', round=4)
+    prices = store.prices()  # ColumnTable of memory-mapped columns
+    coupon = prices['product'] == prices.code('product', 'COCONUT_COUPON')
+    mid = prices['mid_price'][coupon]
+    """
+
+    def __init__(self, data_dir, round=None, cache_dir=None):
+        self.data_dir = data_dir
+        self.round = round
+        self.files = dict(zip(['prices', 'trades', 'observations'], find_round_files(data_dir, round)))
+        rounds = {_round_from_filename(f) for files in self.files.values() for f in files}
+        if len(rounds) > 1:
+            raise ValueError(f'{data_dir} holds the data of rounds {sorted(rounds)}, pick one with round=')
+        cache_dir = cache_dir or os.path.join(data_dir, '.cache')
+        self.cache_dir = os.path.join(cache_dir, f'round{rounds.pop() if rounds else ""}')
+
+    def prices(self) -> ColumnTable:
+        return self._load('prices')
+
+    def trades(self) -> ColumnTable:
+        return self._load('trades')
+
+    def observations(self) -> ColumnTable:
+        return self._load('observations')
+
+    def _load(self, kind) -> ColumnTable:
+        paths = self.files[kind]
+        if not paths:
+            return ColumnTable({}, {})
+        target = os.path.join(self.cache_dir, kind)
+        sources = [[os.path.basename(p), os.path.getsize(p), os.stat(p).st_mtime_ns] for p in paths]
+        meta = None
+        try:
+            with open(os.path.join(target, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if meta is None or meta.get('version') != CACHE_VERSION or meta.get('sources') != sources:
+            meta = self._convert(kind, paths, target, sources)
+        columns = {name: np.load(os.path.join(target, name + '.npy'), mmap_mode='r') for name in meta['columns']}
+        return ColumnTable(columns, meta['categories'])
+
+    @staticmethod
+    def _typed_columns(kind, df):
+        """convert a parsed csv frame into (ordered columns, categories)"""
+        columns, categories = {}, {}
+        columns['day'] = df['day'].to_numpy(dtype=np.int32)
+        columns['timestamp'] = df['timestamp'].to_numpy(dtype=np.int32)
+        columns['key'] = merged_timestamp(df['day'], df['timestamp'])
+        if kind == 'prices':
+            labels = sorted(df['product'].unique().tolist())
+            categories['product'] = labels
+            columns['product'] = pd.Categorical(df['product'], categories=labels).codes.astype(np.int16)
+            for name in LEVEL_COLUMNS:
+                if name in df.columns:
+                    columns[name] = df[name].fillna(0).to_numpy(dtype=np.int32)
+            for name in ['mid_price', 'profit_and_loss']:
+                if name in df.columns:
+                    columns[name] = df[name].to_numpy(dtype=np.float64)
+        elif kind == 'trades':
+            labels = sorted(df['symbol'].unique().tolist())
+            categories['symbol'] = labels
+            columns['symbol'] = pd.Categorical(df['symbol'], categories=labels).codes.astype(np.int16)
+            # buyer and seller share one set of counterparty labels so they can be compared by code
+            names = sorted(set(df['buyer'].tolist()) | set(df['seller'].tolist()))
+            categories['buyer'] = categories['seller'] = names
+            for name in ['buyer', 'seller']:
+                columns[name] = pd.Categorical(df[name], categories=names).codes.astype(np.int16)
+            price = df['price'].to_numpy(dtype=np.float64)
+            columns['price'] = price.astype(np.int32) if _integral(price) else price
+            columns['quantity'] = df['quantity'].to_numpy(dtype=np.int32)
+        else:
+            for name in OBSERVATION_FIELDS:
+                if name in df.columns:
+                    columns[name] = df[name].to_numpy(dtype=np.float64)
+        return columns, categories
+
+    def _convert(self, kind, paths, target, sources) -> dict:
+        reader = {'prices': read_prices, 'trades': read_trades, 'observations': read_observations}[kind]
+        df = reader(paths)
+        if kind != 'prices':
+            df = df.sort_values(['day', 'timestamp'], kind='stable').reset_index(drop=True)
+        columns, categories = self._typed_columns(kind, df)
+
+        # write next to the target and swap it in, a half written cache is never picked up
+        tmp = target + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, values in columns.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(values))
+        meta = {'version': CACHE_VERSION, 'sources': sources, 'columns': list(columns), 'categories': categories}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
+        return meta
+
+
+def load_prices(data_dir, round=None) -> pd.DataFrame:
+    """price frame of a round directory, read through the columnar cache"""
+    return MarketDataStore(data_dir, round).prices().to_frame()
+
+
+def load_trades(data_dir, round=None) -> pd.DataFrame:
+    """trade frame of a round directory, read through the columnar cache"""
+    return MarketDataStore(data_dir, round).trades().to_frame()
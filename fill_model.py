@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+
+def _segment_starts(segment):
+    # index of the first element of the segment of every element, segment sorted
+    starts = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]])
+    return starts[np.cumsum(np.r_[True, segment[1:] != segment[:-1]]) - 1]
+
+
+def passive_fills(group, side, price, quantity, ahead, trade_group, trade_price, trade_quantity,
+                  match_at_price: bool = True) -> np.ndarray:
+    """
+    quantity of every resting order filled by the market trades of its group, with price-time priority.
+
+    a group is one product at one tick, only the trades of the same group can fill an order. a buy at p gets the
+    volume of the trades below p (they went through its level) and, if match_at_price, the volume traded at p once
+    the `ahead` units queued in front of it are filled. sells are the mirror image. orders of the same group and side
+    are served best price first, then in the order they are given, so the trade volume is never used twice.
+    everything is array operations, a whole day of quotes is matched in one call.
+    Args:
+        group: int group of every order
+        side: 1 for a buy, -1 for a sell
+        price: order prices
+        quantity: positive order quantities
+        ahead: displayed volume in front of every order at its price
+        trade_group, trade_price, trade_quantity: market trades, positive quantities
+        match_at_price: let trades at exactly the order price fill it, otherwise only trades through it do
+    Returns:
+        np.ndarray: filled quantity of every order, int
+    Examples:
+    # one buy at 10 behind 5 lots, one sell at 12; trades of 8 at 10 and 3 at 13
+    passive_fills([0, 0], [1, -1], [10, 12], [4, 10], [5, 0], [0, 0], [10, 13], [8, 3])  # array([3, 3])
+    """
+    group, side = np.asarray(group, dtype=np.int64), np.asarray(side, dtype=np.int64)
+    price, quantity = np.asarray(price, dtype=float), np.asarray(quantity, dtype=np.int64)
+    ahead = np.asarray(ahead, dtype=float)
+    trade_group, trade_price = np.asarray(trade_group, dtype=np.int64), np.asarray(trade_price, dtype=float)
+    trade_quantity = np.asarray(trade_quantity, dtype=np.int64)
+    n = len(price)
+    res = np.zeros(n, dtype=np.int64)
+    if n == 0 or len(trade_price) == 0:
+        return res
+
+    # we key on (group, side) and flip the sell prices, a better price is then always a larger one and
+    # "through the order" always means a smaller trade price
+    key = group * 2 + (side < 0)
+    p = price * np.where(side < 0, -1, 1)
+    trade_key = np.r_[trade_group * 2, trade_group * 2 + 1]
+    tp = np.r_[trade_price, -trade_price]
+    tq = np.r_[trade_quantity, trade_quantity]
+
+    # one sortable integer per (key, price) pair, trade volume below or at a price is a slice of a cumulative sum
+    _, rank = np.unique(np.r_[tp, p], return_inverse=True)
+    width = rank.max() + 1
+    trade_code = trade_key * width + rank[:len(tp)]
+    order_code = key * width + rank[len(tp):]
+    order = np.argsort(trade_code, kind='stable')
+    trade_code = trade_code[order]
+    volume = np.r_[0, np.cumsum(tq[order])]
+    start = np.searchsorted(trade_code, key * width, 'left')
+    below = np.searchsorted(trade_code, order_code, 'left')
+    at = np.searchsorted(trade_code, order_code, 'right')
+    available = volume[below] - volume[start]
+    if match_at_price:
+        available += np.maximum(volume[at] - volume[below] - np.floor(ahead).astype(np.int64), 0)
+
+    # priority order inside every (group, side): best price first, then the given order. the volume available to an
+    # order never exceeds the one of the orders before it, so the cumulative fill is
+    # F_i = max_{j <= i} (Q_j + min(0, min_{k <= j} (available_k - Q_k))) with Q the cumulative quantity
+    priority = np.lexsort((np.arange(n), -p, key))
+    segment = key[priority]
+    starts = _segment_starts(segment)
+    segment_rank = np.cumsum(np.r_[0, segment[1:] != segment[:-1]])
+    q = quantity[priority]
+    cumulative = np.cumsum(q)
+    cumulative -= (cumulative - q)[starts]
+    slack = available[priority] - cumulative
+    big = int(np.abs(slack).max() + np.abs(cumulative).max()) * 2 + 1
+    slack = np.minimum.accumulate(slack - segment_rank * big) + segment_rank * big
+    filled = cumulative + np.minimum(slack, 0)
+    filled = np.maximum.accumulate(filled + segment_rank * big) - segment_rank * big
+    filled = np.maximum(filled, 0)
+    previous = np.r_[0, filled[:-1]]
+    previous[starts] = 0
+    res[priority] = filled - previous
+    return res
+
+
+class PassiveFillModel:
+    """
+    Fills resting orders against the market trades printed after them.
+
+    the backtester matches the orders of a tick against the displayed book first; what is left rests until the next
+    tick and is matched here against the market trades of the tick (the rows of the trade csv at that timestamp, which
+    the trader only sees in the next TradingState). an order placed at a price already displayed joins the queue
+    behind queue_ahead of the displayed volume, an order improving the book is at the front.
+    Args:
+        queue_ahead: share of the displayed volume at our price that is in front of us, 1 puts us behind all of it,
+            0 at the front of the queue
+        match_at_price: let trades at exactly our price fill us once the queue in front is filled, otherwise only
+            trades through our price do
+    Examples:
+    Backtester.from_directory(trader_cls, 'data/round1', fill_model=PassiveFillModel(queue_ahead=0.5)).run()
+    """
+
+    def __init__(self, queue_ahead: float = 1.0, match_at_price: bool = True):
+        if not 0 <= queue_ahead <= 1:
+            raise ValueError(f'queue_ahead must be between 0 and 1, got {queue_ahead}')
+        self.queue_ahead = queue_ahead
+        self.match_at_price = match_at_price
+
+    def fill(self, group, side, price, quantity, displayed, trade_group, trade_price, trade_quantity) -> np.ndarray:
+        """passive_fills with displayed the book volume at every order price (0 when the order improves the book)"""
+        ahead = self.queue_ahead * np.asarray(displayed, dtype=float)
+        return passive_fills(group, side, price, quantity, ahead, trade_group, trade_price, trade_quantity,
+                             self.match_at_price)
+
+    def match_frame(self, quotes: pd.DataFrame, trades: pd.DataFrame) -> pd.DataFrame:
+        """
+        open loop fills of a whole set of quotes, e.g. a day of best_bid + 1 / best_ask - 1 quotes.
+        Args:
+            quotes: day, timestamp, product, price, quantity (positive buy, negative sell) and optionally displayed
+                (book volume at the quote price) columns
+            trades: trade rows as returned by data_store.load_trades (day, timestamp, symbol, price, quantity)
+        Returns:
+            pd.DataFrame: quotes with a filled column, signed like quantity
+        """
+        keys = ['day', 'timestamp', 'product']
+        trade_keys = trades.rename(columns={'symbol': 'product'})[keys]
+        codes, _ = pd.MultiIndex.from_frame(pd.concat([quotes[keys], trade_keys], ignore_index=True)).factorize()
+        quantity = quotes['quantity'].to_numpy()
+        displayed = quotes['displayed'].to_numpy() if 'displayed' in quotes.columns else np.zeros(len(quotes))
+        filled = self.fill(codes[:len(quotes)], np.sign(quantity), quotes['price'].to_numpy(), np.abs(quantity),
+                           displayed, codes[len(quotes):], trades['price'].to_numpy(), trades['quantity'].to_numpy())
+        return quotes.assign(filled=filled * np.sign(quantity))
@@ -1,20 +1,311 @@
-from datamodel import OrderDepth, UserId, TradingState, Order
-from typing import List
-import string
-import jsonpickle
+import base64
+import struct
+
+from datamodel import ConversionObservation, Listing, Observation, OrderDepth, Trade, TradingState
+
+CAPTURE_PREFIX = 'CAPTURE:'
+MAX_LOG_LENGTH = 3750  # characters of lambdaLog the sandbox keeps per tick
+KEYFRAME_INTERVAL = 100  # ticks between two keyframes
+PRICE_LEVELS = 3  # levels of a book side kept when a record does not fit even without its trades, as in the csv files
+
+FLOAT = struct.Struct('<d')
+CONVERSION_FIELDS = ['bidPrice', 'askPrice', 'transportFees', 'exportTariff', 'importTariff', 'sunlight', 'humidity']
+
+
+def write_varint(out: bytearray, value: int):
+    # unsigned LEB128, 7 bits per byte
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def write_signed(out: bytearray, value: int):
+    # zigzag, small negative numbers stay short
+    write_varint(out, (value << 1) ^ (value >> 63))
+
+
+class Reader:
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def varint(self) -> int:
+        value, shift = 0, 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def signed(self) -> int:
+        value = self.varint()
+        return (value >> 1) ^ -(value & 1)
+
+    def float(self) -> float:
+        value, = FLOAT.unpack_from(self.data, self.pos)
+        self.pos += FLOAT.size
+        return value
+
+    def string(self) -> str:
+        length = self.varint()
+        self.pos += length
+        return self.data[self.pos - length:self.pos].decode()
+
+
+class CaptureCodec:
+    """
+    Packs a whole TradingState into one base85 line of at most MAX_LOG_LENGTH characters.
+
+    record: version, flags (1 keyframe, 2 trades dropped), timestamp, base timestamp (deltas only), new strings,
+    listings (keyframes only), books, positions, conversion and plain observations, own trades, market trades.
+    every symbol and counterparty name is an index in a string table that is rebuilt at every keyframe, so a name
+    costs one byte after its first tick. the best bid and ask are stored relative to those of the previous tick
+    (keyframes: absolute), deeper levels as the gap to the level above, trade prices relative to the best bid and
+    trade timestamps relative to the tick. when the record would not fit, the trades are dropped for that tick, and
+    if it still does not fit the books are cut to PRICE_LEVELS levels a side. price keys may be numbers or numeric
+    strings, as in the pickled tutorial states. the encoder and decode keep the string table and the previous best
+    prices, decode returns None after a missing or malformed (e.g. truncated) tick until the next keyframe.
+    Examples:
+    codec = CaptureCodec()
+    print(codec.encode(state))  # in Trader.run
+    CaptureCodec().decode(line)  # TradingState, lines fed in tick order
+    """
+    VERSION = 1
+    KEYFRAME = 1
+    TRADES_DROPPED = 2
+    BOOKS_TRUNCATED = 4
+
+    def __init__(self, keyframe_interval: int = KEYFRAME_INTERVAL, max_length: int = MAX_LOG_LENGTH):
+        self.keyframe_interval = keyframe_interval
+        self.max_length = max_length
+        self.strings = []
+        self.string_index = {}
+        self.best = {}  # {symbol: (best bid, best ask)} of the previous tick
+        self.listings = {}  # decode only, the listings of the last keyframe
+        self.timestamp = None
+        self.ticks_since_keyframe = 0
+
+    def encode(self, state: TradingState) -> str:
+        keyframe = self.timestamp is None or self.ticks_since_keyframe + 1 >= self.keyframe_interval
+        line, strings, best = self._encode(state, keyframe, True)
+        if len(line) > self.max_length:
+            line, strings, best = self._encode(state, keyframe, False)
+        if len(line) > self.max_length:
+            line, strings, best = self._encode(state, keyframe, False, PRICE_LEVELS)
+        self.strings, self.best, self.timestamp = strings, best, state.timestamp
+        self.string_index = {s: i for i, s in enumerate(strings)}
+        self.ticks_since_keyframe = 0 if keyframe else self.ticks_since_keyframe + 1
+        return line
+
+    def _encode(self, state: TradingState, keyframe: bool, with_trades: bool, max_levels: int = None):
+        # nothing is committed here, encode keeps the tables of the record it prints
+        strings = [] if keyframe else list(self.strings)
+        index = {} if keyframe else dict(self.string_index)
+        new_strings = []
+
+        def string_id(value) -> int:
+            value = '' if value is None else str(value)
+            if value not in index:
+                index[value] = len(strings)
+                strings.append(value)
+                new_strings.append(value)
+            return index[value]
+
+        body = bytearray()
+        best = {}
+        if keyframe:
+            write_varint(body, len(state.listings))
+            for symbol, listing in state.listings.items():
+                for value in (symbol, _field(listing, 'product'), _field(listing, 'denomination')):
+                    write_varint(body, string_id(value))
+
+        write_varint(body, len(state.order_depths))
+        for symbol, depth in state.order_depths.items():
+            write_varint(body, string_id(symbol))
+            previous = (None, None) if keyframe else self.best.get(symbol, (None, None))
+            sides = [sorted(((_price(price), volume) for price, volume in depth.buy_orders.items()), reverse=True),
+                     sorted((_price(price), volume) for price, volume in depth.sell_orders.items())]
+            for side, levels, reference in zip((1, -1), sides, previous):
+                levels = levels[:max_levels]
+                write_varint(body, len(levels))
+                last = None
+                for price, volume in levels:
+                    if last is None:
+                        write_signed(body, price - (reference or 0))
+                    else:
+                        write_varint(body, (last - price) * side)
+                    write_varint(body, abs(int(volume)))
+                    last = price
+            best[symbol] = (sides[0][0][0] if sides[0] else None, sides[1][0][0] if sides[1] else None)
+
+        write_varint(body, len(state.position))
+        for symbol, position in state.position.items():
+            write_varint(body, string_id(symbol))
+            write_signed(body, int(position))
+
+        observations = state.observations
+        conversions = observations.conversionObservations if observations else {}
+        write_varint(body, len(conversions))
+        for product, obs in conversions.items():
+            write_varint(body, string_id(product))
+            for field in CONVERSION_FIELDS:
+                body += FLOAT.pack(getattr(obs, field))
+        plain = observations.plainValueObservations if observations else {}
+        write_varint(body, len(plain))
+        for product, value in plain.items():
+            write_varint(body, string_id(product))
+            body += FLOAT.pack(value)
+
+        if with_trades:
+            for trades in (state.own_trades, state.market_trades):
+                trades = [trade for symbol_trades in trades.values() for trade in symbol_trades]
+                write_varint(body, len(trades))
+                for trade in trades:
+                    reference = best.get(trade.symbol, (None, None))[0]
+                    write_varint(body, string_id(trade.symbol))
+                    write_signed(body, _price(trade.price) - (reference or 0))
+                    write_varint(body, abs(int(trade.quantity)))
+                    write_varint(body, string_id(trade.buyer))
+                    write_varint(body, string_id(trade.seller))
+                    write_signed(body, state.timestamp - trade.timestamp)
+
+        flags = (self.KEYFRAME if keyframe else 0) | (0 if with_trades else self.TRADES_DROPPED) | \
+            (0 if max_levels is None else self.BOOKS_TRUNCATED)
+        head = bytearray([self.VERSION, flags])
+        write_varint(head, state.timestamp)
+        if not keyframe:
+            write_varint(head, self.timestamp)
+        write_varint(head, len(new_strings))
+        for value in new_strings:
+            raw = value.encode()
+            write_varint(head, len(raw))
+            head += raw
+        line = CAPTURE_PREFIX + base64.b85encode(bytes(head + body)).decode()
+        return line, strings, best
+
+    @staticmethod
+    def is_keyframe(line: str) -> bool:
+        """False for a malformed line as well"""
+        try:
+            return bool(base64.b85decode(line[len(CAPTURE_PREFIX):])[1] & CaptureCodec.KEYFRAME)
+        except (ValueError, IndexError):
+            return False
+
+    def decode(self, line: str):
+        """
+        TradingState of a line printed by encode, None if it cannot be rebuilt from the lines decoded so far or is
+        malformed, e.g. cut by the sandbox. the deltas after a malformed line are None until the next keyframe.
+        """
+        try:
+            reader = Reader(base64.b85decode(line.strip()[len(CAPTURE_PREFIX):]))
+            version = reader.data[0]
+        except (ValueError, IndexError):
+            self.timestamp = None
+            return None
+        if version != self.VERSION:
+            raise ValueError(f'unknown capture version {version}')
+        try:
+            return self._decode(reader)
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+            self.timestamp = None
+            return None
+
+    def _decode(self, reader: Reader):
+        flags = reader.data[1]
+        reader.pos = 2
+        keyframe = bool(flags & self.KEYFRAME)
+        timestamp = reader.varint()
+        if keyframe:
+            self.strings, self.listings = [], {}
+        elif self.timestamp is None or reader.varint() != self.timestamp:
+            self.timestamp = None
+            return None
+        self.strings += [reader.string() for _ in range(reader.varint())]
+        strings = self.strings
+
+        if keyframe:
+            for _ in range(reader.varint()):
+                symbol, product, denomination = [strings[reader.varint()] for _ in range(3)]
+                self.listings[symbol] = Listing(symbol, product, denomination)
+
+        order_depths, best = {}, {}
+        for _ in range(reader.varint()):
+            symbol = strings[reader.varint()]
+            previous = (None, None) if keyframe else self.best.get(symbol, (None, None))
+            sides = []
+            for side, reference in zip((1, -1), previous):
+                levels, last = {}, None
+                for _ in range(reader.varint()):
+                    price = (reference or 0) + reader.signed() if last is None else last - side * reader.varint()
+                    levels[price] = reader.varint() * side
+                    last = price
+                sides.append(levels)
+            order_depths[symbol] = OrderDepth(*sides)
+            best[symbol] = (next(iter(sides[0]), None), next(iter(sides[1]), None))
+
+        position = {}
+        for _ in range(reader.varint()):
+            symbol = strings[reader.varint()]
+            position[symbol] = reader.signed()
+
+        conversions = {}
+        for _ in range(reader.varint()):
+            product = strings[reader.varint()]
+            conversions[product] = ConversionObservation(*[reader.float() for _ in CONVERSION_FIELDS])
+        plain = {}
+        for _ in range(reader.varint()):
+            product = strings[reader.varint()]
+            plain[product] = reader.float()
+
+        own_trades, market_trades = {}, {}
+        if not flags & self.TRADES_DROPPED:
+            for trades in (own_trades, market_trades):
+                for _ in range(reader.varint()):
+                    symbol = strings[reader.varint()]
+                    price = best.get(symbol, (None, None))[0] or 0
+                    price += reader.signed()
+                    quantity = reader.varint()
+                    buyer, seller = strings[reader.varint()], strings[reader.varint()]
+                    trades.setdefault(symbol, []).append(
+                        Trade(symbol, price, quantity, buyer, seller, timestamp - reader.signed()))
+
+        self.timestamp, self.best = timestamp, best
+        return TradingState('', timestamp, dict(self.listings), order_depths, own_trades, market_trades, position,
+                            Observation(plain, conversions))
+
+
+def _price(price) -> int:
+    # the pickled tutorial states have str price keys
+    return int(float(price)) if isinstance(price, str) else int(price)
+
+
+def _field(listing, name):
+    # datamodel.Listing in the sandbox, a plain dict in some local states
+    return listing[name] if isinstance(listing, dict) else getattr(listing, name)
+
 
 class Trader:
+    """
+    prints the whole TradingState of every tick in CaptureCodec lines, log_parser.iter_states decodes them and
+    log_parser.export_round_data writes them out as round csv files
+    """
+
+    def __init__(self):
+        self.codec = CaptureCodec()
 
     def run(self, state: TradingState):
 
         # Orders to be placed on exchange matching engine
         result = {}
 
-        # It will be delivered as TradingState.traderData on next execution.
-
-        print(state.market_trades)
+        print(self.codec.encode(state))
 
+        # It will be delivered as TradingState.traderData on next execution.
         traderData = ""
         # Sample conversion request. Check more details below.
         conversions = 1
-        return result, conversions, traderData
\ No newline at end of file
+        return result, conversions, traderData
@@ -0,0 +1,433 @@
+import json
+import os
+
+import pandas as pd
+
+from data_store import LEVEL_COLUMNS, OBSERVATION_FIELDS, PRICE_LEVELS
+from datamodel import ConversionObservation, Observation, OrderDepth, Trade, TradingState
+from get_data_trader import CAPTURE_PREFIX, CaptureCodec
+
+SANDBOX_HEADER = b'Sandbox logs:'
+ACTIVITIES_HEADER = b'Activities log:'
+TRADES_HEADER = b'Trade History:'
+
+
+class SandboxEntry:
+
+    def __init__(self, timestamp: int, sandbox_log: str, lambda_log: str, offset: int):
+        self.timestamp = timestamp
+        self.sandbox_log = sandbox_log
+        self.lambda_log = lambda_log  # raw text printed by the trader during this tick
+        self.offset = offset  # byte offset of the entry in the log file
+
+    @property
+    def state(self):
+        """
+        TradingState printed in lambdaLog (jsonpickle or Logger format), None if the tick printed something else.
+        the delta lines of a compact Logger need the ticks before them, see iter_states and read_state
+        """
+        return decode_lambda_log(self.lambda_log)
+
+    @property
+    def is_keyframe(self) -> bool:
+        """True for a line of a compact Logger or of get_data_trader that holds the full books"""
+        if _is_capture(self.lambda_log):
+            return CaptureCodec.is_keyframe(self.lambda_log.strip())
+        raw = parse_lambda_log(self.lambda_log)
+        return _is_compact(raw) and raw[0][2] == 'K'
+
+    @property
+    def needs_history(self) -> bool:
+        """True for a delta line, which only decodes after the ticks before it"""
+        if _is_capture(self.lambda_log):
+            return not self.is_keyframe
+        raw = parse_lambda_log(self.lambda_log)
+        return _is_compact(raw) and raw[0][2] == 'D'
+
+
+class Activity:
+
+    def __init__(self, day: int, timestamp: int, product: str, buy_orders: dict, sell_orders: dict,
+                 mid_price: float, profit_and_loss: float):
+        self.day = day
+        self.timestamp = timestamp
+        self.product = product
+        self.buy_orders = buy_orders
+        self.sell_orders = sell_orders  # negative volumes, as in OrderDepth
+        self.mid_price = mid_price
+        self.profit_and_loss = profit_and_loss
+
+    def order_depth(self) -> OrderDepth:
+        return OrderDepth(dict(self.buy_orders), dict(self.sell_orders))
+
+
+def _levels(raw) -> dict:
+    # json object keys are strings, the exchange sends int prices. jsonpickle adds 'py/object' and '__dict__' keys
+    # when a side is a dict subclass such as order_book.SortedLevels
+    return {int(price): volume for price, volume in raw.items() if price.lstrip('-').isdigit()}
+
+
+def _order_depth(raw) -> OrderDepth:
+    return OrderDepth(_levels(raw['buy_orders']), _levels(raw['sell_orders']))
+
+
+def _trade(raw) -> Trade:
+    return Trade(raw['symbol'], raw['price'], raw['quantity'], raw.get('buyer', ''), raw.get('seller', ''),
+                 raw.get('timestamp', 0))
+
+
+def _conversion_observation(raw) -> ConversionObservation:
+    return ConversionObservation(raw['bidPrice'], raw['askPrice'], raw['transportFees'], raw['exportTariff'],
+                                 raw['importTariff'], raw['sunlight'], raw['humidity'])
+
+
+def state_from_dict(raw) -> TradingState:
+    """
+    build a TradingState from a jsonpickle encoded state that was already parsed by json.loads.
+    the py/object tags are ignored, every field has a fixed type so no reflection is needed.
+    """
+    observations = raw.get('observations') or {}
+    return TradingState(
+        raw.get('traderData', ''),
+        raw['timestamp'],
+        raw.get('listings', {}),
+        {symbol: _order_depth(depth) for symbol, depth in raw.get('order_depths', {}).items()},
+        {symbol: [_trade(t) for t in trades] for symbol, trades in raw.get('own_trades', {}).items()},
+        {symbol: [_trade(t) for t in trades] for symbol, trades in raw.get('market_trades', {}).items()},
+        raw.get('position', {}),
+        Observation(observations.get('plainValueObservations', {}),
+                    {product: _conversion_observation(obs)
+                     for product, obs in observations.get('conversionObservations', {}).items()}),
+    )
+
+
+def state_from_compressed(compressed) -> TradingState:
+    """build a TradingState from the compress_state list written by logger.Logger"""
+    timestamp, trader_data, listings, order_depths, own_trades, market_trades, position, observations = compressed
+
+    def trades(rows):
+        res = {}
+        for symbol, price, quantity, buyer, seller, trade_timestamp in rows:
+            res.setdefault(symbol, []).append(Trade(symbol, price, quantity, buyer, seller, trade_timestamp))
+        return res
+
+    plain, conversion = observations
+    return TradingState(
+        trader_data,
+        timestamp,
+        {symbol: {'symbol': symbol, 'product': product, 'denomination': denomination}
+         for symbol, product, denomination in listings},
+        {symbol: _order_depth({'buy_orders': depth[0], 'sell_orders': depth[1]})
+         for symbol, depth in order_depths.items()},
+        trades(own_trades),
+        trades(market_trades),
+        position,
+        Observation(plain, {product: ConversionObservation(*values) for product, values in conversion.items()}),
+    )
+
+
+class CompactStateDecoder:
+    """
+    Rebuilds the full TradingState of every tick from the lines of a compact logger.Logger, fed in tick order.
+
+    a keyframe resets the books, positions and listings, a delta line is applied to the state of the previous tick.
+    a delta whose base timestamp is not the last decoded tick (a line is missing) gives None until the next keyframe.
+    """
+
+    def __init__(self):
+        self.timestamp = None
+        self.listings = []
+        self.books = {}  # {symbol: [buy_orders, sell_orders]} with the str prices of the json lines
+        self.position = {}
+
+    def decode(self, compressed):
+        """TradingState of the state part of a compact line, None if it cannot be rebuilt"""
+        timestamp, trader_data, kind, base, listings, books, own_trades, market_trades, position, observations = \
+            compressed
+        if kind == 'K':
+            self.listings = listings
+            self.books = {}
+            self.position = {}
+        elif self.timestamp is None or base != self.timestamp:
+            self.timestamp = None
+            return None
+        for symbol, sides in books.items():
+            if sides is None:
+                self.books.pop(symbol, None)
+                continue
+            book = self.books.setdefault(symbol, [{}, {}])
+            for i, levels in enumerate(sides):
+                for price, volume in levels.items():
+                    if volume == 0:
+                        book[i].pop(price, None)
+                    else:
+                        book[i][price] = volume
+                # the exchange sends the best level first
+                book[i] = dict(sorted(book[i].items(), key=lambda level: -int(level[0]) if i == 0 else int(level[0])))
+        for symbol, value in position.items():
+            if value is None:
+                self.position.pop(symbol, None)
+            else:
+                self.position[symbol] = value
+        self.timestamp = timestamp
+        return state_from_compressed([timestamp, trader_data, self.listings, self.books, own_trades, market_trades,
+                                      dict(self.position), observations])
+
+
+def parse_lambda_log(lambda_log: str):
+    """json value printed in a lambdaLog, None if it is not json"""
+    text = lambda_log.strip()
+    if not text.startswith(('{', '[')):
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def _is_capture(lambda_log: str) -> bool:
+    return lambda_log.lstrip().startswith(CAPTURE_PREFIX)
+
+
+class StateDecoder:
+    """decodes the lambdaLogs of a run in tick order, keeping the state of the delta encoded formats"""
+
+    def __init__(self):
+        self.compact = CompactStateDecoder()
+        self.capture = CaptureCodec()
+
+    def decode(self, lambda_log: str):
+        return decode_lambda_log(lambda_log, self)
+
+
+def _is_compact(raw) -> bool:
+    return isinstance(raw, list) and bool(raw) and isinstance(raw[0], list) and len(raw[0]) == 10 and \
+        raw[0][2] in ('K', 'D')
+
+
+def decode_lambda_log(lambda_log: str, decoder: StateDecoder = None):
+    """
+    TradingState printed in a lambdaLog, by jsonpickle.encode(state), logger.Logger.flush or get_data_trader.
+    Args:
+        lambda_log: text printed during the tick
+        decoder: decoder of the previous ticks for the delta lines of a compact Logger or get_data_trader. without it
+            only keyframes decode
+    """
+    decoder = decoder if decoder is not None else StateDecoder()
+    if _is_capture(lambda_log):
+        return decoder.capture.decode(lambda_log)
+    raw = parse_lambda_log(lambda_log)
+    if isinstance(raw, dict) and 'order_depths' in raw:
+        return state_from_dict(raw)
+    if isinstance(raw, list) and raw and isinstance(raw[0], list) and len(raw[0]) == 8:
+        return state_from_compressed(raw[0])
+    if _is_compact(raw):
+        return decoder.compact.decode(raw[0])
+    return None
+
+
+def _activity(line: bytes) -> Activity:
+    fields = line.decode().rstrip('\r\n').split(';')
+    day, timestamp, product = int(fields[0]), int(fields[1]), fields[2]
+    buy_orders, sell_orders = {}, {}
+    for i in range(3):
+        bid_price, bid_volume = fields[3 + 2 * i], fields[4 + 2 * i]
+        ask_price, ask_volume = fields[9 + 2 * i], fields[10 + 2 * i]
+        if bid_price:
+            buy_orders[int(float(bid_price))] = int(float(bid_volume))
+        if ask_price:
+            sell_orders[int(float(ask_price))] = -int(float(ask_volume))
+    mid_price = float(fields[15]) if fields[15] else float('nan')
+    return Activity(day, timestamp, product, buy_orders, sell_orders, mid_price, float(fields[16] or 0))
+
+
+def iter_log(path):
+    """
+    single pass over a sandbox .log file, reading one line at a time.
+    Args:
+        path: path of the .log file
+    Yields:
+        tuple: ('sandbox', SandboxEntry), ('activity', Activity) or ('trade', Trade), in file order
+    """
+    section = None
+    block, block_offset, depth = [], 0, 0
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            line_offset = offset
+            offset += len(line)
+            stripped = line.strip()
+            if not block:
+                if stripped == SANDBOX_HEADER:
+                    section = 'sandbox'
+                    continue
+                if stripped == ACTIVITIES_HEADER:
+                    section = 'activities_header'
+                    continue
+                if stripped == TRADES_HEADER:
+                    section = 'trades'
+                    continue
+                if not stripped:
+                    continue
+
+            if section == 'activities_header':
+                # the first line of the section is the csv header
+                section = 'activities'
+            elif section == 'activities':
+                yield 'activity', _activity(line)
+            elif section in ('sandbox', 'trades'):
+                if not block:
+                    if stripped in (b'[', b']') or not stripped.startswith(b'{'):
+                        continue
+                    block_offset = line_offset
+                block.append(line)
+                # neither the sandbox entries nor the trades nest objects across lines, we only count braces
+                # outside of the escaped lambdaLog line
+                if not stripped.startswith(b'"lambdaLog"') and not stripped.startswith(b'"sandboxLog"'):
+                    depth += stripped.count(b'{') - stripped.count(b'}')
+                if depth == 0:
+                    raw = json.loads(b''.join(block).strip().rstrip(b','))
+                    block = []
+                    if section == 'sandbox':
+                        yield 'sandbox', SandboxEntry(raw['timestamp'], raw.get('sandboxLog', ''),
+                                                      raw.get('lambdaLog', ''), block_offset)
+                    else:
+                        yield 'trade', _trade(raw)
+
+
+def iter_states(path):
+    """TradingState of every tick of a sandbox log, ticks whose lambdaLog is not a state are skipped"""
+    decoder = StateDecoder()
+    for kind, record in iter_log(path):
+        if kind == 'sandbox':
+            state = decoder.decode(record.lambda_log)
+            if state is not None:
+                yield state
+        else:
+            # the sandbox section always comes first
+            return
+
+
+def iter_activities(path):
+    for kind, record in iter_log(path):
+        if kind == 'activity':
+            yield record
+
+
+def iter_trades(path):
+    for kind, record in iter_log(path):
+        if kind == 'trade':
+            yield record
+
+
+def build_index(path) -> dict:
+    """
+    byte offset of the sandbox entry of every timestamp, {timestamp: offset}.
+    only the '{' and '"timestamp"' lines are looked at, lambdaLog is never decoded.
+    """
+    index = {}
+    offset, entry_offset = 0, None
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'{'):
+                entry_offset = offset
+            elif entry_offset is not None and line.lstrip().startswith(b'"timestamp"'):
+                index[int(line.split(b':', 1)[1].strip().rstrip(b','))] = entry_offset
+                entry_offset = None
+            elif line.startswith((ACTIVITIES_HEADER, TRADES_HEADER)):
+                break
+            offset += len(line)
+    return index
+
+
+def read_entry(path, timestamp, index: dict = None) -> SandboxEntry:
+    """
+    read the sandbox entry of one timestamp by seeking to it.
+    Args:
+        path: path of the .log file
+        timestamp: timestamp of the tick
+        index: result of build_index(path), built on the fly if not given
+    Returns:
+        SandboxEntry
+    """
+    index = index if index is not None else build_index(path)
+    offset = index[timestamp]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        lines = []
+        for line in f:
+            lines.append(line)
+            if line.startswith(b'}'):
+                break
+    raw = json.loads(b''.join(lines))
+    return SandboxEntry(raw['timestamp'], raw.get('sandboxLog', ''), raw.get('lambdaLog', ''), offset)
+
+
+def read_state(path, timestamp, index: dict = None):
+    """
+    TradingState of one timestamp, read by seeking to its sandbox entry.
+    a delta line of a compact Logger or get_data_trader is rebuilt from the keyframe before it.
+    """
+    index = index if index is not None else build_index(path)
+    entry = read_entry(path, timestamp, index)
+    if not entry.needs_history:
+        return entry.state
+    timestamps = sorted(t for t in index if t <= timestamp)
+    entries = [entry]
+    for previous in reversed(timestamps[:-1]):
+        entries.append(read_entry(path, previous, index))
+        if entries[-1].is_keyframe:
+            break
+    decoder = StateDecoder()
+    state = None
+    for entry in reversed(entries):
+        state = decoder.decode(entry.lambda_log)
+    return state
+
+
+def export_round_data(path, out_dir, round: int, day: int) -> list:
+    """
+    write the states of a sandbox log (e.g. a get_data_trader run) as round csv files that data_store and the
+    backtester load: prices_round_<round>_day_<day>.csv with the PRICE_LEVELS best levels of every book,
+    trades_round_<round>_day_<day>_wn.csv with the market trades and their counterparties, and
+    observations_round_<round>_day_<day>.csv when the states have conversion observations.
+    Returns:
+        list: paths of the written files
+    """
+    prices, trades, observations = [], [], []
+    for state in iter_states(path):
+        for product, depth in state.order_depths.items():
+            row = {'day': day, 'timestamp': state.timestamp, 'product': product}
+            bids = sorted(depth.buy_orders.items(), reverse=True)[:PRICE_LEVELS]
+            asks = sorted(depth.sell_orders.items())[:PRICE_LEVELS]
+            for side, levels in (('bid', bids), ('ask', asks)):
+                for i, (price, volume) in enumerate(levels, 1):
+                    row[f'{side}_price_{i}'] = price
+                    row[f'{side}_volume_{i}'] = abs(volume)
+            best = [levels[0][0] for levels in (bids, asks) if levels]
+            row['mid_price'] = sum(best) / len(best) if best else float('nan')
+            row['profit_and_loss'] = 0.0
+            prices.append(row)
+        for symbol_trades in state.market_trades.values():
+            for trade in symbol_trades:
+                trades.append({'timestamp': trade.timestamp, 'buyer': trade.buyer, 'seller': trade.seller,
+                               'symbol': trade.symbol, 'currency': 'SEASHELLS', 'price': trade.price,
+                               'quantity': trade.quantity})
+        for obs in state.observations.conversionObservations.values():
+            observations.append({'timestamp': state.timestamp, **{f: getattr(obs, f) for f in OBSERVATION_FIELDS}})
+
+    os.makedirs(out_dir, exist_ok=True)
+    files = []
+    price_path = os.path.join(out_dir, f'prices_round_{round}_day_{day}.csv')
+    pd.DataFrame(prices, columns=['day', 'timestamp', 'product'] + LEVEL_COLUMNS + ['mid_price', 'profit_and_loss']
+                 ).to_csv(price_path, sep=';', index=False)
+    files.append(price_path)
+    trade_path = os.path.join(out_dir, f'trades_round_{round}_day_{day}_wn.csv')
+    pd.DataFrame(trades, columns=['timestamp', 'buyer', 'seller', 'symbol', 'currency', 'price', 'quantity']
+                 ).to_csv(trade_path, sep=';', index=False)
+    files.append(trade_path)
+    if observations:
+        observation_path = os.path.join(out_dir, f'observations_round_{round}_day_{day}.csv')
+        pd.DataFrame(observations, columns=['timestamp'] + OBSERVATION_FIELDS).to_csv(observation_path, index=False)
+        files.append(observation_path)
+    return files
@@ -3,34 +3,53 @@ from datamodel import Listing, Observation, Order, OrderDepth, ProsperityEncoder
 from typing import Any
 
 class Logger:
-    def __init__(self) -> None:
-        self.logs = ""
+    """
+    Prints one line per tick in the format of the jmerle visualizer: the compressed state, orders, conversions,
+    traderData and the prints of the tick, with the three strings truncated to fit max_log_length.
+
+    with compact=True the books and positions are only sent when they change: the state part of the line is
+    [timestamp, traderData, "K" or "D", base timestamp, listings, books, own trades, market trades, position,
+    observations]. a "K" keyframe holds the full books, positions and listings; a "D" line only holds the levels and
+    positions that changed since the tick at base timestamp, with 0 volume for a removed level and null for a removed
+    symbol. a keyframe is sent every keyframe_interval ticks and whenever the previous tick is unknown (e.g. a fresh
+    Logger). log_parser.CompactStateDecoder rebuilds the full states, the visualizer only reads the normal format.
+    """
+
+    def __init__(self, compact: bool = False, keyframe_interval: int = 100) -> None:
+        self.log_parts: list[str] = []
         self.max_log_length = 3750
+        self.compact = compact
+        self.keyframe_interval = keyframe_interval
+        self.previous_timestamp = None
+        self.previous_books: dict[Symbol, list[dict]] = {}
+        self.previous_position: dict[Symbol, int] = {}
+        self.ticks_since_keyframe = 0
+
+    @property
+    def logs(self) -> str:
+        return "".join(self.log_parts)
 
     def print(self, *objects: Any, sep: str = " ", end: str = "\n") -> None:
-        self.logs += sep.join(map(str, objects)) + end
+        self.log_parts.append(sep.join(map(str, objects)) + end)
 
     def flush(self, state: TradingState, orders: dict[Symbol, list[Order]], conversions: int, trader_data: str) -> None:
-        base_length = len(self.to_json([
-            self.compress_state(state, ""),
-            self.compress_orders(orders),
-            conversions,
-            "",
-            "",
-        ]))
+        # the fixed part of the line is serialized once, the three truncated strings are spliced into it. the result
+        # is the same as to_json([compress_state(state, truncated traderData), orders, conversions, trader_data, logs])
+        compressed = self.compress_compact_state(state, "") if self.compact else self.compress_state(state, "")
+        head = "[[" + self.to_json(compressed[0]) + ","
+        middle = "," + ",".join(self.to_json(value) for value in compressed[2:]) + "]," + \
+                 self.to_json(self.compress_orders(orders)) + "," + self.to_json(conversions) + ","
+        # each of the three strings is "" in the base length
+        base_length = len(head) + len(middle) + len(",]") + 3 * len('""')
 
         # We truncate state.traderData, trader_data, and self.logs to the same max. length to fit the log limit
         max_item_length = (self.max_log_length - base_length) // 3
 
-        print(self.to_json([
-            self.compress_state(state, self.truncate(state.traderData, max_item_length)),
-            self.compress_orders(orders),
-            conversions,
-            self.truncate(trader_data, max_item_length),
-            self.truncate(self.logs, max_item_length),
-        ]))
+        print(head + self.to_json(self.truncate(state.traderData, max_item_length)) + middle +
+              self.to_json(self.truncate(trader_data, max_item_length)) + "," +
+              self.to_json(self.truncate(self.logs, max_item_length)) + "]")
 
-        self.logs = ""
+        self.log_parts = []
 
     def compress_state(self, state: TradingState, trader_data: str) -> list[Any]:
         return [
@@ -44,6 +63,49 @@ class Logger:
             self.compress_observations(state.observations),
         ]
 
+    def compress_compact_state(self, state: TradingState, trader_data: str) -> list[Any]:
+        books = {symbol: [dict(order_depth.buy_orders), dict(order_depth.sell_orders)]
+                 for symbol, order_depth in state.order_depths.items()}
+        keyframe = self.previous_timestamp is None or self.ticks_since_keyframe + 1 >= self.keyframe_interval
+        if keyframe:
+            compressed = [state.timestamp, trader_data, "K", None, self.compress_listings(state.listings), books,
+                          self.compress_trades(state.own_trades), self.compress_trades(state.market_trades),
+                          state.position, self.compress_observations(state.observations)]
+            self.ticks_since_keyframe = 0
+        else:
+            compressed = [state.timestamp, trader_data, "D", self.previous_timestamp, [],
+                          self.diff_books(self.previous_books, books),
+                          self.compress_trades(state.own_trades), self.compress_trades(state.market_trades),
+                          self.diff_levels(self.previous_position, state.position, None),
+                          self.compress_observations(state.observations)]
+            self.ticks_since_keyframe += 1
+        self.previous_timestamp = state.timestamp
+        self.previous_books = books
+        self.previous_position = dict(state.position)
+        return compressed
+
+    @staticmethod
+    def diff_levels(previous: dict, current: dict, removed: Any = 0) -> dict:
+        """{key: value} of the keys of current that are new or changed, and {key: removed} of the dropped keys"""
+        diff = {key: value for key, value in current.items() if previous.get(key) != value}
+        for key in previous:
+            if key not in current:
+                diff[key] = removed
+        return diff
+
+    def diff_books(self, previous: dict[Symbol, list[dict]], current: dict[Symbol, list[dict]]) -> dict[Symbol, Any]:
+        diff = {}
+        for symbol, (buy_orders, sell_orders) in current.items():
+            previous_buy, previous_sell = previous.get(symbol, ({}, {}))
+            buy_diff = self.diff_levels(previous_buy, buy_orders)
+            sell_diff = self.diff_levels(previous_sell, sell_orders)
+            if buy_diff or sell_diff:
+                diff[symbol] = [buy_diff, sell_diff]
+        for symbol in previous:
+            if symbol not in current:
+                diff[symbol] = None
+        return diff
+
     def compress_listings(self, listings: dict[Symbol, Listing]) -> list[list[Any]]:
         compressed = []
         for listing in listings.values():
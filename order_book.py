@@ -0,0 +1,241 @@
+from bisect import bisect_left
+from numbers import Real
+
+from datamodel import OrderDepth
+
+
+def _orderable(price) -> bool:
+    return isinstance(price, Real) and not isinstance(price, bool)
+
+
+def _restored_price(price):
+    # jsonpickle writes every dict key as a string, numeric ones become prices again
+    if isinstance(price, str):
+        try:
+            return int(price)
+        except ValueError:
+            try:
+                return float(price)
+            except ValueError:
+                pass
+    return price
+
+
+class SortedLevels(dict):
+    """
+    {price: volume} of one side of an order book, always iterated best price first.
+
+    the prices are also kept in a sorted list (negated for bids, so best first is ascending in both cases), which
+    gives O(1) best/worst price and O(log n) position lookups. it is a real dict, so json, ProsperityEncoder and code
+    indexing or iterating buy_orders/sell_orders keep working, and list(levels)[0] is the best price.
+    changing the volume of an existing price or removing a price is O(1) on the dict plus a list delete, inserting a
+    new price in the middle of the book rebuilds the dict to keep its iteration order.
+    keys that are not numbers (some traders write str(price) into the books they are given) are stored as in a plain
+    dict, after the prices, and are ignored by the best/worst/level/walk helpers.
+    every dict method that adds keys goes through __setitem__, and popitem removes the last level of the iteration
+    order as for a dict, i.e. the worst price when every key is a number.
+    """
+
+    def __init__(self, levels=(), reverse=False):
+        self.sign = -1 if reverse else 1
+        self._rebuild(dict(levels))
+
+    def _rebuild(self, levels: dict):
+        items = sorted(((price, volume) for price, volume in levels.items() if _orderable(price)),
+                       key=lambda item: item[0] * self.sign)
+        super().clear()
+        super().update(items)
+        super().update((price, volume) for price, volume in levels.items() if not _orderable(price))
+        self.__dict__['keys_'] = [price * self.sign for price, _ in items]
+
+    def __reduce__(self):
+        # dict subclasses are unpickled by __setitem__ before their attributes are restored
+        return self.__class__, (dict(self), self.sign == -1)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == '__dict__':
+            # jsonpickle restores the items first, with str keys, then assigns __dict__: the index is rebuilt from the
+            # items instead of trusting the restored keys_
+            self._rebuild({_restored_price(price): volume for price, volume in self.items()})
+
+    def __setitem__(self, price, volume):
+        if price in self or 'keys_' not in self.__dict__ or not _orderable(price):
+            # jsonpickle restores the items of an instance before its attributes, in their original order
+            super().__setitem__(price, volume)
+            return
+        key = price * self.sign
+        i = bisect_left(self.keys_, key)
+        self.keys_.insert(i, key)
+        if i == len(self.keys_) - 1 and len(self.keys_) == len(self) + 1:
+            super().__setitem__(price, volume)
+        else:
+            # the keys that are not numbers stay after the prices
+            items = list(self.items())
+            items.insert(i, (price, volume))
+            super().clear()
+            super().update(items)
+
+    def __delitem__(self, price):
+        super().__delitem__(price)
+        if _orderable(price):
+            del self.keys_[bisect_left(self.keys_, price * self.sign)]
+
+    def pop(self, price, *default):
+        if price not in self:
+            return super().pop(price, *default)
+        volume = self[price]
+        del self[price]
+        return volume
+
+    def popitem(self):
+        """remove and return the last (price, volume) of the iteration order, as dict.popitem"""
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        price = next(reversed(self))
+        return price, self.pop(price)
+
+    def setdefault(self, price, volume=None):
+        if price not in self:
+            self[price] = volume
+        return self[price]
+
+    def update(self, *args, **kwargs):
+        for price, volume in dict(*args, **kwargs).items():
+            self[price] = volume
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        res = self.copy()
+        res.update(other)
+        return res
+
+    def __ror__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        res = self.__class__(other, self.sign == -1)
+        res.update(self)
+        return res
+
+    @classmethod
+    def fromkeys(cls, prices, volume=None, reverse=False):
+        return cls(dict.fromkeys(prices, volume), reverse)
+
+    def clear(self):
+        super().clear()
+        self.keys_.clear()
+
+    def copy(self):
+        return self.__class__(self, self.sign == -1)
+
+    def best(self):
+        """best price, None if the side is empty"""
+        return self.keys_[0] * self.sign if self.keys_ else None
+
+    def worst(self):
+        """worst price, None if the side is empty"""
+        return self.keys_[-1] * self.sign if self.keys_ else None
+
+    def price_at(self, level: int):
+        """price of the level-th best level, 0 is the best"""
+        return self.keys_[level] * self.sign
+
+    def level_of(self, price) -> int:
+        """number of levels strictly better than price, also the position price has or would have in the book"""
+        return bisect_left(self.keys_, price * self.sign)
+
+    def cumulative(self) -> list:
+        """[(price, volume available at this price or better)] best first, volumes as positive numbers"""
+        res, total = [], 0
+        for key in self.keys_:
+            price = key * self.sign
+            total += abs(self[price])
+            res.append((price, total))
+        return res
+
+    def depth(self, levels: int = None) -> int:
+        """total volume of the best levels (all of them by default), as a positive number"""
+        return sum(abs(self[key * self.sign]) for key in self.keys_[:levels])
+
+    def walk(self, quantity, limit=None) -> list:
+        """
+        fills of a market order walking this side of the book, the book itself is not changed.
+        Args:
+            quantity: size of the order, a positive number
+            limit: worst price we accept, every level is walked by default
+        Returns:
+            list: [(price, filled quantity)] best price first, their sum is less than quantity if the book runs out
+        """
+        fills = []
+        for key in self.keys_:
+            price, volume = key * self.sign, self[key * self.sign]
+            if quantity <= 0 or (limit is not None and (price - limit) * self.sign > 0):
+                break
+            filled = min(quantity, abs(volume))
+            if filled:
+                fills.append((price, filled))
+                quantity -= filled
+        return fills
+
+
+class SortedOrderDepth(OrderDepth):
+    """
+    Drop-in OrderDepth whose buy_orders and sell_orders are SortedLevels.
+
+    buy_orders iterate from the highest bid and sell_orders from the lowest ask, whatever order the levels were given
+    in, and plain dicts assigned to either attribute are converted. __dict__ only holds the two sides, so
+    ProsperityEncoder and jsonpickle see the same fields as for datamodel.OrderDepth.
+    Examples:
+    depth = SortedOrderDepth({9998: 5, 9999: 2}, {10002: -4, 10001: -1})
+    depth.best_bid, depth.best_ask  # 9999, 10001
+    depth.sell_orders.walk(3)  # [(10001, 1), (10002, 2)]
+    """
+
+    def __init__(self, buy_orders=None, sell_orders=None):
+        super().__init__(buy_orders or {}, sell_orders or {})
+
+    def __setattr__(self, name, value):
+        if name in ('buy_orders', 'sell_orders') and not isinstance(value, SortedLevels):
+            value = SortedLevels(value, reverse=name == 'buy_orders')
+        super().__setattr__(name, value)
+
+    @classmethod
+    def from_order_depth(cls, order_depth: OrderDepth) -> 'SortedOrderDepth':
+        return cls(order_depth.buy_orders, order_depth.sell_orders)
+
+    @property
+    def best_bid(self):
+        return self.buy_orders.best()
+
+    @property
+    def best_ask(self):
+        return self.sell_orders.best()
+
+    @property
+    def worst_bid(self):
+        return self.buy_orders.worst()
+
+    @property
+    def worst_ask(self):
+        return self.sell_orders.worst()
+
+    @property
+    def mid_price(self):
+        """(best bid + best ask) / 2, None if a side is empty"""
+        if not self.buy_orders or not self.sell_orders:
+            return None
+        return (self.best_bid + self.best_ask) / 2
+
+    def walk(self, quantity, limit=None) -> list:
+        """
+        fills of a market order of signed quantity: a positive quantity buys from sell_orders, a negative one sells
+        into buy_orders. see SortedLevels.walk.
+        """
+        if quantity > 0:
+            return self.sell_orders.walk(quantity, limit)
+        return self.buy_orders.walk(-quantity, limit)
@@ -0,0 +1,165 @@
+import contextlib
+import fnmatch
+import functools
+import inspect
+import sys
+import time
+
+import numpy as np
+
+# Class.method names timed by default: Trader.run, the strategy helpers and the traderData round trip
+DEFAULT_PATTERNS = ['*.run', '*.set_up_cached_trader_data', '*.decode_trader_data', '*.kevin_*', '*.tongfei_*',
+                    '*.shaoqin_*', '*.rhianna_*', '*.r4_*', '*.r_*_adaptor', '*.implied_volatility',
+                    '*.update_*', '*Codec.encode', '*Codec.decode']
+
+
+class Profiler:
+    """
+    Opt-in timer of Trader.run and the methods it calls.
+
+    instrument(trader_cls) replaces the matching methods of the classes of the trader module by timing wrappers and
+    puts the originals back on exit, so a trader that is not instrumented runs its own code untouched. every call is
+    recorded under its call path (run > set_up_cached_trader_data > implied_volatility), which gives the per-function
+    percentiles and a flame-style tree of where a tick's time goes.
+    Examples:
+    profiler = Profiler()
+    result = Backtester.from_directory(trader_cls, data_dir).run(profiler=profiler)
+    print(profiler.summary())
+    """
+
+    def __init__(self, patterns=None):
+        self.patterns = list(patterns or DEFAULT_PATTERNS)
+        self.stack = []
+        self.calls = {}  # {call path: [duration in ns]}
+        self.ticks = []  # [(timestamp, duration in ns)] of every Trader.run
+
+    def reset(self):
+        self.stack = []
+        self.calls = {}
+        self.ticks = []
+
+    def _wrap(self, name, function, is_run):
+        stack, calls, ticks = self.stack, self.calls, self.ticks
+        perf_counter_ns = time.perf_counter_ns
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stack.append(name)
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                duration = perf_counter_ns() - start
+                path = tuple(stack)
+                stack.pop()
+                durations = calls.get(path)
+                if durations is None:
+                    calls[path] = durations = []
+                durations.append(duration)
+                if is_run and len(args) > 1:
+                    ticks.append((getattr(args[1], 'timestamp', None), duration))
+        return wrapper
+
+    def targets(self, trader_cls) -> list:
+        """[(class, attribute name, qualified name)] of the methods instrument would wrap"""
+        module = sys.modules.get(trader_cls.__module__)
+        classes = [trader_cls]
+        if module is not None:
+            classes += [obj for obj in vars(module).values()
+                        if inspect.isclass(obj) and obj.__module__ == module.__name__ and obj is not trader_cls]
+        res = []
+        for cls in classes:
+            for attr, value in vars(cls).items():
+                function = value.__func__ if isinstance(value, (staticmethod, classmethod)) else value
+                qualified = f'{cls.__name__}.{attr}'
+                if inspect.isfunction(function) and any(fnmatch.fnmatchcase(qualified, p) for p in self.patterns):
+                    res.append((cls, attr, qualified))
+        return res
+
+    @contextlib.contextmanager
+    def instrument(self, trader_cls):
+        """time the matching methods of trader_cls and of the other classes of its module while the block runs"""
+        originals = []
+        try:
+            for cls, attr, qualified in self.targets(trader_cls):
+                value = vars(cls)[attr]
+                originals.append((cls, attr, value))
+                if isinstance(value, (staticmethod, classmethod)):
+                    wrapped = type(value)(self._wrap(qualified, value.__func__, False))
+                else:
+                    wrapped = self._wrap(qualified, value, cls is trader_cls and attr == 'run')
+                setattr(cls, attr, wrapped)
+            yield self
+        finally:
+            for cls, attr, value in reversed(originals):
+                setattr(cls, attr, value)
+
+    def stats(self) -> dict:
+        """
+        {function: {'calls', 'total_ms', 'self_ms', 'p50_us', 'p99_us', 'max_us'}}, sorted by total time.
+        total_ms is inclusive of the timed functions it calls, self_ms is not, a recursive function counts once.
+        """
+        durations, self_time = {}, {}
+        for path, values in self.calls.items():
+            name = path[-1]
+            if name not in path[:-1]:
+                durations.setdefault(name, []).extend(values)
+            self_time[name] = self_time.get(name, 0) + sum(values)
+            if len(path) > 1:
+                self_time[path[-2]] = self_time.get(path[-2], 0) - sum(values)
+        res = {}
+        for name, values in durations.items():
+            values = np.asarray(values, dtype=float)
+            res[name] = {'calls': len(values), 'total_ms': values.sum() / 1e6, 'self_ms': self_time[name] / 1e6,
+                         'p50_us': np.percentile(values, 50) / 1e3, 'p99_us': np.percentile(values, 99) / 1e3,
+                         'max_us': values.max() / 1e3}
+        return dict(sorted(res.items(), key=lambda item: -item[1]['total_ms']))
+
+    def tree(self) -> list:
+        """[(call path, total ms, calls)] depth first, children sorted by total time"""
+        totals = {path: (sum(values) / 1e6, len(values)) for path, values in self.calls.items()}
+        children = {}
+        for path in totals:
+            children.setdefault(path[:-1], []).append(path)
+        res = []
+
+        def visit(parent):
+            for path in sorted(children.get(parent, []), key=lambda p: -totals[p][0]):
+                res.append((path, *totals[path]))
+                visit(path)
+        visit(())
+        return res
+
+    def summary(self, min_percent: float = 0.5, width: int = 30, slowest: int = 5) -> str:
+        """
+        per-function table, flame-style tree of the call paths taking at least min_percent of the total and the
+        slowest ticks
+        """
+        if not self.calls:
+            return 'no timed calls'
+        stats = self.stats()
+        lines = [f'{"function":<44}{"calls":>8}{"total ms":>11}{"self ms":>10}{"p50 us":>10}{"p99 us":>10}'
+                 f'{"max us":>10}']
+        for name, s in stats.items():
+            lines.append(f'{name:<44}{s["calls"]:>8}{s["total_ms"]:>11.1f}{s["self_ms"]:>10.1f}{s["p50_us"]:>10.1f}'
+                         f'{s["p99_us"]:>10.1f}{s["max_us"]:>10.1f}')
+
+        tree = self.tree()
+        total = sum(ms for path, ms, _ in tree if len(path) == 1)
+        lines += ['', f'call tree ({total:.1f} ms, bars are the share of it)']
+        for path, ms, calls in tree:
+            percent = 100 * ms / total if total else 0
+            if percent < min_percent:
+                continue
+            bar = '#' * max(1, round(width * ms / total)) if total else ''
+            label = '  ' * (len(path) - 1) + path[-1]
+            lines.append(f'{bar:<{width}} {percent:5.1f}% {ms:>10.1f} ms {calls:>7}x  {label}')
+
+        if self.ticks:
+            tick_ms = np.array([duration for _, duration in self.ticks], dtype=float) / 1e6
+            lines += ['', f'run per tick: p50 {np.percentile(tick_ms, 50):.3f} ms, p99 {np.percentile(tick_ms, 99):.3f}'
+                          f' ms, max {tick_ms.max():.3f} ms over {len(tick_ms)} ticks']
+            worst = sorted(self.ticks, key=lambda tick: -tick[1])[:slowest]
+            lines.append('slowest ticks: ' + ', '.join(f'{timestamp} ({duration / 1e6:.2f} ms)'
+                                                       for timestamp, duration in worst))
+        return '\n'.join(lines)
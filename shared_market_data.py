@@ -0,0 +1,233 @@
+import atexit
+import json
+import mmap
+import os
+import struct
+import tempfile
+import uuid
+
+import numpy as np
+
+from data_store import OBSERVATION_FIELDS, PRICE_LEVELS, ColumnTable, MarketDataStore
+from datamodel import ConversionObservation, Observation, OrderDepth, Trade, TradingState
+
+MAGIC = b'SMD1'
+ALIGNMENT = 64
+# /dev/shm is where shm_open puts POSIX shared memory on linux, files there never touch the disk
+DEFAULT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+KINDS = ['prices', 'trades', 'observations']
+CONVERSION_PRODUCT = 'ORCHIDS'  # the only product with conversion observations, as in the backtester
+
+
+class SharedMarketData:
+    """
+    Price, trade and observation columns of a round published once in shared memory.
+
+    publish() reads the columnar cache of data_store, sorts every table by (day, timestamp), adds a tick index
+    (rows of every tick in each table) and writes it all to one file under /dev/shm: a JSON header followed by
+    aligned arrays. every process that attaches memory-maps that file read-only, so the columns are numpy views
+    on the same physical pages whatever the number of workers. pickling an instance only pickles its descriptor,
+    a worker receiving it attaches on unpickling.
+    the publishing instance owns the file and removes it on unlink(), when used as a context manager or at exit.
+    Examples:
+    with SharedMarketData.publish('src/round5', round=5) as shared:
+        Parallel(n_jobs=4)(delayed(period_search)(period, shared) for period in periods)
+    # in the worker
+    prices = shared.table('prices')
+    starfruit = prices['product'] == prices.code('product', 'STARFRUIT')
+    mid_price = prices['mid_price'][starfruit]
+    state = shared.state(i)  # TradingState of tick i
+    """
+
+    def __init__(self, path, owner: bool = False):
+        self.path = path
+        self.owner = owner
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a shared market data file')
+        data_start, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        self.header = json.loads(bytes(self._mmap[len(MAGIC) + 8:data_start]).rstrip(b'\0'))
+        arrays = {}
+        for name, (dtype, shape, offset) in self.header['arrays'].items():
+            count = int(np.prod(shape)) if shape else 1
+            arrays[name] = np.frombuffer(self._mmap, dtype=np.dtype(dtype), count=count,
+                                         offset=data_start + offset).reshape(shape)
+        self.tables = {kind: ColumnTable({column: arrays[f'{kind}.{column}'] for column in layout['columns']},
+                                         layout['categories'])
+                       for kind, layout in self.header['tables'].items()}
+        self.tick_day = arrays['tick.day']
+        self.tick_timestamp = arrays['tick.timestamp']
+        self.price_offsets = arrays['tick.price_offsets']
+        self.trade_offsets = arrays['tick.trade_offsets']
+        self.observation_row = arrays['tick.observation_row']
+        self.products = self.tables['prices'].categories.get('product', [])
+
+    @classmethod
+    def publish(cls, data_dir, round=None, days=None, directory=None) -> 'SharedMarketData':
+        """
+        copy the market data of a round directory into a new shared file.
+        Args:
+            data_dir: round data directory
+            round: round of the data files, needed when the directory holds several
+            days: only publish these days
+            directory: where the file goes, /dev/shm when it exists
+        Returns:
+            SharedMarketData: the owning instance
+        """
+        store = MarketDataStore(data_dir, round)
+        arrays, tables = {}, {}
+        for kind in KINDS:
+            table = getattr(store, kind)()
+            columns = dict(table.columns)
+            if columns:
+                keep = np.ones(len(table), dtype=bool) if days is None else np.isin(table['day'], days)
+                order = np.flatnonzero(keep)
+                # stable, the rows of a tick keep their csv order
+                order = order[np.lexsort((table['timestamp'][order], table['day'][order]))]
+                columns = {name: np.asarray(values)[order] for name, values in columns.items()}
+            tables[kind] = {'columns': list(columns), 'categories': table.categories}
+            arrays.update({f'{kind}.{name}': values for name, values in columns.items()})
+
+        if len(arrays.get('prices.key', ())) == 0:
+            raise FileNotFoundError(f'no prices_round_*_day_*.csv found in {data_dir} for days {days}')
+        price_key = arrays['prices.key']
+        starts = np.flatnonzero(np.r_[True, price_key[1:] != price_key[:-1]])
+        tick_key = price_key[starts]
+        arrays['tick.day'] = arrays['prices.day'][starts]
+        arrays['tick.timestamp'] = arrays['prices.timestamp'][starts]
+        arrays['tick.price_offsets'] = np.r_[starts, len(price_key)].astype(np.int64)
+        trade_key = arrays.get('trades.key', np.zeros(0, dtype=np.int64))
+        arrays['tick.trade_offsets'] = np.r_[np.searchsorted(trade_key, tick_key, 'left'),
+                                             len(trade_key)].astype(np.int64)
+        # the trade rows of tick i are trade_offsets[i]:trade_offsets[i + 1], rows between two ticks go to the first
+        observation_key = arrays.get('observations.key', np.zeros(0, dtype=np.int64))
+        row = np.searchsorted(observation_key, tick_key, 'left')
+        found = row < len(observation_key)
+        found[found] = observation_key[row[found]] == tick_key[found]
+        arrays['tick.observation_row'] = np.where(found, row, -1).astype(np.int64)
+
+        header = {'source': os.path.abspath(data_dir), 'round': round, 'days': days, 'tables': tables, 'arrays': {}}
+        offset = 0
+        for name, values in arrays.items():
+            header['arrays'][name] = [values.dtype.str, list(values.shape), offset]
+            offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+        header_bytes = json.dumps(header, separators=(',', ':')).encode()
+        data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+        path = os.path.join(directory or DEFAULT_DIR, f'prosperity-market-{uuid.uuid4().hex}')
+        # written under a temporary name and renamed, an attaching process never sees half a file
+        with open(path + '.tmp', 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', data_start))
+            f.write(header_bytes)
+            f.write(b'\0' * (data_start - f.tell()))
+            for values in arrays.values():
+                data = np.ascontiguousarray(values).tobytes()
+                f.write(data)
+                f.write(b'\0' * (-len(data) % ALIGNMENT))
+        os.replace(path + '.tmp', path)
+        res = cls(path, owner=True)
+        atexit.register(res.unlink)
+        return res
+
+    @property
+    def descriptor(self) -> dict:
+        """what a worker needs to attach, small enough to pass with every task"""
+        return {'path': self.path}
+
+    @classmethod
+    def attach(cls, descriptor) -> 'SharedMarketData':
+        return cls(descriptor['path'] if isinstance(descriptor, dict) else descriptor)
+
+    def __reduce__(self):
+        return SharedMarketData.attach, (self.descriptor,)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.owner:
+            self.unlink()
+
+    def unlink(self):
+        """remove the file, processes that already attached keep their mapping"""
+        if self.owner:
+            self.owner = False
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def table(self, kind) -> ColumnTable:
+        """zero-copy columns of 'prices', 'trades' or 'observations'"""
+        return self.tables[kind]
+
+    def frame(self, kind):
+        """pandas frame of a table (a copy, like ColumnTable.to_frame), None when the table is empty"""
+        table = self.tables[kind]
+        return table.to_frame() if len(table) else None
+
+    @property
+    def ticks(self) -> int:
+        return len(self.tick_day)
+
+    def order_depths(self, i) -> dict:
+        """{product: OrderDepth} of tick i, bids best first, asks best first with negative volumes"""
+        prices = self.tables['prices']
+        a, b = int(self.price_offsets[i]), int(self.price_offsets[i + 1])
+        res = {}
+        for side, sign in (('bid', 1), ('ask', -1)):
+            price = np.stack([prices[f'{side}_price_{k}'][a:b] for k in range(1, PRICE_LEVELS + 1)], axis=1)
+            volume = np.stack([prices[f'{side}_volume_{k}'][a:b] for k in range(1, PRICE_LEVELS + 1)], axis=1)
+            for product, row_price, row_volume in zip(prices['product'][a:b].tolist(), price.tolist(),
+                                                     volume.tolist()):
+                depth = res.get(product)
+                if depth is None:
+                    depth = res[product] = OrderDepth({}, {})
+                levels = sorted(((p, v) for p, v in zip(row_price, row_volume) if v), reverse=sign > 0)
+                orders = depth.buy_orders if sign > 0 else depth.sell_orders
+                orders.update((p, sign * abs(v)) for p, v in levels)
+        return {self.products[product]: depth for product, depth in res.items()}
+
+    def market_trades(self, i) -> dict:
+        """{symbol: [Trade]} printed at tick i"""
+        trades = self.tables['trades']
+        a, b = int(self.trade_offsets[i]), int(self.trade_offsets[i + 1])
+        res = {}
+        if a == b:
+            return res
+        symbols = trades.categories['symbol']
+        names = trades.categories['buyer']
+        for symbol, price, quantity, buyer, seller, timestamp in zip(
+                trades['symbol'][a:b].tolist(), trades['price'][a:b].tolist(), trades['quantity'][a:b].tolist(),
+                trades['buyer'][a:b].tolist(), trades['seller'][a:b].tolist(), trades['timestamp'][a:b].tolist()):
+            res.setdefault(symbols[symbol], []).append(Trade(symbols[symbol], price, quantity, names[buyer],
+                                                             names[seller], timestamp))
+        return res
+
+    def observation(self, i) -> Observation:
+        row = int(self.observation_row[i])
+        if row < 0:
+            return Observation({}, {})
+        observations = self.tables['observations']
+        values = [float(observations[field][row]) if field in observations else 0.0 for field in OBSERVATION_FIELDS]
+        return Observation({}, {CONVERSION_PRODUCT: ConversionObservation(*values)})
+
+    def state(self, i, trader_data: str = '', position: dict = None, own_trades: dict = None) -> TradingState:
+        """
+        TradingState of tick i with the backtester conventions: the market trades are those printed at the
+        previous tick of the same day, position and own trades are the caller's.
+        """
+        previous = i > 0 and self.tick_day[i - 1] == self.tick_day[i]
+        order_depths = self.order_depths(i)
+        listings = {product: {'symbol': product, 'product': product, 'denomination': 'SEASHELLS'}
+                    for product in order_depths}
+        return TradingState(trader_data, int(self.tick_timestamp[i]), listings, order_depths, own_trades or {},
+                            self.market_trades(i - 1) if previous else {}, dict(position or {}), self.observation(i))
+
+    def iter_states(self, day=None):
+        """TradingState of every tick (of one day), with empty traderData and positions"""
+        ticks = range(self.ticks) if day is None else np.flatnonzero(self.tick_day == day).tolist()
+        for i in ticks:
+            yield self.state(i)
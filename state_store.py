@@ -0,0 +1,353 @@
+import argparse
+import copy
+import json
+import mmap
+import os
+import pickle
+import struct
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from datamodel import ConversionObservation, Observation, OrderDepth, Trade, TradingState
+
+MAGIC = b'TSS1'
+
+CONVERSION_FIELDS = ['bidPrice', 'askPrice', 'transportFees', 'exportTariff', 'importTariff', 'sunlight', 'humidity']
+
+ALIGNMENT = 8
+
+
+def _price(value):
+    # jsonpickle turns the price keys into strings, the exchange sends ints
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _price_array(values):
+    values = np.asarray(values, dtype=np.float64)
+    if np.all(values == np.round(values)) and (values.size == 0 or np.abs(values).max() < 2 ** 31):
+        return values.astype(np.int32)
+    return values
+
+
+class _Interner:
+
+    def __init__(self):
+        self.labels = []
+        self.codes = {}
+
+    def __call__(self, label) -> int:
+        label = '' if label is None else str(label)
+        code = self.codes.get(label)
+        if code is None:
+            code = self.codes[label] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+
+def write_states(path, states):
+    """
+    write a sequence of TradingState as a struct-of-arrays file.
+
+    Every field becomes one or a few flat numpy arrays: the book levels and the trades are stored CSR style
+    (an offsets array per tick and product plus the concatenated values), symbols and counterparties are interned,
+    positions and observations are dense per tick matrices with a presence mask.
+    Args:
+        path: output file
+        states: list of TradingState (e.g. the pickled lists in src/tutorial)
+    """
+    states = list(states)
+    n = len(states)
+    symbols = sorted({symbol for state in states for symbol in state.order_depths}
+                     | {symbol for state in states for symbol in state.position}
+                     | {symbol for state in states for trades in (state.market_trades, state.own_trades)
+                        for symbol in trades})
+    symbol_code = {symbol: i for i, symbol in enumerate(symbols)}
+    n_symbols = len(symbols)
+    conversion_products = sorted({product for state in states
+                                  for product in state.observations.conversionObservations})
+    plain_products = sorted({product for state in states for product in state.observations.plainValueObservations})
+    listings = states[0].listings if states else {}
+    listings = {symbol: listing if isinstance(listing, dict) else vars(listing) for symbol, listing in listings.items()}
+    names = _Interner()
+
+    arrays = {}
+    arrays['timestamp'] = np.array([state.timestamp for state in states], dtype=np.int64)
+    trader_data = [(state.traderData or '').encode() for state in states]
+    arrays['trader_data_offsets'] = np.concatenate([[0], np.cumsum([len(b) for b in trader_data])]).astype(np.int64)
+    arrays['trader_data'] = np.frombuffer(b''.join(trader_data), dtype=np.uint8)
+
+    # order depths: one offsets array per side, indexed by tick * n_symbols + symbol
+    has_depth = np.zeros((n, n_symbols), dtype=bool)
+    for side in ['buy', 'sell']:
+        counts = np.zeros(n * n_symbols, dtype=np.int64)
+        prices, volumes = [], []
+        for i, state in enumerate(states):
+            for symbol, depth in state.order_depths.items():
+                j = symbol_code[symbol]
+                has_depth[i, j] = True
+                orders = depth.buy_orders if side == 'buy' else depth.sell_orders
+                counts[i * n_symbols + j] = len(orders)
+                for price, volume in orders.items():
+                    prices.append(_price(price))
+                    volumes.append(volume)
+        arrays[f'{side}_offsets'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        arrays[f'{side}_price'] = _price_array(prices)
+        arrays[f'{side}_volume'] = np.asarray(volumes, dtype=np.int32)
+    arrays['has_depth'] = has_depth
+
+    # trades: one offsets array per tick, symbols and counterparties as codes
+    for kind in ['market', 'own']:
+        counts = np.zeros(n, dtype=np.int64)
+        rows = []
+        for i, state in enumerate(states):
+            trades_by_symbol = state.market_trades if kind == 'market' else state.own_trades
+            for symbol, trades in trades_by_symbol.items():
+                for trade in trades:
+                    rows.append((symbol_code[symbol], trade.price, trade.quantity, names(trade.buyer),
+                                 names(trade.seller), trade.timestamp))
+                    counts[i] += 1
+        columns = list(zip(*rows)) if rows else [[]] * 6
+        arrays[f'{kind}_offsets'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        arrays[f'{kind}_symbol'] = np.asarray(columns[0], dtype=np.int16)
+        arrays[f'{kind}_price'] = _price_array(columns[1])
+        arrays[f'{kind}_quantity'] = np.asarray(columns[2], dtype=np.int32)
+        arrays[f'{kind}_buyer'] = np.asarray(columns[3], dtype=np.int32)
+        arrays[f'{kind}_seller'] = np.asarray(columns[4], dtype=np.int32)
+        arrays[f'{kind}_timestamp'] = np.asarray(columns[5], dtype=np.int64)
+
+    position = np.zeros((n, n_symbols), dtype=np.int32)
+    has_position = np.zeros((n, n_symbols), dtype=bool)
+    conversion = np.zeros((n, len(conversion_products), len(CONVERSION_FIELDS)), dtype=np.float64)
+    has_conversion = np.zeros((n, len(conversion_products)), dtype=bool)
+    plain = np.zeros((n, len(plain_products)), dtype=np.float64)
+    has_plain = np.zeros((n, len(plain_products)), dtype=bool)
+    for i, state in enumerate(states):
+        for symbol, value in state.position.items():
+            position[i, symbol_code[symbol]] = value
+            has_position[i, symbol_code[symbol]] = True
+        for j, product in enumerate(conversion_products):
+            observation = state.observations.conversionObservations.get(product)
+            if observation is not None:
+                conversion[i, j] = [getattr(observation, field) for field in CONVERSION_FIELDS]
+                has_conversion[i, j] = True
+        for j, product in enumerate(plain_products):
+            if product in state.observations.plainValueObservations:
+                plain[i, j] = state.observations.plainValueObservations[product]
+                has_plain[i, j] = True
+    arrays.update(position=position, has_position=has_position, conversion=conversion,
+                  has_conversion=has_conversion, plain=plain, has_plain=has_plain)
+
+    header = {'length': n, 'symbols': symbols, 'names': names.labels, 'listings': listings,
+              'conversion_products': conversion_products, 'plain_products': plain_products, 'arrays': {}}
+    offset = 0
+    for name, values in arrays.items():
+        header['arrays'][name] = [values.dtype.str, list(values.shape), offset]
+        offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header, separators=(',', ':')).encode()
+    # the array section starts on an aligned offset so every array can be viewed in place
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', data_start))
+        f.write(header_bytes)
+        f.write(b'\0' * (data_start - f.tell()))
+        for values in arrays.values():
+            data = np.ascontiguousarray(values).tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % ALIGNMENT))
+
+
+class LazyOrderDepths(Mapping):
+    """order_depths of a StateView, an OrderDepth is only built the first time its symbol is looked up"""
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+        self._symbols = store.depth_symbols(index)
+        self._cache = {}
+
+    def __getitem__(self, symbol) -> OrderDepth:
+        depth = self._cache.get(symbol)
+        if depth is None:
+            if symbol not in self._symbols:
+                raise KeyError(symbol)
+            depth = self._cache[symbol] = self._store.order_depth(self._index, symbol)
+        return depth
+
+    def __iter__(self):
+        return iter(self._symbols)
+
+    def __len__(self) -> int:
+        return len(self._symbols)
+
+    def __contains__(self, symbol) -> bool:
+        return symbol in self._symbols
+
+    def copy(self) -> dict:
+        return dict(self.items())
+
+    def __deepcopy__(self, memo) -> dict:
+        return {symbol: copy.deepcopy(depth, memo) for symbol, depth in self.items()}
+
+
+class StateView(TradingState):
+    """
+    TradingState backed by a StateStore. Only the timestamp is read up front, every other field is decoded on first
+    access and then cached on the instance like a normal attribute.
+    """
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+        self.timestamp = int(store.arrays['timestamp'][index])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        store, i = self._store, self._index
+        if name == 'order_depths':
+            value = LazyOrderDepths(store, i)
+        elif name in ('market_trades', 'own_trades'):
+            value = store.trades(i, name.split('_')[0])
+        elif name == 'position':
+            value = store.position(i)
+        elif name == 'observations':
+            value = store.observation(i)
+        elif name == 'traderData':
+            value = store.trader_data(i)
+        elif name == 'listings':
+            value = copy.deepcopy(store.header['listings'])
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def toJSON(self):
+        return self.materialize().toJSON()
+
+    def materialize(self) -> TradingState:
+        """plain TradingState with every field decoded"""
+        return TradingState(self.traderData, self.timestamp, self.listings, dict(self.order_depths.items()),
+                            self.own_trades, self.market_trades, self.position, self.observations)
+
+
+class StateStore(Sequence):
+    """
+    Read side of write_states. The file is memory-mapped and every array is a zero-copy numpy view on the map,
+    indexing returns lazy StateView objects.
+    Examples:
+    store = open_states('src/tutorial/tutorial_trade_state_list.pkl')  # or StateStore(path of a .states file)
+    mid = [(s.order_depths['STARFRUIT'].buy_orders, s.order_depths['STARFRUIT'].sell_orders) for s in store]
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a state store file')
+        data_start, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        self.header = json.loads(bytes(self._mmap[len(MAGIC) + 8:data_start]).rstrip(b'\0'))
+        self.arrays = {}
+        for name, (dtype, shape, offset) in self.header['arrays'].items():
+            count = int(np.prod(shape)) if shape else 1
+            self.arrays[name] = np.frombuffer(self._mmap, dtype=np.dtype(dtype), count=count,
+                                              offset=data_start + offset).reshape(shape)
+        self.symbols = self.header['symbols']
+        self.names = self.header['names']
+        self._symbol_code = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def __len__(self) -> int:
+        return self.header['length']
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [StateView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return StateView(self, index)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.arrays['timestamp']
+
+    def depth_symbols(self, index) -> list:
+        return [symbol for symbol, present in zip(self.symbols, self.arrays['has_depth'][index].tolist()) if present]
+
+    def order_depth(self, index, symbol) -> OrderDepth:
+        i = index * len(self.symbols) + self._symbol_code[symbol]
+        sides = []
+        for side in ['buy', 'sell']:
+            offsets = self.arrays[f'{side}_offsets']
+            start, end = offsets[i], offsets[i + 1]
+            sides.append(dict(zip(self.arrays[f'{side}_price'][start:end].tolist(),
+                                  self.arrays[f'{side}_volume'][start:end].tolist())))
+        return OrderDepth(*sides)
+
+    def trades(self, index, kind) -> dict:
+        a = self.arrays
+        start, end = a[f'{kind}_offsets'][index], a[f'{kind}_offsets'][index + 1]
+        res = {}
+        for symbol, price, quantity, buyer, seller, timestamp in zip(
+                a[f'{kind}_symbol'][start:end].tolist(), a[f'{kind}_price'][start:end].tolist(),
+                a[f'{kind}_quantity'][start:end].tolist(), a[f'{kind}_buyer'][start:end].tolist(),
+                a[f'{kind}_seller'][start:end].tolist(), a[f'{kind}_timestamp'][start:end].tolist()):
+            symbol = self.symbols[symbol]
+            res.setdefault(symbol, []).append(
+                Trade(symbol, price, quantity, self.names[buyer], self.names[seller], timestamp))
+        return res
+
+    def position(self, index) -> dict:
+        return {symbol: value for symbol, value, present in zip(
+            self.symbols, self.arrays['position'][index].tolist(), self.arrays['has_position'][index].tolist())
+                if present}
+
+    def observation(self, index) -> Observation:
+        conversion = {product: ConversionObservation(*values) for product, values, present in zip(
+            self.header['conversion_products'], self.arrays['conversion'][index].tolist(),
+            self.arrays['has_conversion'][index].tolist()) if present}
+        plain = {product: value for product, value, present in zip(
+            self.header['plain_products'], self.arrays['plain'][index].tolist(),
+            self.arrays['has_plain'][index].tolist()) if present}
+        return Observation(plain, conversion)
+
+    def trader_data(self, index) -> str:
+        offsets = self.arrays['trader_data_offsets']
+        return self.arrays['trader_data'][offsets[index]:offsets[index + 1]].tobytes().decode()
+
+    def close(self):
+        self.arrays = {}
+        self._mmap.close()
+
+
+def convert_pickle(pkl_path, out_path=None) -> str:
+    """convert a pickled list of TradingState (src/tutorial/*.pkl) into a .states file next to it"""
+    out_path = out_path or os.path.splitext(pkl_path)[0] + '.states'
+    with open(pkl_path, 'rb') as f:
+        states = pickle.load(f)
+    write_states(out_path, states)
+    return out_path
+
+
+def open_states(pkl_path) -> StateStore:
+    """
+    StateStore of a pickled list of TradingState. the .states files are generated, not committed: the pickle is
+    converted next to itself on first use and again whenever it is newer than its .states file.
+    """
+    path = os.path.splitext(pkl_path)[0] + '.states'
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(pkl_path):
+        convert_pickle(pkl_path, path)
+    return StateStore(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert pickled TradingState lists into .states files')
+    parser.add_argument('pickles', nargs='+')
+    args = parser.parse_args()
+    for pkl in args.pickles:
+        out = convert_pickle(pkl)
+        print(f'{pkl} ({os.path.getsize(pkl):,} bytes) -> {out} ({os.path.getsize(out):,} bytes)')
@@ -0,0 +1,374 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from backtester import Backtester, load_trader
+from data_store import MarketDataStore
+
+DEFAULT_DB = 'sweeps.sqlite'
+BAYES_CANDIDATES = 2000  # random candidates scored by expected improvement at every step
+BAYES_LENGTH_SCALE = 0.25  # RBF length scale, parameters are scaled to [0, 1]
+BAYES_NOISE = 1e-3  # relative to the variance of the standardized pnl
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sweeps (
+    id INTEGER PRIMARY KEY,
+    created TEXT,
+    trader TEXT,
+    data TEXT,
+    days TEXT,
+    method TEXT,
+    space TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    sweep_id INTEGER REFERENCES sweeps (id),
+    params TEXT,
+    total_pnl REAL,
+    pnl_by_day TEXT,
+    pnl_by_product TEXT,
+    elapsed REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+    run_id INTEGER REFERENCES runs (id),
+    name TEXT,
+    value
+);
+CREATE INDEX IF NOT EXISTS runs_by_pnl ON runs (sweep_id, total_pnl);
+CREATE INDEX IF NOT EXISTS params_by_run ON params (run_id);
+CREATE INDEX IF NOT EXISTS params_by_value ON params (name, value);
+'''
+
+
+class ResultStore:
+    """
+    sqlite file holding every sweep and replay, one row per replay in runs and one row per parameter in params.
+    Examples:
+    store = ResultStore('sweeps.sqlite')
+    store.results(sweep_id)  # DataFrame, one column per parameter
+    store.connection.execute("SELECT value, AVG(total_pnl) FROM params JOIN runs ON runs.id = run_id "
+                             "WHERE name = 'ORCHIDS_PROFIT_MARGIN' GROUP BY value")
+    """
+
+    def __init__(self, path=DEFAULT_DB):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def new_sweep(self, trader, data, days, method, space) -> int:
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO sweeps (created, trader, data, days, method, space) VALUES (?, ?, ?, ?, ?, ?)',
+                (time.strftime('%Y-%m-%d %H:%M:%S'), trader, data, json.dumps(days), method, json.dumps(space)))
+        return cursor.lastrowid
+
+    def add(self, sweep_id, result: dict) -> int:
+        """store one result of run_point"""
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (sweep_id, params, total_pnl, pnl_by_day, pnl_by_product, elapsed, error) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sweep_id, json.dumps(result['params']), result['total_pnl'], json.dumps(result['pnl_by_day']),
+                 json.dumps(result['pnl_by_product']), result['elapsed'], result['error']))
+            self.connection.executemany('INSERT INTO params (run_id, name, value) VALUES (?, ?, ?)',
+                                        [(cursor.lastrowid, name, value) for name, value in result['params'].items()])
+        return cursor.lastrowid
+
+    def results(self, sweep_id) -> pd.DataFrame:
+        """one row per replay of the sweep, best pnl first, with a column per parameter"""
+        runs = pd.read_sql_query('SELECT id, params, total_pnl, elapsed, error FROM runs WHERE sweep_id = ? '
+                                 'ORDER BY total_pnl DESC', self.connection, params=(sweep_id,))
+        params = pd.DataFrame([json.loads(p) for p in runs.pop('params')], index=runs.index)
+        return pd.concat([runs, params], axis=1)
+
+    def close(self):
+        self.connection.close()
+
+
+def parse_value(text: str):
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_space(specs) -> dict:
+    """
+    ['NAME=1,2,3', 'OTHER=0.5:2'] to {'NAME': [1, 2, 3], 'OTHER': (0.5, 2.0)}, a list is a set of values and a
+    tuple a range (ints when both bounds are ints)
+    """
+    res = {}
+    for spec in specs or []:
+        name, _, values = spec.partition('=')
+        if not values:
+            raise ValueError(f'expected NAME=v1,v2,... or NAME=low:high, got {spec}')
+        if ':' in values:
+            low, high = [parse_value(v) for v in values.split(':')]
+            res[name] = (low, high)
+        else:
+            res[name] = [parse_value(v) for v in values.split(',')]
+    return res
+
+
+def grid_points(space: dict) -> list:
+    """every combination of the value lists of space"""
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+
+def _from_unit(space: dict, u: np.ndarray) -> list:
+    # every parameter is drawn on [0, 1) and mapped to its range or to one of its values
+    points = []
+    for row in u:
+        point = {}
+        for (name, values), x in zip(space.items(), row):
+            if isinstance(values, tuple):
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    point[name] = low + min(int(x * (high - low + 1)), high - low)
+                else:
+                    point[name] = float(low + x * (high - low))
+            else:
+                point[name] = values[min(int(x * len(values)), len(values) - 1)]
+        points.append(point)
+    return points
+
+
+def _to_unit(space: dict, point: dict) -> np.ndarray:
+    res = []
+    for name, values in space.items():
+        value = point[name]
+        if isinstance(values, tuple):
+            low, high = values
+            if isinstance(low, int) and isinstance(high, int):
+                res.append((value - low + 0.5) / (high - low + 1))
+            else:
+                res.append((value - low) / (high - low) if high != low else 0.5)
+        else:
+            res.append((values.index(value) + 0.5) / len(values))
+    return np.array(res)
+
+
+def random_points(space: dict, n: int, seed=None) -> list:
+    return _from_unit(space, np.random.default_rng(seed).random((n, len(space))))
+
+
+def _gaussian_process(x, y, candidates):
+    """posterior mean and standard deviation at candidates of a GP with an RBF kernel fitted on (x, y)"""
+    def kernel(a, b):
+        d = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+        return np.exp(-d / (2 * BAYES_LENGTH_SCALE ** 2))
+    L = np.linalg.cholesky(kernel(x, x) + BAYES_NOISE * np.eye(len(x)))
+    alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+    k = kernel(candidates, x)
+    v = np.linalg.solve(L, k.T)
+    return k @ alpha, np.sqrt(np.maximum(1 - (v ** 2).sum(axis=0), 1e-12))
+
+
+def suggest(space: dict, evaluated: list, n: int, rng) -> list:
+    """
+    n new points for a Bayesian search: a Gaussian process on the (point, pnl) pairs evaluated so far, the candidate
+    with the largest expected improvement is taken, its predicted pnl is added as if it were observed and the
+    next one is chosen the same way, so a batch spreads over the workers instead of piling on one spot.
+    Args:
+        evaluated: [(point, total_pnl)], failed replays excluded
+    """
+    if len(evaluated) < 2:
+        return _from_unit(space, rng.random((n, len(space))))
+    x = np.array([_to_unit(space, point) for point, _ in evaluated])
+    y = np.array([pnl for _, pnl in evaluated], dtype=float)
+    mean, scale = y.mean(), y.std() or 1.0
+    y = (y - mean) / scale
+    candidates = rng.random((BAYES_CANDIDATES, len(space)))
+    # snap the candidates to the values they map to so that duplicates of evaluated points are visible
+    candidates = np.array([_to_unit(space, point) for point in _from_unit(space, candidates)])
+    res = []
+    for _ in range(n):
+        mu, sigma = _gaussian_process(x, y, candidates)
+        z = (mu - y.max()) / sigma
+        improvement = (mu - y.max()) * norm.cdf(z) + sigma * norm.pdf(z)
+        best = int(np.argmax(improvement))
+        res.append(_from_unit(space, candidates[best:best + 1])[0])
+        x, y = np.vstack([x, candidates[best]]), np.r_[y, mu[best]]
+        candidates = np.delete(candidates, best, axis=0)
+    return res
+
+
+def configure(trader_cls, params: dict):
+    """
+    split params into Trader attributes, set on a subclass, and module level constants of the trader file
+    (e.g. NUM_OF_DATA_POINT).
+    Returns:
+        tuple: (Trader subclass, {module constant: value})
+    """
+    module = sys.modules[trader_cls.__module__]
+    attributes, constants = {}, {}
+    for name, value in params.items():
+        if hasattr(trader_cls, name):
+            attributes[name] = value
+        elif hasattr(module, name):
+            constants[name] = value
+        else:
+            raise KeyError(f'{name} is neither a Trader attribute nor a constant of {module.__file__}')
+    return type(trader_cls.__name__, (trader_cls,), attributes), constants
+
+
+@contextlib.contextmanager
+def module_constants(trader_cls, constants: dict):
+    module = sys.modules[trader_cls.__module__]
+    previous = {name: getattr(module, name) for name in constants}
+    for name, value in constants.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(module, name, value)
+
+
+# one backtester per worker process, built by _init_worker from the memory-mapped data cache
+_worker = {}
+
+
+def _init_worker(trader_path, data_dir, round, days, fill_model):
+    trader_cls = load_trader(trader_path)
+    _worker['trader_cls'] = trader_cls
+    _worker['backtester'] = Backtester.from_directory(trader_cls, data_dir, days=days, round=round,
+                                                      fill_model=fill_model)
+
+
+def run_point(params: dict) -> dict:
+    """replay the worker's data with params, a failing replay is returned with its error"""
+    trader_cls, backtester = _worker['trader_cls'], _worker['backtester']
+    start = time.perf_counter()
+    res = {'params': params, 'total_pnl': None, 'pnl_by_day': {}, 'pnl_by_product': {}, 'error': None}
+    try:
+        backtester.trader_cls, constants = configure(trader_cls, params)
+        with module_constants(trader_cls, constants):
+            result = backtester.run()
+        final = result.final_pnl()
+        res['total_pnl'] = result.total_pnl
+        res['pnl_by_day'] = {day: sum(pnl.values()) for day, pnl in final.items()}
+        res['pnl_by_product'] = {product: sum(pnl[product] for pnl in final.values()) for product in result.products}
+    except Exception as e:
+        res['error'] = f'{type(e).__name__}: {e}'
+    res['elapsed'] = time.perf_counter() - start
+    return res
+
+
+def sweep(trader_path, data_dir, points=None, space=None, bayes: int = 0, round=None, days=None, workers=None,
+          db=DEFAULT_DB, fill_model=None, seed=None, progress=None) -> int:
+    """
+    replay the trader with every point (or bayes points suggested from space) over a process pool.
+
+    the parent builds the columnar cache of the data once, every worker memory-maps it and builds its backtester
+    once, then replays one point per task. results are written to the sqlite store as they come in.
+    Args:
+        trader_path: trader file
+        data_dir: round data directory
+        points: [{parameter: value}], a grid or random sample
+        space: search space of parse_space, used for bayes
+        bayes: number of points of a Bayesian search over space, run in batches of one point per worker
+        workers: size of the pool, the number of cpus by default
+        db: sqlite file of ResultStore
+        progress: called with every result
+    Returns:
+        int: id of the sweep in the store
+    """
+    workers = workers or os.cpu_count()
+    store = MarketDataStore(data_dir, round)
+    # build the columnar cache here, the workers then only memory-map it
+    store.prices(), store.trades(), store.observations()
+    results = ResultStore(db)
+    method = 'bayes' if bayes else 'points'
+    sweep_id = results.new_sweep(os.path.abspath(trader_path), os.path.abspath(data_dir), days, method,
+                                 space if bayes else points)
+    rng = np.random.default_rng(seed)
+    evaluated = []
+
+    def record(result):
+        results.add(sweep_id, result)
+        if result['error'] is None:
+            evaluated.append((result['params'], result['total_pnl']))
+        if progress is not None:
+            progress(result)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(trader_path, data_dir, round, days, fill_model)) as pool:
+            if not bayes:
+                pending = {pool.submit(run_point, point) for point in points}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record(future.result())
+            else:
+                remaining = bayes
+                while remaining > 0:
+                    batch = suggest(space, evaluated, min(workers, remaining), rng)
+                    for result in pool.map(run_point, batch):
+                        record(result)
+                    remaining -= len(batch)
+    finally:
+        results.close()
+    return sweep_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay a trader over a grid or search space of its knobs')
+    parser.add_argument('trader', help='trader file, e.g. Round5/round_5_trader.py')
+    parser.add_argument('data', help='round data directory')
+    parser.add_argument('--round', type=int, help='round of the data files, needed when a directory holds several')
+    parser.add_argument('--days', type=int, nargs='*', help='only replay these days')
+    parser.add_argument('--grid', nargs='*', default=[], metavar='NAME=v1,v2', help='values of a grid parameter')
+    parser.add_argument('--random', nargs='*', default=[], metavar='NAME=low:high',
+                        help='range or values of a random / Bayesian search parameter')
+    parser.add_argument('--samples', type=int, default=0, help='random points drawn from --random')
+    parser.add_argument('--bayes', type=int, default=0, help='points of a Bayesian search over --random')
+    parser.add_argument('--seed', type=int, help='seed of the random and Bayesian search')
+    parser.add_argument('--workers', type=int, help='size of the process pool, the number of cpus by default')
+    parser.add_argument('--db', default=DEFAULT_DB, help='sqlite results store')
+    parser.add_argument('--top', type=int, default=10, help='number of best points printed')
+    args = parser.parse_args()
+    if args.random and not (args.samples or args.bayes):
+        parser.error('--random needs --samples or --bayes, the number of points to draw from it')
+
+    grid, space = parse_space(args.grid), parse_space(args.random)
+    points = None
+    if not args.bayes:
+        points = grid_points(grid)
+        if args.samples:
+            # a random sample over the --random knobs at every point of the grid over the others
+            points = [{**g, **p} for g in points for p in random_points(space, args.samples, args.seed)]
+
+    start = time.perf_counter()
+    count = itertools.count(1)
+    total = args.bayes or len(points)
+
+    def progress(result):
+        status = result['error'] or f'{result["total_pnl"]:,.1f}'
+        print(f'[{next(count)}/{total}] {result["params"]}: {status} ({result["elapsed"]:.1f}s)')
+
+    sweep_id = sweep(args.trader, args.data, points, space, args.bayes, args.round, args.days, args.workers, args.db,
+                     seed=args.seed, progress=progress)
+    print(f'sweep {sweep_id}: {total} replays in {time.perf_counter() - start:.1f}s, stored in {args.db}')
+    store = ResultStore(args.db)
+    print(store.results(sweep_id).head(args.top).to_string(index=False))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
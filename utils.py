@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve
 from scipy.stats import t
 
 
@@ -29,10 +30,37 @@ def exponential_halflife(length: int, half_life: int) -> np.ndarray:
     return np.exp(-np.log(2) / half_life * np.arange(length))[::-1]
 
 
+def _design(x, intercept=False) -> np.ndarray:
+    """2D design matrix of x, with a leading column of ones if intercept"""
+    x = np.asarray(x, dtype=float)
+    # Ensure x is two-dimensional (for a single predictor case, it should still work)
+    if x.ndim == 1:
+        x = x.reshape(-1, 1)
+    if intercept:
+        # Augment x with a column of ones for intercept
+        return np.hstack([np.ones((len(x), 1)), x])
+    return x
+
+
+def _fit_result(beta, r_squared, residuals=None, intercept=False, t_stats=None) -> dict:
+    # beta has the coefficients on its last axis, the intercept first. same keys, in the same order, as wls and ols
+    res = {"coefficients": beta[..., 1:] if intercept else beta}  # coefficients for predictors
+    if intercept:
+        res["intercept"] = beta[..., 0]  # intercept
+    if t_stats is not None:
+        res["t_stats"] = t_stats  # t statistics, the intercept first
+    res["R2"] = r_squared  # R^2 value
+    if residuals is not None:
+        res["residuals"] = residuals  # residuals
+    return res
+
+
 def wls(x, y, w, intercept=False):
     """
     Weighted least squares regression for multivariate x, including R^2 and residuals.
 
+    the rows of x and y are scaled by sqrt(w) instead of building the n x n diag(w) matrix, so the fit is O(n p^2)
+    in time and O(n p) in memory.
     Args:
         x (list of lists or numpy.ndarray): 2D list or array where each inner list or
         row represents a single observation's features.
@@ -42,64 +70,134 @@ def wls(x, y, w, intercept=False):
     Returns:
         dict: A dictionary containing coefficients, intercept, R^2, and residuals.
     """
-    # Convert inputs to numpy arrays if they aren't already
-    x = np.asarray(x)
-    y = np.asarray(y)
-    w = np.asarray(w)
+    y = np.asarray(y, dtype=float)
+    w = np.asarray(w, dtype=float)
 
     # Check if lengths of x, y, and w are the same
     if len(x) != len(y) or len(y) != len(w):
         raise ValueError("The lengths of x, y, and w must be the same")
 
-    # Ensure x is two-dimensional (for a single predictor case, it should still work)
-    if x.ndim == 1:
-        x = x.reshape(-1, 1)
-
-    # Create diagonal matrix for weights
-    W = np.diag(w)
-
-    # Reshape y as a column vector
-    Y = y.reshape(-1, 1)
-    if intercept:
-        # Augment x with a column of ones for intercept
-        X = np.hstack([np.ones((len(x), 1)), x])
-    else:
-        X = x
+    X = _design(x, intercept)
 
-    # Compute X'WX and X'WY
-    XTWX = X.T @ W @ X
-    XTWY = X.T @ W @ Y
+    # Compute X'WX and X'WY from the rows scaled by sqrt(w)
+    sqrt_w = np.sqrt(w)
+    X_w = X * sqrt_w[:, None]
+    XTWX = X_w.T @ X_w
+    XTWY = X_w.T @ (y * sqrt_w)
 
     try:
         # Solve for beta (coefficients)
         beta = np.linalg.solve(XTWX, XTWY)
-        beta = beta.flatten()  # Flatten the array to 1D
+    except np.linalg.LinAlgError as e:
+        raise np.linalg.LinAlgError("Matrix is singular and cannot be inverted.") from e
 
-        # Calculate fitted values
-        y_fitted = X @ beta.reshape(-1, 1)
+    # Calculate residuals and weighted R^2
+    residuals = y - X @ beta
+    SS_res = np.sum(w * residuals ** 2)
+    SS_tot = np.sum(w * (y - np.mean(y)) ** 2)
+    return _fit_result(beta, 1 - SS_res / SS_tot, residuals, intercept=intercept)
 
-        # Calculate residuals
-        residuals = Y - y_fitted
 
-        # Calculate weighted R^2
-        SS_res = residuals.T @ W @ residuals
-        SS_tot = (Y - np.mean(Y)).T @ W @ (Y - np.mean(Y))
-        r_squared = 1 - (SS_res / SS_tot).item()  # Extract scalar value
-        if intercept:
-            return {
-                "coefficients": beta[1:],  # coefficients for predictors
-                "intercept": beta[0],  # intercept
-                "R2": r_squared,  # R^2 value
-                "residuals": residuals.flatten(),  # residuals
-            }
+def wls_many(x, Y, W, intercept=False):
+    """
+    Weighted least squares of many targets (and weights) on the same x in one call, same results as calling wls on
+    every column.
+
+    if W is a single weight vector X'WX is factorized once (Cholesky) and shared by every target, otherwise the k
+    systems are solved as one batch.
+    Args:
+        x: 2D array (n, p) of features, or 1D for a single feature
+        Y: targets, an array (n, k) with one target per column
+        W: weights, (n,) shared by every target or (n, k) with one weight vector per target
+        intercept: whether to include an intercept in the model
+    Returns:
+        dict: the keys of wls with the targets on the first axis: coefficients (k, p), intercept (k,), R2 (k,) and
+        residuals (k, n)
+    Examples:
+    res = wls_many(x, np.column_stack([y1, y2]), exponential_halflife(len(x), 100))
+    res['coefficients'][1]  # same as wls(x, y2, exponential_halflife(len(x), 100))['coefficients']
+    """
+    Y = np.asarray(Y, dtype=float)
+    W = np.asarray(W, dtype=float)
+    if Y.ndim == 1:
+        Y = Y.reshape(-1, 1)
+    if len(x) != len(Y) or len(Y) != len(W):
+        raise ValueError("The lengths of x, Y, and W must be the same")
+
+    X = _design(x, intercept)
+    try:
+        if W.ndim == 1:
+            X_w = X * np.sqrt(W)[:, None]
+            beta = cho_solve(cho_factor(X_w.T @ X_w), X.T @ (Y * W[:, None])).T
         else:
-            return {
-                "coefficients": beta,  # coefficients for predictors
-                "R2": r_squared,  # R^2 value
-                "residuals": residuals.flatten(),  # residuals
-            }
+            # one (p, p) system per target
+            XTWX = np.einsum('np,nq,nk->kpq', X, X, W)
+            XTWY = np.einsum('np,nk->kp', X, Y * W)
+            beta = np.linalg.solve(XTWX, XTWY[..., None])[..., 0]
+    except np.linalg.LinAlgError as e:
+        raise np.linalg.LinAlgError("Matrix is singular and cannot be inverted.") from e
+
+    residuals = Y - X @ beta.T
+    W = np.broadcast_to(W.reshape(len(W), -1), Y.shape)
+    SS_res = np.sum(W * residuals ** 2, axis=0)
+    SS_tot = np.sum(W * (Y - Y.mean(axis=0)) ** 2, axis=0)
+    return _fit_result(beta, 1 - SS_res / SS_tot, residuals.T, intercept=intercept)
+
+
+def rolling_wls(x, y, w, window: int, step: int = 1, intercept=False):
+    """
+    wls on every rolling window of (x, y, w) in one call.
+
+    the windows are strided views of the inputs, so nothing is copied per window, and their normal equations are
+    solved as one batch. windows whose X'WX is singular get NaN coefficients instead of raising.
+    Args:
+        x: 2D array (n, p) of features, or 1D for a single feature
+        y: target, (n,)
+        w: weights, either (n,), one per row, or (window,), the same weights for every window (e.g.
+            exponential_halflife(window, h) to weigh the end of every window most)
+        window: number of rows of a window
+        step: distance between the starts of two consecutive windows
+        intercept: whether to include an intercept in the model
+    Returns:
+        dict: the keys of wls with the windows on the first axis: coefficients (m, p), intercept (m,), R2 (m,),
+        residuals (m, window), plus start (m,), the first row of every window
+    Examples:
+    res = rolling_wls(x, y, exponential_halflife(100, 20), window=100, step=10)
+    res['coefficients'][3]  # same as wls(x[30:130], y[30:130], exponential_halflife(100, 20))['coefficients']
+    """
+    X = _design(x, intercept)
+    y = np.asarray(y, dtype=float)
+    w = np.asarray(w, dtype=float)
+    if len(X) != len(y):
+        raise ValueError("The lengths of x and y must be the same")
+    if len(w) != len(y) and len(w) != window:
+        raise ValueError("w must have one weight per row or one weight per row of a window")
+
+    # (m, window, p), (m, window) and (m, window) views
+    X_win = np.lib.stride_tricks.sliding_window_view(X, window, axis=0)[::step].transpose(0, 2, 1)
+    y_win = np.lib.stride_tricks.sliding_window_view(y, window)[::step]
+    if len(w) == window and len(w) != len(y):
+        w_win = np.broadcast_to(w, y_win.shape)
+    else:
+        w_win = np.lib.stride_tricks.sliding_window_view(w, window)[::step]
+
+    XTWX = np.einsum('mwp,mwq,mw->mpq', X_win, X_win, w_win)
+    XTWY = np.einsum('mwp,mw->mp', X_win, y_win * w_win)
+    try:
+        beta = np.linalg.solve(XTWX, XTWY[..., None])[..., 0]
     except np.linalg.LinAlgError:
-        raise "Matrix is singular and cannot be inverted."
+        # we only look for the singular windows when the batch fails
+        singular = np.linalg.matrix_rank(XTWX) < XTWX.shape[-1]
+        XTWX[singular] = np.eye(XTWX.shape[-1])
+        beta = np.linalg.solve(XTWX, XTWY[..., None])[..., 0]
+        beta[singular] = np.nan
+
+    residuals = y_win - np.einsum('mwp,mp->mw', X_win, beta)
+    SS_res = np.sum(w_win * residuals ** 2, axis=1)
+    SS_tot = np.sum(w_win * (y_win - y_win.mean(axis=1, keepdims=True)) ** 2, axis=1)
+    res = _fit_result(beta, 1 - SS_res / SS_tot, residuals, intercept=intercept)
+    res["start"] = np.arange(0, len(y) - window + 1, step)
+    return res
 
 
 def ols(y,x, intercept=False):
@@ -180,5 +278,136 @@ def ols(y,x, intercept=False):
                 "R2": r_squared,  # R^2 value
                 "residuals": residuals.flatten(),  # residuals
             }
-    except np.linalg.LinAlgError:
-        raise "Matrix is singular and cannot be inverted."
+    except np.linalg.LinAlgError as e:
+        raise np.linalg.LinAlgError("Matrix is singular and cannot be inverted.") from e
+
+
+def _cholesky_inverse(A, floor=0.0) -> np.ndarray:
+    """
+    inverse of a batch of symmetric positive semi-definite matrices (..., p, p) through the Cholesky factors of their
+    correlation form, which keeps badly scaled columns (prices next to returns) precise.
+    the matrices with a diagonal entry below floor or with (numerically) collinear columns are NaN.
+    """
+    diag = np.diagonal(A, axis1=-2, axis2=-1)
+    singular = np.any(diag <= floor, axis=-1)
+    scale = 1 / np.sqrt(np.where(diag > 0, diag, 1))
+    corr = A * scale[..., :, None] * scale[..., None, :]
+    singular |= np.linalg.eigvalsh(corr)[..., 0] <= 1e-12 * A.shape[-1]
+    corr[singular] = np.eye(A.shape[-1])
+    L_inv = np.linalg.inv(np.linalg.cholesky(corr))
+    A_inv = (np.swapaxes(L_inv, -1, -2) @ L_inv) * scale[..., :, None] * scale[..., None, :]
+    A_inv[singular] = np.nan
+    return A_inv
+
+
+def ols_many(Y, X, intercept=False):
+    """
+    ols of many targets on the same X, same results as calling ols on every column of Y.
+
+    X'X is factorized once (Cholesky) for every target and for the standard errors of the t statistics.
+    Args:
+        Y: targets, an array (n, k) with one target per column
+        X: 2D array (n, p) of features, or 1D for a single feature
+        intercept: whether to include an intercept in the model
+    Returns:
+        dict: the keys of ols with the targets on the first axis: coefficients (k, p), intercept (k,), t_stats
+        (k, p + intercept), R2 (k,) and residuals (k, n)
+    Examples:
+    res = ols_many(np.column_stack([coconut_mid, coupon_mid]), x, intercept=True)
+    res['t_stats'][0]  # same as ols(coconut_mid, x, intercept=True)['t_stats']
+    """
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y.reshape(-1, 1)
+    X = _design(X, intercept)
+    if len(X) != len(Y):
+        raise ValueError("The lengths of X and Y must be the same")
+
+    try:
+        factor = cho_factor(X.T @ X)
+    except np.linalg.LinAlgError as e:
+        raise np.linalg.LinAlgError("Matrix is singular and cannot be inverted.") from e
+    beta = cho_solve(factor, X.T @ Y)  # (p, k)
+    XTX_inv_diag = np.diag(cho_solve(factor, np.eye(X.shape[1])))
+
+    residuals = Y - X @ beta
+    SS_res = np.sum(residuals ** 2, axis=0)
+    SS_tot = np.sum((Y - Y.mean(axis=0)) ** 2, axis=0)
+    df = len(Y) - X.shape[1]
+    se = np.sqrt(np.outer(SS_res / df, XTX_inv_diag))
+    return _fit_result(beta.T, 1 - SS_res / SS_tot, residuals.T, intercept=intercept, t_stats=beta.T / se)
+
+
+def rolling_ols(y, X, window: int, step: int = 1, intercept=False):
+    """
+    ols on every rolling window of (y, X), e.g. a walk-forward study of the coefficients over several days.
+
+    the cross products of every window are differences of cumulative sums, so the cost does not depend on window.
+    the cumulative sums are taken on data centered on its overall mean, which keeps prices in the thousands as
+    precise as returns. each window is then solved through the Cholesky factor of its own X'X.
+    windows whose X'X is singular are NaN.
+    Args:
+        y: target, (n,)
+        X: 2D array (n, p) of features, or 1D for a single feature
+        window: number of rows of a window
+        step: distance between the starts of two consecutive windows
+        intercept: whether to include an intercept in the model
+    Returns:
+        dict: the keys of ols with the windows on the first axis, without the residuals: coefficients (m, p),
+        intercept (m,), t_stats (m, p + intercept), R2 (m,), plus start (m,), the first row of every window
+    Examples:
+    res = rolling_ols(coconut_mid, coupon_mid, window=1000, step=100, intercept=True)
+    res['coefficients'][:, 0]  # coefficient of coupon_mid in every window
+    """
+    y = np.asarray(y, dtype=float)
+    X = _design(X)
+    if len(X) != len(y):
+        raise ValueError("The lengths of X and y must be the same")
+    p = X.shape[1]
+    Z = np.column_stack([X, y])
+    mean = Z.mean(axis=0)
+    Z_c = Z - mean
+
+    # window sums of z and z z' from cumulative sums, windows are [start, start + window)
+    start = np.arange(0, len(y) - window + 1, step)
+    end = start + window
+    S1 = np.cumsum(np.vstack([np.zeros(p + 1), Z_c]), axis=0)
+    S1 = S1[end] - S1[start]
+    S2 = np.cumsum(np.concatenate([np.zeros((1, p + 1, p + 1)), Z_c[:, :, None] * Z_c[:, None, :]]), axis=0)
+    S2 = S2[end] - S2[start]
+    # cross products centered on the mean of each window
+    C = S2 - S1[:, :, None] * S1[:, None, :] / window
+    SS_tot = C[:, p, p]
+
+    if intercept:
+        XTX, XTY = C[:, :p, :p], C[:, :p, p]
+    else:
+        # raw cross products, sum of (z_c + mean)(z_c + mean)'
+        R = S2 + S1[:, :, None] * mean + mean[:, None] * S1[:, None, :] + window * np.outer(mean, mean)
+        XTX, XTY = R[:, :p, :p], R[:, :p, p]
+    # a constant column in a window only leaves the rounding noise of the cumulative sums
+    XTX_inv = _cholesky_inverse(XTX, floor=1e-12 * np.sum(Z_c[:, :p] ** 2, axis=0))
+    beta = np.einsum('mpq,mq->mp', XTX_inv, XTY)
+    XTX_inv_diag = np.diagonal(XTX_inv, axis1=1, axis2=2)
+
+    # the residual of a row is g'z with g = (-beta, 1), SS_res is a quadratic form of the centered sums rather than
+    # a difference of raw sums of squares, which would cancel for prices
+    g = np.column_stack([-beta, np.ones(len(start))])
+    if intercept:
+        SS_res = np.einsum('mp,mpq,mq->m', g, C, g)
+        x_mean = mean[:p] + S1[:, :p] / window
+        y_mean = mean[p] + S1[:, p] / window
+        beta = np.column_stack([y_mean - np.einsum('mp,mp->m', x_mean, beta), beta])
+        # the intercept variance of a centered design is 1 / n + x_mean' (X_c'X_c)^-1 x_mean
+        XTX_inv_diag = np.column_stack([1 / window + np.einsum('mp,mpq,mq->m', x_mean, XTX_inv, x_mean),
+                                        XTX_inv_diag])
+    else:
+        # residual = g'z_c + g'mean
+        offset = g @ mean
+        SS_res = (np.einsum('mp,mpq,mq->m', g, S2, g) + 2 * offset * np.einsum('mp,mp->m', g, S1)
+                  + window * offset ** 2)
+    df = window - beta.shape[1]
+    se = np.sqrt(np.maximum(SS_res, 0)[:, None] / df * XTX_inv_diag)
+    res = _fit_result(beta, 1 - SS_res / SS_tot, intercept=intercept, t_stats=beta / se)
+    res["start"] = start
+    return res
@@ -1,8 +1,8 @@
-import pandas as pd
 import numpy as np
-import glob
 import plotly.graph_objects as go
 
+from data_store import MarketDataStore
+
 
 def player_position(player_buy_trade, player_sell_trade, symbol_r_quote):
     player_buy_trade = player_buy_trade.reindex(symbol_r_quote.index).fillna(0)
@@ -30,37 +30,19 @@ def metrics(pnl):
 
 
 def visualize_player_product(player, product, round,plot=True):
-    # get all files under src/round1
-    files = glob.glob('src/round5/round-5-island-data-bottle/*.csv')
-    round_files = glob.glob(f'src/round{round}/round-{round}-island-data-bottle/*.csv')
-    r_quote = []
-    for file in round_files:
-        if 'prices' in file:
-            print(file)
-            df = pd.read_csv(file, sep=';', index_col=0)
-            r_quote.append(df)
-    r_quote = pd.concat(r_quote).reset_index().set_index(['day', 'timestamp']).sort_index().reset_index()
-
-    r_quote['merged_timestamp'] = (r_quote['day'] + 2) * 1000000 + r_quote['timestamp']
-
-    r_quote.set_index('merged_timestamp', inplace=True)
-
-    r = []
-    df_keys = []
-    for file in files:
-        if f'round_{round}' in file:
-            print(file)
-            df = pd.read_csv(file, sep=';', index_col=0)
-            r.append(df)
-            df_keys.append(int(file.split(f'trades_round_{round}_day_')[1].split('_wn.csv')[0]))
-    r = pd.concat(r, keys=df_keys, names=['day']).reset_index().set_index(
-        ['day', 'timestamp']).sort_index().reset_index()
+    # prices come from the round directory, the named trades of every round are in the round 5 directory.
+    # both are read through the data_store columnar cache, so only the first call parses the csv files
+    r_quote = MarketDataStore(f'src/round{round}/round-{round}-island-data-bottle', round).prices().to_frame()
+    r_quote.set_index('key', inplace=True)
+    r_quote.index.name = 'merged_timestamp'
+
+    r = MarketDataStore('src/round5/round-5-island-data-bottle', round).trades().to_frame()
 
     print(
-        f'player: {[x for x in r[r['symbol'] == product]['buyer'].unique() if x in r[r['symbol'] == product]['seller'].unique()]}')
+        f'player: {[x for x in r[r["symbol"] == product]["buyer"].unique() if x in r[r["symbol"] == product]["seller"].unique()]}')
 
-    r['merged_timestamp'] = (r['day'] + 2) * 1000000 + r['timestamp']
-    r.set_index('merged_timestamp', inplace=True)
+    r.set_index('key', inplace=True)
+    r.index.name = 'merged_timestamp'
 
     # all trade in r where buyer is player or seller is player
     tmp = r[r['symbol'] == product]